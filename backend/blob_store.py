@@ -0,0 +1,50 @@
+import os
+import uuid
+import shutil
+from typing import BinaryIO
+
+# --- Configuración del almacén de blobs ---
+# La API y los workers de Celery deben compartir este directorio (disco local o volumen montado).
+BLOB_STORE_DIR = os.environ.get("GMD_BLOB_DIR", "uploads/blobs")
+COPY_CHUNK_SIZE = 1024 * 1024
+
+class FileSystemBlobStore:
+    """
+    Almacén de blobs sobre el sistema de archivos.
+
+    Los archivos se guardan por bloques bajo un identificador opaco, de modo que a las
+    tareas de Celery solo se les pasa el identificador y nunca el contenido.
+    """
+
+    def __init__(self, base_dir: str = BLOB_STORE_DIR):
+        self.base_dir = base_dir
+        os.makedirs(self.base_dir, exist_ok=True)
+
+    def path(self, blob_id: str) -> str:
+        """Devuelve la ruta local de un blob."""
+        # El identificador nunca debe poder salir del directorio base
+        if os.path.basename(blob_id) != blob_id:
+            raise ValueError(f"Identificador de blob no válido: {blob_id}")
+        return os.path.join(self.base_dir, blob_id)
+
+    def new_blob_id(self, suffix: str = "") -> str:
+        """Genera un identificador de blob nuevo; el llamador escribe el archivo en `path(blob_id)`."""
+        return f"{uuid.uuid4().hex}{suffix}"
+
+    def put_stream(self, source: BinaryIO, suffix: str = "") -> str:
+        """Copia un flujo al almacén por bloques y devuelve el identificador del blob."""
+        blob_id = self.new_blob_id(suffix)
+        tmp_path = self.path(blob_id) + ".part"
+        with open(tmp_path, "wb") as destination:
+            shutil.copyfileobj(source, destination, COPY_CHUNK_SIZE)
+        os.replace(tmp_path, self.path(blob_id))
+        return blob_id
+
+    def delete(self, blob_id: str):
+        """Elimina un blob si existe."""
+        try:
+            os.remove(self.path(blob_id))
+        except FileNotFoundError:
+            pass
+
+blob_store = FileSystemBlobStore()
@@ -1,11 +1,20 @@
 import io
+import os
+import copy
+import glob
+import uuid
+import shutil
 import zipfile
 import pandas as pd
-from celery import Celery
+from celery import Celery, chord
+from celery.exceptions import Ignore
 from docx import Document
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
 from typing import Dict, Any
 
 from database import SessionLocal
+from blob_store import blob_store
 import models
 
 # --- Importaciones de la lógica de documentos de main.py ---
@@ -13,32 +22,36 @@ import models
 import re
 PLACEHOLDER_REGEX = re.compile(r"\[(.*?)\]")
 
+def replace_placeholders_in_paragraph(paragraph: Paragraph, data: Dict[str, Any]):
+    """Reemplaza los placeholders de un párrafo con los datos proporcionados, preservando el formato."""
+    full_text = paragraph.text
+    original_runs = list(paragraph.runs)
+
+    for key, value in data.items():
+        full_text = full_text.replace(f"[{key}]", str(value))
+
+    for run in original_runs:
+        run.clear()
+
+    if original_runs:
+        new_run = paragraph.add_run(full_text)
+        first_run_format = original_runs[0].font
+        new_run.font.bold = first_run_format.bold
+        new_run.font.italic = first_run_format.italic
+        new_run.font.underline = first_run_format.underline
+        new_run.font.color.rgb = first_run_format.color.rgb
+        new_run.font.size = first_run_format.size
+        new_run.font.name = first_run_format.name
+    else:
+        paragraph.add_run(full_text)
+
 def replace_placeholders_in_doc(doc: Document, data: Dict[str, Any]):
     """Reemplaza los placeholders en un documento con los datos proporcionados, preservando el formato."""
 
     def _replace_in_element(element):
         # Si el elemento es un párrafo, procesarlo directamente
         if hasattr(element, 'runs'):
-            full_text = element.text
-            original_runs = list(element.runs)
-
-            for key, value in data.items():
-                full_text = full_text.replace(f"[{key}]", str(value))
-
-            for run in original_runs:
-                run.clear()
-
-            if original_runs:
-                new_run = element.add_run(full_text)
-                first_run_format = original_runs[0].font
-                new_run.font.bold = first_run_format.bold
-                new_run.font.italic = first_run_format.italic
-                new_run.font.underline = first_run_format.underline
-                new_run.font.color.rgb = first_run_format.color.rgb
-                new_run.font.size = first_run_format.size
-                new_run.font.name = first_run_format.name
-            else:
-                element.add_run(full_text)
+            replace_placeholders_in_paragraph(element, data)
         # Si el elemento es una celda, iterar sobre sus párrafos
         elif hasattr(element, 'paragraphs'):
             for p in element.paragraphs:
@@ -54,6 +67,95 @@ def replace_placeholders_in_doc(doc: Document, data: Dict[str, Any]):
             for cell in row.cells:
                 _replace_in_element(cell)
 
+class CompiledTemplate:
+    """
+    Plantilla .docx analizada una sola vez por trabajo.
+
+    Conserva el paquete ya parseado y las posiciones (dentro del cuerpo) de los párrafos
+    que contienen placeholders. Cada fila se genera a partir de una copia en memoria del
+    cuerpo original, sin volver a leer el archivo .docx del disco.
+    """
+
+    def __init__(self, template_path: str):
+        self.document = Document(template_path)
+        self._body = self.document.element.body
+        self._pristine_body = copy.deepcopy(self._body)
+        self.placeholder_positions = [
+            position
+            for position, p in enumerate(self._pristine_body.iter(qn('w:p')))
+            if PLACEHOLDER_REGEX.search(Paragraph(p, self.document).text)
+        ]
+
+    def render(self, data: Dict[str, Any]) -> bytes:
+        """Genera el documento de una fila y devuelve el contenido del .docx en bytes."""
+        body = copy.deepcopy(self._pristine_body)
+        self.document.element.replace(self._body, body)
+        self._body = body
+
+        paragraphs = list(body.iter(qn('w:p')))
+        for position in self.placeholder_positions:
+            replace_placeholders_in_paragraph(Paragraph(paragraphs[position], self.document), data)
+
+        doc_buffer = io.BytesIO()
+        self.document.save(doc_buffer)
+        return doc_buffer.getvalue()
+
+def build_row_data(row: pd.Series, mappings: dict, columns) -> Dict[str, Any]:
+    """Construye el diccionario placeholder -> valor de una fila según los mapeos."""
+    data_for_row = {}
+    for placeholder, column_name in mappings.items():
+        if column_name in columns:
+            data_for_row[placeholder] = row[column_name]
+    return data_for_row
+
+# --- Compresión de los miembros del ZIP de resultados ---
+# Cada .docx ya es un paquete comprimido; volver a comprimirlo gasta CPU sin reducir casi el tamaño.
+ZIP_COMPRESSION_METHODS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflated": zipfile.ZIP_DEFLATED,
+}
+DEFAULT_ZIP_COMPRESSION = os.environ.get("GMD_ZIP_COMPRESSION", "stored")
+
+# --- Reparto de trabajos grandes en bloques paralelos ---
+# Los trabajos con más filas que este tamaño se dividen en subtareas de este número de filas.
+DEFAULT_CHUNK_SIZE = int(os.environ.get("GMD_CHUNK_SIZE", "1000"))
+
+def write_documents_zip(zip_path: str, template: CompiledTemplate, df_rows: pd.DataFrame, mappings: dict, compression_method: int, on_row_done=None):
+    """
+    Genera un documento por fila y lo escribe en el ZIP en disco en cuanto se produce,
+    de modo que en memoria solo vive un documento a la vez.
+    `on_row_done(index, processed_rows)` se llama después de escribir cada documento.
+    """
+    processed_rows = 0
+    with zipfile.ZipFile(zip_path, 'w', compression_method) as zip_file:
+        for index, row in df_rows.iterrows():
+            doc_bytes = template.render(build_row_data(row, mappings, df_rows.columns))
+            zip_file.writestr(f"documento_{index + 1}.docx", doc_bytes)
+            processed_rows += 1
+            if on_row_done:
+                on_row_done(index, processed_rows)
+    return processed_rows
+
+def mark_job_failed(job_id: str):
+    """Marca un trabajo de generación como fallido en la base de datos."""
+    db = SessionLocal()
+    try:
+        db_job = db.query(models.GenerationJob).filter(models.GenerationJob.id == job_id).first()
+        if db_job:
+            db_job.status = 'FAILURE'
+            db.commit()
+    finally:
+        db.close()
+
+def chunk_zip_path(job_id: str, chunk_number: int) -> str:
+    """Ruta del ZIP parcial de un bloque de un trabajo repartido."""
+    return f"generated_docs_{job_id}.chunk{chunk_number:04d}.zip"
+
+def remove_file_if_exists(path: str):
+    """Borra un archivo si existe."""
+    if os.path.exists(path):
+        os.remove(path)
+
 # --- Configuración de Celery ---
 celery_app = Celery(
     "tasks",
@@ -67,9 +169,11 @@ celery_app.conf.update(
 
 # --- Tarea Asíncrona de Generación de Documentos ---
 @celery_app.task(bind=True)
-def generate_documents_task(self, template_path: str, data_content_bytes: bytes, data_filename: str, mappings: dict, num_rows_to_generate: int | None = None):
+def generate_documents_task(self, template_path: str, data_blob_id: str, data_filename: str, mappings: dict, num_rows_to_generate: int | None = None, zip_compression: str | None = None, chunk_size: int | None = None):
     """
     Tarea de Celery que genera documentos en segundo plano.
+    `zip_compression` elige el método de compresión de los miembros del ZIP ("stored" o "deflated").
+    Si el trabajo tiene más de `chunk_size` filas, se reparte en subtareas paralelas.
     """
     db = SessionLocal()
     try:
@@ -80,66 +184,76 @@ def generate_documents_task(self, template_path: str, data_content_bytes: bytes,
         db_job.status = 'PROGRESS'
         db.commit()
 
+        compression_method = ZIP_COMPRESSION_METHODS.get(zip_compression or DEFAULT_ZIP_COMPRESSION)
+        if compression_method is None:
+            raise ValueError(f"Método de compresión de ZIP no soportado: {zip_compression}")
+
         # --- 1. Leer el archivo de datos ---
         self.update_state(state='PROGRESS', meta={'status': 'Leyendo archivo de datos...'})
+        data_path = blob_store.path(data_blob_id)
         if data_filename.endswith('.xlsx'):
-            df = pd.read_excel(io.BytesIO(data_content_bytes))
+            df = pd.read_excel(data_path)
         elif data_filename.endswith('.csv'):
-            df = pd.read_csv(io.BytesIO(data_content_bytes))
+            df = pd.read_csv(data_path)
         else:
             raise ValueError("Formato de archivo de datos no soportado.")
 
-        # --- 2. Generar Documentos y Comprimir en ZIP ---
+        # Limitar el DataFrame si num_rows_to_generate está especificado
+        if num_rows_to_generate is not None and num_rows_to_generate > 0:
+            df_to_process = df.head(num_rows_to_generate)
+        else:
+            df_to_process = df
+        total_rows = len(df_to_process)
+
+        # Trabajos grandes: repartir las filas en bloques que se generan en paralelo y unirlos al final
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        if total_rows > chunk_size:
+            return self.replace(build_chunked_job(self, template_path, df_to_process, mappings, zip_compression, chunk_size))
+
+        # --- 2. Compilar la plantilla una sola vez para todo el trabajo ---
+        self.update_state(state='PROGRESS', meta={'status': 'Analizando plantilla...'})
+        template = CompiledTemplate(template_path)
+
+        # --- 3. Generar Documentos ---
         self.update_state(state='PROGRESS', meta={'status': 'Generando documentos...'})
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Limitar el DataFrame si num_rows_to_generate está especificado
-            if num_rows_to_generate is not None and num_rows_to_generate > 0:
-                df_to_process = df.head(num_rows_to_generate)
-            else:
-                df_to_process = df
-            
-            total_rows = len(df_to_process)
-            for index, row in df_to_process.iterrows():
-                doc = Document(template_path)
-                
-                data_for_row = {}
-                for placeholder, column_name in mappings.items():
-                    if column_name in df.columns:
-                        data_for_row[placeholder] = row[column_name]
-                
-                replace_placeholders_in_doc(doc, data_for_row)
-                
-                doc_buffer = io.BytesIO()
-                doc.save(doc_buffer)
-                doc_buffer.seek(0)
-                
-                zip_file.writestr(f"documento_{index + 1}.docx", doc_buffer.getvalue())
-                # Actualizar el progreso
-                self.update_state(state='PROGRESS', meta={'status': f'Procesando fila {index + 1} de {total_rows}'})
-
-        # Si solo se generó un documento, devolverlo directamente
+
+        # Si solo se genera un documento, devolverlo directamente
         if total_rows == 1:
-            doc_buffer = io.BytesIO()
-            doc.save(doc_buffer)
-            doc_buffer.seek(0)
+            _, row = next(df_to_process.iterrows())
             output_filename = f"documento_{self.request.id}.docx"
             with open(output_filename, "wb") as f:
-                f.write(doc_buffer.getvalue())
+                f.write(template.render(build_row_data(row, mappings, df.columns)))
             db_job.status = 'SUCCESS'
             db_job.result_file_path = output_filename
             db.commit()
             return {'status': 'Completed', 'result': output_filename, 'file_type': 'docx'}
-        else:
-            zip_buffer.seek(0)
-            output_filename = f"generated_docs_{self.request.id}.zip"
-            with open(output_filename, "wb") as f:
-                f.write(zip_buffer.getvalue())
-            db_job.status = 'SUCCESS'
-            db_job.result_file_path = output_filename
-            db.commit()
-            return {'status': 'Completed', 'result': output_filename, 'file_type': 'zip'}
 
+        output_filename = f"generated_docs_{self.request.id}.zip"
+        partial_filename = f"{output_filename}.part"
+
+        def report_progress(index, processed_rows):
+            self.update_state(state='PROGRESS', meta={
+                'status': f'Procesando fila {index + 1} de {total_rows}',
+                'current': processed_rows,
+                'total': total_rows
+            })
+
+        try:
+            write_documents_zip(partial_filename, template, df_to_process, mappings, compression_method, report_progress)
+        except Exception:
+            # No dejar en disco el ZIP a medio escribir
+            remove_file_if_exists(partial_filename)
+            raise
+        os.replace(partial_filename, output_filename)
+
+        db_job.status = 'SUCCESS'
+        db_job.result_file_path = output_filename
+        db.commit()
+        return {'status': 'Completed', 'result': output_filename, 'file_type': 'zip'}
+
+    except Ignore:
+        # La tarea fue reemplazada por sus bloques paralelos; no es un fallo
+        raise
     except Exception as e:
         db_job = db.query(models.GenerationJob).filter(models.GenerationJob.id == self.request.id).first()
         if db_job:
@@ -161,4 +275,108 @@ def generate_documents_task(self, template_path: str, data_content_bytes: bytes,
         # Devolver la información de la excepción para que Celery la procese correctamente
         raise e # Re-lanzar la excepción para que Celery la marque como FAILURE
     finally:
-        db.close()
\ No newline at end of file
+        blob_store.delete(data_blob_id)
+        db.close()
+
+def build_chunked_job(task, template_path: str, df_to_process: pd.DataFrame, mappings: dict, zip_compression: str | None, chunk_size: int):
+    """
+    Divide las filas en bloques, guarda cada bloque en el almacén de blobs y devuelve el chord
+    de subtareas. El paso final hereda el ID del trabajo al reemplazar a la tarea original.
+    """
+    job_id = task.request.id
+    mapped_columns = [column for column in dict.fromkeys(mappings.values()) if column in df_to_process.columns]
+    total_rows = len(df_to_process)
+
+    chunk_signatures = []
+    for chunk_number, start in enumerate(range(0, total_rows, chunk_size)):
+        chunk_blob_id = blob_store.new_blob_id(".pkl")
+        df_to_process.iloc[start:start + chunk_size][mapped_columns].to_pickle(blob_store.path(chunk_blob_id))
+        chunk_signatures.append(
+            generate_documents_chunk_task.s(template_path, chunk_blob_id, mappings, zip_compression, job_id, chunk_number)
+            .set(task_id=str(uuid.uuid4()))
+        )
+
+    task.update_state(state='PROGRESS', meta={
+        'status': f'Generando {total_rows} documentos en {len(chunk_signatures)} bloques paralelos...',
+        'current': 0,
+        'total': total_rows,
+        'chunk_ids': [signature.id for signature in chunk_signatures]
+    })
+    # Si falla algún bloque el paso final no se ejecuta; el callback de error borra los ZIP parciales
+    assemble_signature = assemble_chunks_task.s(zip_compression, total_rows)
+    assemble_signature.link_error(cleanup_chunk_zips_task.s(job_id))
+    return chord(chunk_signatures, assemble_signature)
+
+@celery_app.task(bind=True)
+def generate_documents_chunk_task(self, template_path: str, chunk_blob_id: str, mappings: dict, zip_compression: str | None, job_id: str, chunk_number: int):
+    """
+    Subtarea de Celery que genera los documentos de un bloque de filas en un ZIP parcial.
+    """
+    partial_path = chunk_zip_path(job_id, chunk_number)
+    try:
+        compression_method = ZIP_COMPRESSION_METHODS[zip_compression or DEFAULT_ZIP_COMPRESSION]
+        df_chunk = pd.read_pickle(blob_store.path(chunk_blob_id))
+        template = CompiledTemplate(template_path)
+        chunk_rows = len(df_chunk)
+
+        def report_progress(index, processed_rows):
+            self.update_state(state='PROGRESS', meta={'current': processed_rows, 'total': chunk_rows})
+
+        write_documents_zip(partial_path, template, df_chunk, mappings, compression_method, report_progress)
+        return {'partial_path': partial_path, 'rows': chunk_rows}
+    except Exception:
+        remove_file_if_exists(partial_path)
+        mark_job_failed(job_id)
+        raise
+    finally:
+        blob_store.delete(chunk_blob_id)
+
+@celery_app.task(bind=True)
+def assemble_chunks_task(self, chunk_results: list, zip_compression: str | None, total_rows: int):
+    """
+    Paso final de un trabajo repartido: une los ZIP parciales en un solo archivo y registra el
+    resultado en `GenerationJob`. Se ejecuta con el ID del trabajo original.
+    """
+    job_id = self.request.id
+    partial_paths = [chunk_result['partial_path'] for chunk_result in chunk_results]
+    output_filename = f"generated_docs_{job_id}.zip"
+    partial_filename = f"{output_filename}.part"
+    db = SessionLocal()
+    try:
+        self.update_state(state='PROGRESS', meta={'status': 'Uniendo bloques...', 'current': total_rows, 'total': total_rows})
+        compression_method = ZIP_COMPRESSION_METHODS[zip_compression or DEFAULT_ZIP_COMPRESSION]
+
+        with zipfile.ZipFile(partial_filename, 'w', compression_method) as zip_file:
+            for partial_path in partial_paths:
+                with zipfile.ZipFile(partial_path) as partial_zip:
+                    for member_info in partial_zip.infolist():
+                        target_info = zipfile.ZipInfo(member_info.filename, date_time=member_info.date_time)
+                        target_info.compress_type = compression_method
+                        with partial_zip.open(member_info) as source, zip_file.open(target_info, 'w') as target:
+                            shutil.copyfileobj(source, target)
+        os.replace(partial_filename, output_filename)
+
+        db_job = db.query(models.GenerationJob).filter(models.GenerationJob.id == job_id).first()
+        if db_job:
+            db_job.status = 'SUCCESS'
+            db_job.result_file_path = output_filename
+            db.commit()
+        return {'status': 'Completed', 'result': output_filename, 'file_type': 'zip'}
+    except Exception:
+        remove_file_if_exists(partial_filename)
+        mark_job_failed(job_id)
+        raise
+    finally:
+        for partial_path in partial_paths:
+            remove_file_if_exists(partial_path)
+        db.close()
+
+@celery_app.task
+def cleanup_chunk_zips_task(request, exc, traceback, job_id: str):
+    """
+    Callback de error del chord de un trabajo repartido: si falla algún bloque, el paso final
+    no llega a ejecutarse, así que aquí se borran los ZIP parciales que sí se generaron.
+    """
+    for partial_path in glob.glob(glob.escape(f"generated_docs_{job_id}") + ".chunk*.zip"):
+        remove_file_if_exists(partial_path)
+    mark_job_failed(job_id)
@@ -1,16 +1,24 @@
+import os
 import re
 import io
 import json
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Depends
-from fastapi.responses import JSONResponse, FileResponse
+import asyncio
+import hashlib
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Depends, Request
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from docx import Document
-from typing import Set, List, Dict
+from typing import Set, List, Dict, Tuple
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 
 # --- Importar la instancia de Celery y la tarea ---
-from celery_worker import celery_app, generate_documents_task
+from celery import states
+from celery.result import AsyncResult
+from celery_worker import celery_app, generate_documents_task, ZIP_COMPRESSION_METHODS
+from blob_store import blob_store
 from database import SessionLocal, engine
 import models
 
@@ -29,6 +37,10 @@ class ProjectCreate(BaseModel):
 # --- Regex para encontrar placeholders como [TEXTO] ---
 PLACEHOLDER_REGEX = re.compile(r"\[(.*?)\]")
 
+# --- Intervalos del flujo de eventos de progreso (en segundos) ---
+JOB_EVENTS_POLL_INTERVAL = 0.5
+JOB_EVENTS_KEEPALIVE_INTERVAL = 15
+
 # --- Inicialización de la Aplicación FastAPI ---
 app = FastAPI(
     title="Document Generation API",
@@ -73,6 +85,26 @@ def find_placeholders_in_docx(doc: Document) -> Set[str]:
                     placeholders.update(PLACEHOLDER_REGEX.findall(p.text))
     return placeholders
 
+def compute_content_hash(content: bytes) -> str:
+    """Calcula el hash SHA-256 del contenido de un archivo."""
+    return hashlib.sha256(content).hexdigest()
+
+def build_placeholder_index(content: bytes, db: Session) -> Tuple[str, List[str]]:
+    """Devuelve el hash del contenido de una plantilla y la lista ordenada de sus placeholders.
+
+    Si otra plantilla con el mismo hash ya tiene su índice, se reutiliza sin volver a abrir el .docx.
+    """
+    content_hash = compute_content_hash(content)
+    indexed_template = db.query(models.Template).filter(
+        models.Template.content_hash == content_hash,
+        models.Template.placeholders.isnot(None)
+    ).first()
+    if indexed_template:
+        return content_hash, list(indexed_template.placeholders)
+
+    document = Document(io.BytesIO(content))
+    return content_hash, sorted(find_placeholders_in_docx(document))
+
 # --- Endpoints de la API ---
 
 @app.post("/templates", tags=["Templates"])
@@ -87,22 +119,34 @@ async def create_template(file: UploadFile = File(...), project_id: int = Form(.
     
     # Guardar el archivo en el directorio de uploads
     file_path = f"uploads/{file.filename}"
+    content = await file.read()
     with open(file_path, "wb") as buffer:
-        buffer.write(await file.read())
+        buffer.write(content)
     
     # Crear el registro en la base de datos
     db_template = models.Template(name=file.filename, file_path=file_path, project_id=project_id) # owner_id se elimina por ahora
-    db.add(db_template)
-    db.commit()
-    db.refresh(db_template)
 
-    # Analizar los placeholders
+    # Analizar los placeholders una sola vez y guardarlos con la plantilla
     try:
-        document = Document(file_path)
-        placeholders = find_placeholders_in_docx(document)
-        return {"id": db_template.id, "name": db_template.name, "placeholders": sorted(list(placeholders))}
+        content_hash, placeholders = build_placeholder_index(content, db)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error procesando el archivo: {e}")
+    db_template.content_hash = content_hash
+    db_template.placeholders = placeholders
+
+    # Si el archivo se sobrescribió con otro contenido, el índice de las plantillas que lo comparten queda obsoleto
+    stale_templates = db.query(models.Template).filter(
+        models.Template.file_path == file_path,
+        or_(models.Template.content_hash != content_hash, models.Template.content_hash.is_(None))
+    ).all()
+    for stale_template in stale_templates:
+        stale_template.content_hash = content_hash
+        stale_template.placeholders = placeholders
+
+    db.add(db_template)
+    db.commit()
+    db.refresh(db_template)
+    return {"id": db_template.id, "name": db_template.name, "placeholders": db_template.placeholders}
 
 @app.get("/templates", tags=["Templates"])
 async def get_templates(db: Session = Depends(get_db)):
@@ -131,12 +175,16 @@ async def get_template_placeholders(template_id: int, db: Session = Depends(get_
     if not db_template:
         raise HTTPException(status_code=404, detail="Plantilla no encontrada")
 
-    try:
-        document = Document(db_template.file_path)
-        placeholders = find_placeholders_in_docx(document)
-        return {"placeholders": sorted(list(placeholders))}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error procesando el archivo: {e}")
+    # Plantillas subidas antes de existir el índice: se construye una vez y se guarda
+    if db_template.placeholders is None:
+        try:
+            with open(db_template.file_path, "rb") as f:
+                db_template.content_hash, db_template.placeholders = build_placeholder_index(f.read(), db)
+            db.commit()
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error procesando el archivo: {e}")
+
+    return {"placeholders": db_template.placeholders}
 
 @app.post("/mappings", tags=["Mappings"])
 async def create_mapping(mapping: MappingCreate, db: Session = Depends(get_db)):
@@ -210,6 +258,8 @@ async def create_generation_job(
     data_file: UploadFile = File(...),
     mappings_json: str = Form(...),
     num_rows_to_generate: int | None = Form(None),
+    zip_compression: str | None = Form(None),
+    chunk_size: int | None = Form(None),
     project_id: int = Form(...),
     db: Session = Depends(get_db)
 ):
@@ -225,9 +275,16 @@ async def create_generation_job(
     if not db_project:
         raise HTTPException(status_code=404, detail="Proyecto no encontrado")
 
+    if chunk_size is not None and chunk_size <= 0:
+        raise HTTPException(status_code=400, detail="chunk_size debe ser mayor que cero.")
+
+    if zip_compression is not None and zip_compression not in ZIP_COMPRESSION_METHODS:
+        raise HTTPException(status_code=400, detail=f"zip_compression debe ser uno de: {', '.join(ZIP_COMPRESSION_METHODS)}")
+
     try:
         mappings = json.loads(mappings_json)
-        data_content = await data_file.read()
+        # El archivo de datos se copia por bloques al almacén de blobs; a la tarea solo le llega su identificador
+        data_blob_id = await run_in_threadpool(blob_store.put_stream, data_file.file, os.path.splitext(data_file.filename)[1])
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="El formato de mappings_json no es válido.")
     except Exception as e:
@@ -236,10 +293,12 @@ async def create_generation_job(
     # Lanzar la tarea de Celery en segundo plano
     task = generate_documents_task.delay(
         template_path=db_template.file_path,
-        data_content_bytes=data_content,
+        data_blob_id=data_blob_id,
         data_filename=data_file.filename,
         mappings=mappings,
-        num_rows_to_generate=num_rows_to_generate
+        num_rows_to_generate=num_rows_to_generate,
+        zip_compression=zip_compression,
+        chunk_size=chunk_size
     )
 
     # Guardar el trabajo en la base de datos
@@ -267,6 +326,73 @@ async def get_job_status(job_id: str, db: Session = Depends(get_db)):
     
     return JSONResponse(response)
 
+def get_chunk_processed_rows(chunk_id: str) -> int:
+    """Devuelve cuántas filas lleva generadas un bloque de un trabajo repartido."""
+    chunk_result = AsyncResult(chunk_id, app=celery_app)
+    if chunk_result.successful():
+        return chunk_result.result["rows"]
+    chunk_info = chunk_result.info
+    return chunk_info.get("current", 0) if isinstance(chunk_info, dict) else 0
+
+def get_job_progress_snapshot(job_id: str) -> dict:
+    """Lee el estado y los metadatos de progreso de un trabajo desde el backend de resultados de Celery."""
+    result = AsyncResult(job_id, app=celery_app)
+    state = result.state
+    info = result.info
+
+    snapshot = {"job_id": job_id, "status": state}
+    if isinstance(info, dict):
+        snapshot["message"] = info.get("status")
+        snapshot["current"] = info.get("current")
+        snapshot["total"] = info.get("total")
+        # Trabajos repartidos en bloques: el avance es la suma del avance de cada bloque
+        if info.get("chunk_ids"):
+            snapshot["current"] = sum(get_chunk_processed_rows(chunk_id) for chunk_id in info["chunk_ids"])
+    elif isinstance(info, Exception):
+        snapshot["error"] = str(info)
+    snapshot["result_url"] = f"/jobs/{job_id}/download" if state == states.SUCCESS else None
+    return snapshot
+
+@app.get("/jobs/{job_id}/events", tags=["Jobs"])
+async def stream_job_events(job_id: str, request: Request):
+    """
+    Envía el progreso de un trabajo como Server-Sent Events.
+    Solo emite un evento cuando cambian el estado o los metadatos, y cierra el flujo al terminar el trabajo.
+    """
+    # Sesión de vida corta: el flujo puede durar minutos y no debe retener una conexión del pool
+    db = SessionLocal()
+    try:
+        job_exists = db.query(models.GenerationJob.id).filter(models.GenerationJob.id == job_id).first() is not None
+    finally:
+        db.close()
+    if not job_exists:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+
+    async def event_generator():
+        last_snapshot = None
+        idle_time = 0.0
+        while not await request.is_disconnected():
+            snapshot = await run_in_threadpool(get_job_progress_snapshot, job_id)
+            if snapshot != last_snapshot:
+                yield f"data: {json.dumps(snapshot)}\n\n"
+                last_snapshot = snapshot
+                idle_time = 0.0
+            elif idle_time >= JOB_EVENTS_KEEPALIVE_INTERVAL:
+                # Comentario SSE para que proxies y navegadores no cierren la conexión inactiva
+                yield ": keep-alive\n\n"
+                idle_time = 0.0
+
+            if snapshot["status"] in states.READY_STATES:
+                break
+            await asyncio.sleep(JOB_EVENTS_POLL_INTERVAL)
+            idle_time += JOB_EVENTS_POLL_INTERVAL
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/jobs/{job_id}/download", tags=["Jobs"])
 async def download_job_result(job_id: str, db: Session = Depends(get_db)):
     """
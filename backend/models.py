@@ -32,6 +32,8 @@ class Template(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
     file_path = Column(String, nullable=False)
+    content_hash = Column(String, index=True, nullable=True)
+    placeholders = Column(JSON, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     project_id = Column(Integer, ForeignKey("projects.id"))
 
@@ -19,6 +19,7 @@ import tempfile
 import shutil
 import threading
 import copy
+import bisect
 import unicodedata
 from openpyxl.styles import Font, Alignment
 import sys # <--- ASEGÚRATE QUE ESTA LÍNEA ESTÉ PRESENTE Y NO COMENTADA
@@ -127,6 +128,8 @@ except ImportError:
         @property
         def size(self): return (0,0)
 
+import ocr_escaneo # Motor de OCR compartido (Tesseract en memoria, con pytesseract como respaldo)
+
 # --- docx2pdf ---
 try:
     from docx2pdf import convert
@@ -554,10 +557,12 @@ def buscar_pdf_oficio(numero_oficio_str, directorio_base_pdfs_obj, nombre_contri
             return archivos_encontrados_validos[0]
 
 
-def obtener_datos_placas_montos_de_bd_multas(oficio_id_reporte, df_bd_multas_maestro):
+def obtener_datos_placas_montos_de_bd_multas(oficio_id_reporte, df_bd_multas_maestro, indice_oficios=None):
     """
     Obtiene datos de placas y montos del DataFrame de la BD de multas maestra.
     Usa las constantes COL_BD_MAESTRA_OFICIO, COL_BD_MAESTRA_PLACA, COL_BD_MAESTRA_MONTO.
+    `indice_oficios` es el índice de construir_indice_oficios_multas sobre COL_BD_MAESTRA_OFICIO;
+    si no se pasa se construye aquí (conviene construirlo una vez fuera cuando se llama en bucle).
     Devuelve una lista de diccionarios: [{'PLACA': 'ABC', 'MONTO': 100.0}, ...]
     """
     if df_bd_multas_maestro.empty:
@@ -567,9 +572,11 @@ def obtener_datos_placas_montos_de_bd_multas(oficio_id_reporte, df_bd_multas_mae
     try:
         oficio_id_reporte_normalizado = normalizar_oficio_multas(str(oficio_id_reporte)) # Normaliza el ID del reporte
 
-        # Filtrar por el oficio_id_reporte (comparando formas normalizadas)
-        data_oficio_en_bd = df_bd_multas_maestro[ # df_bd_multas_maestro es en realidad df_base_de_datos_original
-            df_bd_multas_maestro[COL_BD_MAESTRA_OFICIO].apply(normalizar_oficio_multas) == oficio_id_reporte_normalizado
+        # Filtrar por el oficio_id_reporte (comparando formas normalizadas) a través del índice
+        if indice_oficios is None:
+            indice_oficios = construir_indice_oficios_multas(df_bd_multas_maestro[COL_BD_MAESTRA_OFICIO])
+        data_oficio_en_bd = df_bd_multas_maestro.iloc[ # df_bd_multas_maestro es en realidad df_base_de_datos_original
+            indice_oficios.get(oficio_id_reporte_normalizado, [])
         ]
     
 
@@ -1293,6 +1300,37 @@ def normalizar_oficio_multas(oficio_str):
     # print(f"    - ADVERTENCIA: Oficio '{oficio_str}' no pudo ser normalizado a un formato conocido. Se devuelve: '{s}'") # Opcional: habilitar para depuración
     return s
 
+def construir_indice_oficios_multas(serie_oficios):
+    """
+    Construye {oficio normalizado: [posiciones de fila]} sobre una columna de oficios.
+    Cada valor distinto se normaliza una sola vez y las posiciones quedan en orden ascendente,
+    igual que con un filtro `serie.apply(normalizar_oficio_multas) == oficio`.
+    """
+    indice = {}
+    normalizados = {}
+    for posicion, valor in enumerate(serie_oficios.tolist()):
+        clave = normalizados.get(valor)
+        if clave is None:
+            clave = normalizar_oficio_multas(valor)
+            normalizados[valor] = clave
+        indice.setdefault(clave, []).append(posicion)
+    return indice
+
+def mover_posicion_indice_oficios_multas(indice, posicion, clave_anterior, clave_nueva):
+    """
+    Mantiene el índice de oficios al cambiar el oficio de una fila, o al añadirla
+    (clave_anterior=None). Las posiciones de cada oficio siguen ordenadas.
+    """
+    if clave_anterior == clave_nueva:
+        return
+    if clave_anterior is not None:
+        posiciones = indice.get(clave_anterior, [])
+        if posicion in posiciones:
+            posiciones.remove(posicion)
+        if not posiciones:
+            indice.pop(clave_anterior, None)
+    bisect.insort(indice.setdefault(clave_nueva, []), posicion)
+
 def convertir_a_formato_con_barras(oficio_input_str):
     """
     Convierte un oficio en cualquier formato reconocible (ej. DIDCFMT12345 o DI/DCF/MT/12345)
@@ -1678,6 +1716,12 @@ def generar_un_documento_multas_v2(
             error_msg_pdf_intermedio = (f"Fallo al generar PDF completo intermedio. El archivo no se creó o está vacío. "
                                         f"Verifica el DOCX temporal: {ruta_docx_temp}")
             raise RuntimeError(error_msg_pdf_intermedio)
+
+        # QR con el oficio en cada página, para que el escaneo lo identifique sin OCR
+        if ocr_escaneo.ESTAMPAR_CODIGO_ID:
+            ocr_escaneo.estampar_codigo_id_pdf(
+                ruta_pdf_completo_intermedio_temp, CODIGO_ID_MODO_MULTAS, normalizar_oficio_multas(oficio_slashed_para_placeholder)
+            )
         
         num_paginas_pdf_completo = contar_paginas_pdf(ruta_pdf_completo_intermedio_temp)
         if num_paginas_pdf_completo is None:
@@ -1726,39 +1770,79 @@ def generar_un_documento_multas_v2(
 
 
 
-def extract_oficio_from_page_scan_multas(page_fitz_obj, page_num_debug):
+# Modo que va en el código de ID impreso en los documentos de Multas ("GOBID|MULTAS|DIDCFMT...")
+CODIGO_ID_MODO_MULTAS = "MULTAS"
+# Región de la página donde se busca el OFICIO (fracciones de la altura: desde el 50% hacia abajo)
+OCR_REGION_OFICIO_SCAN_MULTAS = (0.50, 1.0)
+OCR_ZOOM_SCAN_MULTAS = 3.0
+# Pase rápido del OCR adaptativo: zoom bajo y solo los caracteres que puede tener el oficio
+OCR_ZOOM_RAPIDO_SCAN_MULTAS = 2.0
+OCR_LISTA_BLANCA_SCAN_MULTAS = "DILCFMTdilcfmt0123456789"
+# El patrón busca "DIDCFMT" seguido de 6 o más dígitos
+PATRON_OFICIO_SCAN_MULTAS = re.compile(r"D[I1L]DCFMT\s*(\d{6,})", re.IGNORECASE)
+# Configuración que determina el resultado de extract_oficio_from_page_scan_multas (clave de la caché de
+# OCR); se completa con los oficios válidos del lote, de los que depende el escalado del OCR
+FIRMA_CACHE_OCR_SCAN_MULTAS = repr((
+    OCR_REGION_OFICIO_SCAN_MULTAS, OCR_ZOOM_SCAN_MULTAS, OCR_ZOOM_RAPIDO_SCAN_MULTAS,
+    OCR_LISTA_BLANCA_SCAN_MULTAS, PATRON_OFICIO_SCAN_MULTAS.pattern,
+))
+
+def extract_oficio_from_page_scan_multas(page_fitz_obj, page_num_debug, oficios_validos=None):
     """
     Extrae el OFICIO buscando únicamente en la mitad inferior de la página,
-    haciéndolo más rápido y preciso.
+    haciéndolo más rápido y preciso. Lee primero el código de ID impreso, luego la capa de
+    texto del PDF si la tiene y, si no, OCR. Lo leído en la capa de texto o a zoom bajo solo se
+    acepta si alguno de los oficios está en 'oficios_validos' (BD Maestra y CSV); si no, se
+    vuelve a leer a la resolución alta.
     """
-    try:
-        # Aumentar el zoom para mejor calidad de imagen
-        zoom = 3.0
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page_fitz_obj.get_pixmap(colorspace=fitz.csGRAY, matrix=mat, alpha=False)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        
-        # --- MEJORA CLAVE: Recortar la imagen a la mitad inferior ---
-        img_width, img_height = img.size
-        area_recorte = (0, int(img_height * 0.50), img_width, img_height) # Desde el 50% hacia abajo
-        img_recortada = img.crop(area_recorte)
-        
-        # Realizar OCR solo en la imagen recortada
-        texto_pagina = pytesseract.image_to_string(img_recortada, lang='spa', config='--psm 4')
+    patron_oficio = PATRON_OFICIO_SCAN_MULTAS
+
+    def hay_valido(candidatos):
+        return oficios_validos is None or any(candidato in oficios_validos for candidato in candidatos)
 
+    try:
+        # Si el documento lleva impreso el código de ID, el oficio sale de ahí sin OCR
+        oficios_codigo = ocr_escaneo.leer_codigo_id(page_fitz_obj, CODIGO_ID_MODO_MULTAS)
+        if oficios_codigo:
+            return list(set(normalizar_oficio_multas(oficio) for oficio in oficios_codigo)), "CODIGO_MULTAS_OK"
+
+        # Primero la capa de texto del PDF en la misma región: si ya trae el oficio no hace falta OCR
+        coincidencias = patron_oficio.findall(ocr_escaneo.texto_de_franja(page_fitz_obj, *OCR_REGION_OFICIO_SCAN_MULTAS))
+        candidatos_previos = list(set(f"DIDCFMT{match}" for match in coincidencias))
+        if candidatos_previos and hay_valido(candidatos_previos):
+            return candidatos_previos, "TEXTO_MULTAS_CANDIDATOS_OK"
+
+        # Una hoja escaneada en blanco no se pasa por OCR (se revisa con una miniatura del raster)
+        if not candidatos_previos and ocr_escaneo.pagina_en_blanco_por_raster(page_fitz_obj):
+            return [], ocr_escaneo.ESTADO_PAGINA_EN_BLANCO
+
+        # Solo se rasteriza la mitad inferior, en grises. Primero a zoom bajo y, si no aparece el
+        # oficio o no es válido, con el zoom alto de siempre para mejor calidad de imagen.
+        texto_pagina = ""
+        prefijo_estado = "TEXTO_"
+        for zoom, es_rapido in ocr_escaneo.pases_ocr(OCR_ZOOM_RAPIDO_SCAN_MULTAS, OCR_ZOOM_SCAN_MULTAS):
+            if es_rapido:
+                prefijo_estado = ocr_escaneo.PREFIJO_ESTADO_OCR_RAPIDO
+            elif candidatos_previos:
+                prefijo_estado = ocr_escaneo.PREFIJO_ESTADO_OCR_ALTA_POR_VALIDACION
+            else:
+                prefijo_estado = ocr_escaneo.PREFIJO_ESTADO_OCR_ALTA
+            img_recortada = ocr_escaneo.renderizar_franja_gris(page_fitz_obj, zoom, *OCR_REGION_OFICIO_SCAN_MULTAS)
+            config_ocr = ocr_escaneo.config_de_pase('--psm 4', OCR_LISTA_BLANCA_SCAN_MULTAS, es_rapido)
+            texto_pagina = ocr_escaneo.imagen_a_texto(img_recortada, lang='spa', config=config_ocr)
+            coincidencias = patron_oficio.findall(texto_pagina)
+            if coincidencias:
+                # El o los oficios encontrados (normalmente será uno)
+                candidatos_previos = list(set(f"DIDCFMT{match}" for match in coincidencias))
+                if hay_valido(candidatos_previos):
+                    return candidatos_previos, f"{prefijo_estado}MULTAS_CANDIDATOS_OK"
+
+        # Ningún pase dio un oficio válido: se devuelve la última lectura para reportarla como no encontrada
+        if candidatos_previos:
+            return candidatos_previos, f"{prefijo_estado}MULTAS_CANDIDATOS_OK"
         if not texto_pagina.strip():
             return [], "OCR_MULTAS_PAGINA_VACIA"
-
-        # El patrón busca "DIDCFMT" seguido de 6 o más dígitos
-        patron_oficio = re.compile(r"D[I1L]DCFMT\s*(\d{6,})", re.IGNORECASE)
-        coincidencias = patron_oficio.findall(texto_pagina)
-
-        if not coincidencias:
-            return [], "OCR_MULTAS_SIN_PATRON"
-
-        # Devolver el o los oficios encontrados (normalmente será uno)
-        candidatos_normalizados = [f"DIDCFMT{match}" for match in coincidencias]
-        return list(set(candidatos_normalizados)), "OCR_MULTAS_CANDIDATOS_OK"
+        return [], "OCR_MULTAS_SIN_PATRON"
 
     except Exception as e_ocr_page:
         print(f"        - (!) Error inesperado en OCR de Multas en página {page_num_debug}: {e_ocr_page}")
@@ -1833,12 +1917,28 @@ def group_and_split_pdf_dynamically_scan_multas(pdf_fuente_path_obj, temp_dir_pa
         total_paginas_pdf_fuente = doc_fitz_pdf_fuente.page_count
         print(f"    - Paso 1 (Multas): Mapeando y validando {total_paginas_pdf_fuente} páginas...")
 
-        for i_pagina in range(total_paginas_pdf_fuente):
+        # El render y OCR de cada página se reparten en procesos; los resultados llegan en orden de página
+        # Las páginas ya analizadas de este mismo PDF con la misma configuración salen de la caché de OCR
+        # El OCR escala al pase de alta resolución cuando lo leído a zoom bajo no está en la BD ni en el CSV
+        oficios_validos = set(oficios_validos_set)
+        if df_csv_principal_preparado is not None and 'OFICIO_NORM_CSV' in df_csv_principal_preparado.columns:
+            oficios_validos.update(df_csv_principal_preparado['OFICIO_NORM_CSV'].dropna().astype(str))
+        oficios_validos = frozenset(oficios_validos)
+        paginas_analizadas = ocr_escaneo.analizar_paginas_pdf(
+            doc_fitz_pdf_fuente, pdf_fuente_path_obj, extract_oficio_from_page_scan_multas,
+            (oficios_validos,), ocr_escaneo.resolver_num_procesos_ocr(config_multas_actual),
+            cache_ocr=ocr_escaneo.obtener_cache_ocr(config_multas_actual),
+            firma_cache=repr((FIRMA_CACHE_OCR_SCAN_MULTAS, ocr_escaneo.firma_identificadores_validos(oficios_validos))),
+        )
+        estados_paginas = []
+        for i_pagina, resultado_pagina, error_pagina in paginas_analizadas:
             num_pagina_para_mostrar = i_pagina + 1
             try:
-                pagina_obj = doc_fitz_pdf_fuente.load_page(i_pagina)
+                if error_pagina:
+                    raise RuntimeError(error_pagina)
                 # La nueva función devuelve una LISTA de candidatos
-                posibles_oficios, metodo_extraccion = extract_oficio_from_page_scan_multas(pagina_obj, num_pagina_para_mostrar)
+                posibles_oficios, metodo_extraccion = resultado_pagina
+                estados_paginas.append(metodo_extraccion)
 
                 if not posibles_oficios:
                     continue
@@ -1895,6 +1995,7 @@ def group_and_split_pdf_dynamically_scan_multas(pdf_fuente_path_obj, temp_dir_pa
                 print(f"        - (!) Error mapeando página de Multas {num_pagina_para_mostrar}: {e_proc_pagina}.")
                 continue
 
+        ocr_escaneo.reportar_escalado_ocr(estados_paginas, "Multas")
         print(f"\n    - Paso 1 (Multas) completo. {len(oficios_y_sus_paginas)} oficios válidos y {len(oficios_no_encontrados_log)} no encontrados.")
         print(f"    - Paso 2 (Multas): Creando PDFs de grupo para oficios válidos...")
 
@@ -2072,6 +2173,11 @@ def crear_reporte_despachos_main(directorio_multas_cliente_str, config_multas_ac
     datos_para_nuevo_excel = []
     contador_filas_excel_salida = 0
 
+    # Índice de oficios normalizados de la base de datos, construido una sola vez para todo el reporte
+    indice_oficios_bd_original = None
+    if COL_BD_MAESTRA_OFICIO in df_base_de_datos_original.columns:
+        indice_oficios_bd_original = construir_indice_oficios_multas(df_base_de_datos_original[COL_BD_MAESTRA_OFICIO])
+
     print("\n  Procesando expedientes notificados para el nuevo reporte:")
     for _, fila_notif in df_notificados.iterrows():
         # --- CAMBIO 5: Se obtienen los datos de las nuevas columnas ---
@@ -2084,7 +2190,8 @@ def crear_reporte_despachos_main(directorio_multas_cliente_str, config_multas_ac
         # Se renombra el primer argumento de la función para mayor claridad.
         lista_placas_montos_oficio = obtener_datos_placas_montos_de_bd_multas(
             expediente_actual, 
-            df_base_de_datos_original 
+            df_base_de_datos_original,
+            indice_oficios_bd_original
         )
 
         if not lista_placas_montos_oficio or \
@@ -2642,15 +2749,21 @@ def generar_documentos_multas_core(
     letra_actual_para_ciclo = letra_lote
     contador_actual_para_ciclo = contador_inicial_lote
 
+    # Índice oficio normalizado -> posiciones de fila en la BD Maestra; se mantiene al actualizar o añadir filas
+    col_id_en_bd_maestra = config_multas_actual["col_expediente"]
+    indice_oficios_bdm = construir_indice_oficios_multas(df_bd_maestra_para_actualizar_logica[col_id_en_bd_maestra])
+
+    # Particionar los registros por oficio una sola vez: oficio normalizado -> posiciones de sus filas
+    # (sort=False y posiciones ascendentes conservan el orden recibido de process_selected_mode_action)
+    posiciones_por_oficio = df_registros_a_procesar.groupby(col_id_normalizado_para_unicos, sort=False).indices
+
     for i, oficio_norm_actual_iteracion in enumerate(oficios_unicos_a_procesar_final):
         
         # --- 1. Obtener y preparar los datos para el oficio actual ---
-        registros_csv_para_este_oficio = df_registros_a_procesar[
-            df_registros_a_procesar[col_id_normalizado_para_unicos] == oficio_norm_actual_iteracion
-        ].copy()
-
-        if registros_csv_para_este_oficio.empty:
+        posiciones_oficio = posiciones_por_oficio.get(oficio_norm_actual_iteracion)
+        if posiciones_oficio is None or len(posiciones_oficio) == 0:
             continue
+        registros_csv_para_este_oficio = df_registros_a_procesar.iloc[posiciones_oficio].copy()
 
         monto_total_oficio = registros_csv_para_este_oficio['IMPORTE_numeric'].sum()
         fila_representativa_csv = registros_csv_para_este_oficio.iloc[0]
@@ -2729,19 +2842,22 @@ def generar_documentos_multas_core(
             }
 
         # --- 3. Lógica Unificada para Actualizar o Añadir en la BD Maestra ---
-        col_id_en_bd_maestra = config_multas_actual["col_expediente"]
-        indices_existentes_en_bdm = df_bd_maestra_para_actualizar_logica.index[
-            df_bd_maestra_para_actualizar_logica[col_id_en_bd_maestra].apply(normalizar_oficio_multas) == oficio_norm_actual_iteracion
-        ].tolist()
+        posiciones_existentes_en_bdm = indice_oficios_bdm.get(oficio_norm_actual_iteracion, [])
 
-        if indices_existentes_en_bdm:
+        if posiciones_existentes_en_bdm:
             # El registro YA EXISTE: Se actualizan los campos, respetando el ID existente.
-            idx_actualizar_bdm = indices_existentes_en_bdm[-1]
+            posicion_actualizar_bdm = posiciones_existentes_en_bdm[-1]
+            idx_actualizar_bdm = df_bd_maestra_para_actualizar_logica.index[posicion_actualizar_bdm]
             id_existente = df_bd_maestra_para_actualizar_logica.loc[idx_actualizar_bdm, 'ID']
             print(f"     -> (Multas Logic) RESPETANDO ID de lote existente '{id_existente}' para Oficio: {oficio_final_formato_barras}")
             for col_nombre, valor_nuevo in datos_para_bd.items():
                 if col_nombre in df_bd_maestra_para_actualizar_logica.columns:
                     df_bd_maestra_para_actualizar_logica.loc[idx_actualizar_bdm, col_nombre] = valor_nuevo
+            if col_id_en_bd_maestra in datos_para_bd:
+                mover_posicion_indice_oficios_multas(
+                    indice_oficios_bdm, posicion_actualizar_bdm,
+                    oficio_norm_actual_iteracion, normalizar_oficio_multas(datos_para_bd[col_id_en_bd_maestra])
+                )
         else:
             # El registro es NUEVO: Se genera un nuevo ID y se añade la fila completa.
             contador_actual_para_ciclo += 1
@@ -2759,7 +2875,12 @@ def generar_documentos_multas_core(
                     datos_para_bd[col_maestra] = pd.NA if tipo_col == 'Int64' else ""
             
             df_nueva_fila = pd.DataFrame([datos_para_bd], columns=config_multas_actual["db_master_columns"])
+            posicion_nueva_fila = len(df_bd_maestra_para_actualizar_logica)
             df_bd_maestra_para_actualizar_logica = pd.concat([df_bd_maestra_para_actualizar_logica, df_nueva_fila], ignore_index=True)
+            mover_posicion_indice_oficios_multas(
+                indice_oficios_bdm, posicion_nueva_fila,
+                None, normalizar_oficio_multas(df_bd_maestra_para_actualizar_logica[col_id_en_bd_maestra].iat[posicion_nueva_fila])
+            )
             
         # --- 4. Re-asegurar tipos de datos al final de CADA iteración ---
         # Esto previene errores de tipos mixtos en el DataFrame para la siguiente iteración.
@@ -2808,6 +2929,7 @@ def run_scan_and_process_multas(df_bd_maestra_global, df_csv_principal_global, c
         pytesseract.get_tesseract_version() # Forzará error si Tesseract no está bien
         if 'fitz' not in sys.modules: # Chequeo simbólico
             print("    - (!) Advertencia: Módulo 'fitz' (PyMuPDF) no detectado en sys.modules.")
+        print(f"    - Motor OCR: {ocr_escaneo.descripcion_motor_ocr()}")
     except (ImportError, NameError, pytesseract.TesseractNotFoundError, AttributeError) as e_dep_ocr_scan:
         print(f"    - (!) ERROR CRÍTICO: Falta dependencia de OCR o Tesseract no está configurado: {e_dep_ocr_scan}")
         print("        El modo Escaneo de Multas no puede continuar.")
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import io
 import re
 import locale
 import pandas as pd
@@ -68,6 +69,7 @@ except ImportError:
     print("¡ERROR FATAL! No se encontraron 'pytesseract' o 'Pillow'. Necesarios para OCR Predial.")
     # Considera cómo manejar esto; podrías lanzar la excepción: raise
     pass
+import ocr_escaneo # Motor de OCR compartido (Tesseract en memoria, con pytesseract como respaldo)
 # --- Imports para Excel y PDF ---
 try:
     import openpyxl
@@ -188,12 +190,165 @@ FIRMA: _______________________                                           FIRMA:_
 
 PROTECTED_PLACEHOLDERS = ["[LOGO]", "[TITULO]"]
 
+# --- Citatorio pre-renderizado ---
+# El expediente (ya con el cero a la izquierda) tiene 8 dígitos; el centinela ocupa el mismo
+# ancho al convertir CITATORIO.docx, así el estampado conserva la maquetación original.
+CITATORIO_CENTINELA = "00000000"
+CITATORIO_DIGITOS = "0123456789"
 
+def preparar_citatorio_base_pdf(config_predial):
+    """
+    Convierte CITATORIO.docx a PDF una sola vez por corrida, con CITATORIO_CENTINELA en lugar
+    de [EXPEDIENTE], y registra las cajas de los caracteres del centinela para estampar cada
+    expediente con PyMuPDF. Los dígitos se toman de una segunda conversión con una línea de
+    referencia añadida al final, de modo que el PDF base conserva todas las páginas de la plantilla.
+    Devuelve None si el estampado no es seguro; entonces se convierte por expediente como antes.
+    """
+    if 'fitz' not in sys.modules or not DOCX2PDF_INSTALLED:
+        return None
+    ruta_plantilla_citatorio = Path(config_predial["base_path"]) / 'CITATORIO.docx'
+    if not ruta_plantilla_citatorio.is_file():
+        return None
+
+    try:
+        doc = Document(ruta_plantilla_citatorio)
+        parrafo_expediente = None
+        for paragraph in doc.paragraphs:
+            if '[EXPEDIENTE]' in paragraph.text:
+                # Mismo reemplazo que _generar_citatorio_pdf_interno, para obtener la misma maquetación
+                paragraph.text = paragraph.text.replace('[EXPEDIENTE]', CITATORIO_CENTINELA)
+                parrafo_expediente = paragraph
+                break
+        if parrafo_expediente is None:
+            print("    (*) Advertencia: CITATORIO.docx no tiene [EXPEDIENTE]; se convertirá por expediente.")
+            return None
+
+        with tempfile.TemporaryDirectory() as temp_dir_base:
+            # 1. El citatorio tal cual (todas sus páginas) es la base sobre la que se estampa
+            pdf_base = _convertir_docx_temporal(doc, Path(temp_dir_base) / "citatorio_base")
+            if pdf_base is None:
+                return None
+
+            # 2. Copia del párrafo al final con todos los dígitos, para que la fuente incrustada
+            #    los incluya; de esta conversión solo se usa la página con la línea de dígitos.
+            elemento_digitos = copy.deepcopy(parrafo_expediente._element)
+            cuerpo = doc.element.body
+            if cuerpo.sectPr is not None:
+                cuerpo.sectPr.addprevious(elemento_digitos)
+            else:
+                cuerpo.append(elemento_digitos)
+            Paragraph(elemento_digitos, parrafo_expediente._parent).text = CITATORIO_DIGITOS
+            pdf_referencia = _convertir_docx_temporal(doc, Path(temp_dir_base) / "citatorio_digitos")
+            if pdf_referencia is None:
+                pdf_base.close()
+                return None
+
+            try:
+                return _registrar_centinela_citatorio(pdf_base, pdf_referencia)
+            finally:
+                pdf_referencia.close()
+                pdf_base.close()
+    except Exception as e:
+        print(f"    (*) Advertencia: No se pudo pre-renderizar el citatorio ({e}); se convertirá por expediente.")
+        return None
+
+def _convertir_docx_temporal(doc, ruta_sin_extension):
+    """Guarda el documento y lo convierte a PDF; devuelve el PDF abierto con fitz o None."""
+    temp_docx_path = ruta_sin_extension.with_suffix(".docx")
+    temp_pdf_path = ruta_sin_extension.with_suffix(".pdf")
+    doc.save(temp_docx_path)
+    convert(str(temp_docx_path), str(temp_pdf_path))
+    if not (temp_pdf_path.exists() and temp_pdf_path.stat().st_size > 0):
+        return None
+    return fitz.open(str(temp_pdf_path))
+
+def _buscar_texto_en_spans(page_fitz_obj, texto_buscado):
+    """Devuelve (span, caracteres) del primer span horizontal de la página que contiene el texto."""
+    for block in page_fitz_obj.get_text("rawdict")["blocks"]:
+        for line in block.get("lines", []):
+            if tuple(round(v, 3) for v in line["dir"]) != (1.0, 0.0):
+                continue
+            for span in line["spans"]:
+                chars = span["chars"]
+                texto_span = "".join(ch["c"] for ch in chars)
+                pos = texto_span.find(texto_buscado)
+                if pos >= 0:
+                    return span, chars[pos:pos + len(texto_buscado)]
+    return None, None
+
+def _buscar_texto_en_documento(pdf_fitz_obj, texto_buscado):
+    """Devuelve (número de página, caracteres) de la primera aparición del texto en el documento."""
+    for numero_pagina in range(pdf_fitz_obj.page_count):
+        _, chars = _buscar_texto_en_spans(pdf_fitz_obj[numero_pagina], texto_buscado)
+        if chars:
+            return numero_pagina, chars
+    return None, None
+
+def _registrar_centinela_citatorio(pdf_base, pdf_referencia):
+    """
+    Localiza el centinela en el citatorio base y la línea de dígitos en la conversión de
+    referencia, y deja el citatorio base listo para estampar. Cada dígito del expediente se
+    copia (vectorial) desde la línea de dígitos sobre la caja del carácter correspondiente
+    del centinela.
+    """
+    pagina_centinela, chars_centinela = _buscar_texto_en_documento(pdf_base, CITATORIO_CENTINELA)
+    if chars_centinela is None:
+        print("    (*) Advertencia: No se localizó el expediente en el citatorio convertido.")
+        return None
+
+    pagina_digitos, chars_digitos = _buscar_texto_en_documento(pdf_referencia, CITATORIO_DIGITOS)
+    if chars_digitos is None:
+        print("    (*) Advertencia: No se localizaron los dígitos de referencia del citatorio.")
+        return None
+
+    # Todos los dígitos deben medir lo mismo que el centinela para no alterar la maquetación
+    anchos = [fitz.Rect(ch["bbox"]).width for ch in chars_centinela + chars_digitos]
+    if max(anchos) - min(anchos) > 0.05:
+        print("    (*) Advertencia: La fuente del citatorio tiene dígitos proporcionales; se convertirá por expediente.")
+        return None
+
+    pdf_digitos = fitz.open()
+    pdf_digitos.insert_pdf(pdf_referencia, from_page=pagina_digitos, to_page=pagina_digitos)
+    digitos_bytes = pdf_digitos.tobytes(garbage=3, deflate=True)
+    pdf_digitos.close()
+
+    # Se borra el centinela encogiendo un poco el rectángulo para no alcanzar los caracteres vecinos
+    page = pdf_base[pagina_centinela]
+    rect = fitz.Rect(chars_centinela[0]["bbox"]) | fitz.Rect(chars_centinela[-1]["bbox"])
+    alto = rect.height
+    page.add_redact_annot(fitz.Rect(rect.x0 + 0.5, rect.y0 + alto * 0.25, rect.x1 - 0.5, rect.y1 - alto * 0.25), fill=False)
+    page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE)
+
+    return {
+        "pdf": pdf_base.tobytes(garbage=3, deflate=True),
+        "pagina_centinela": pagina_centinela,
+        "digitos_pdf": digitos_bytes,
+        "cajas_destino": [tuple(ch["bbox"]) for ch in chars_centinela],
+        "cajas_digitos": {ch["c"]: tuple(ch["bbox"]) for ch in chars_digitos},
+    }
+
+def _estampar_citatorio_pdf(citatorio_base, expediente_str, temp_pdf_path):
+    """Copia los dígitos del expediente sobre una copia del citatorio pre-renderizado."""
+    doc_citatorio = fitz.open("pdf", citatorio_base["pdf"])
+    doc_digitos = fitz.open("pdf", citatorio_base["digitos_pdf"])
+    try:
+        page = doc_citatorio[citatorio_base["pagina_centinela"]]
+        for caja_destino, caracter in zip(citatorio_base["cajas_destino"], expediente_str):
+            page.show_pdf_page(
+                fitz.Rect(caja_destino), doc_digitos, 0,
+                clip=fitz.Rect(citatorio_base["cajas_digitos"][caracter])
+            )
+        doc_citatorio.save(str(temp_pdf_path), garbage=3, deflate=True)
+    finally:
+        doc_digitos.close()
+        doc_citatorio.close()
 
 # --- Funciones de utilidad (sin cambios) ---
-def _generar_citatorio_pdf_interno(expediente, config_predial, temp_dir):
+def _generar_citatorio_pdf_interno(expediente, config_predial, temp_dir, citatorio_base=None):
     """
     Función interna para generar el PDF del citatorio para un expediente específico.
+    Si se pasa citatorio_base (ver preparar_citatorio_base_pdf) se estampa el expediente sobre
+    el PDF pre-renderizado; si no, se convierte CITATORIO.docx completo.
     Devuelve la ruta (Path object) al PDF temporal del citatorio o None si falla.
     """
     try:
@@ -201,6 +356,21 @@ def _generar_citatorio_pdf_interno(expediente, config_predial, temp_dir):
         if len(expediente_str) == 7:
             expediente_str = '0' + expediente_str
 
+        if (citatorio_base is not None and len(expediente_str) == len(CITATORIO_CENTINELA)
+                and all(c in CITATORIO_DIGITOS for c in expediente_str)):
+            temp_pdf_path = temp_dir / f"citatorio_{expediente}.pdf"
+            try:
+                _estampar_citatorio_pdf(citatorio_base, expediente_str, temp_pdf_path)
+            except Exception as e_estampar:
+                print(f"      - (*) Error al estampar el citatorio para {expediente}: {e_estampar}")
+                # Un guardado a medias no debe pasar por un citatorio válido
+                try: temp_pdf_path.unlink()
+                except FileNotFoundError: pass
+            if temp_pdf_path.exists() and temp_pdf_path.stat().st_size > 0:
+                print(f"      - PDF de citatorio estampado para {expediente}.")
+                return temp_pdf_path
+            print(f"      - (*) Fallo al estampar el citatorio para {expediente}; se convierte completo.")
+
         # Construir la ruta a la plantilla del citatorio desde la configuración del modo
         ruta_plantilla_citatorio = Path(config_predial["base_path"]) / 'CITATORIO.docx'
         
@@ -358,15 +528,28 @@ def group_and_split_pdf_dynamically_scan_predial(pdf_fuente_path_obj, temp_dir_p
     col_exp_bd = config_predial_actual["col_expediente"]
     expedientes_validos_bd_set = set(df_bd_maestra_para_verificar[col_exp_bd].astype(str).str.strip().str.lstrip('0'))
     expedientes_validos_csv_set = set(df_csv_principal_predial[col_exp_bd].astype(str).str.strip().str.lstrip('0'))
+    # El OCR escala al pase de alta resolución cuando lo leído a zoom bajo no está en ninguno de los dos
+    expedientes_validos = frozenset(expedientes_validos_bd_set | expedientes_validos_csv_set)
 
     try:
         expedientes_y_sus_paginas = {}
         doc_fitz = fitz.open(str(pdf_fuente_path_obj))
 
-        for i_pagina in range(doc_fitz.page_count):
-            pagina_obj = doc_fitz.load_page(i_pagina)
+        # El render y OCR de cada página se reparten en procesos; los resultados llegan en orden de página
+        # Las páginas ya analizadas de este mismo PDF con la misma configuración salen de la caché de OCR
+        paginas_analizadas = ocr_escaneo.analizar_paginas_pdf(
+            doc_fitz, pdf_fuente_path_obj, extract_expediente_from_page_scan_predial,
+            (config_predial_actual, expedientes_validos), ocr_escaneo.resolver_num_procesos_ocr(config_predial_actual),
+            cache_ocr=ocr_escaneo.obtener_cache_ocr(config_predial_actual),
+            firma_cache=firma_cache_ocr_scan_predial(config_predial_actual, expedientes_validos),
+        )
+        estados_paginas = []
+        for i_pagina, resultado_pagina, error_pagina in paginas_analizadas:
+            if error_pagina:
+                print(f"    - (!) Error analizando página {i_pagina + 1}: {error_pagina}")
             # Extraemos los posibles expedientes de la página (sin cambios)
-            posibles_exp, _ = extract_expediente_from_page_scan_predial(pagina_obj, i_pagina + 1, config_predial_actual)
+            posibles_exp, estado_pagina = resultado_pagina if resultado_pagina else ([], None)
+            estados_paginas.append(estado_pagina)
 
             expediente_encontrado_y_validado = None
 
@@ -392,7 +575,14 @@ def group_and_split_pdf_dynamically_scan_predial(pdf_fuente_path_obj, temp_dir_p
                 # CASO 2: NO encontramos un número de expediente válido en la página.
                 # Ahora verificamos si es una página de continuación o si está en blanco.
                 # Para ser de continuación, la página NO debe estar en blanco Y ya debemos tener un expediente anterior.
-                if not is_page_blank_scan_predial(pagina_obj) and ultimo_expediente_valido:
+                # Si el análisis ya llegó a OCR sin encontrar nada, la página no estaba en blanco. Las que
+                # se saltaron el OCR por el raster se revisan aquí con el criterio de siempre (una página
+                # con imagen se conserva), para no descartar hojas con contenido muy claro.
+                if estado_pagina == "OCR_NO_ENCONTRADO":
+                    pagina_en_blanco = False
+                else:
+                    pagina_en_blanco = is_page_blank_scan_predial(doc_fitz.load_page(i_pagina))
+                if ultimo_expediente_valido and not pagina_en_blanco:
                     # ¡Es una hoja de continuación! La asignamos al último expediente válido.
                     print(f"    - Página {i_pagina + 1} sin expediente, pero con contenido. Asignada a Exp. {ultimo_expediente_valido}.")
                     expedientes_y_sus_paginas[ultimo_expediente_valido]["paginas"].append(i_pagina)
@@ -400,6 +590,7 @@ def group_and_split_pdf_dynamically_scan_predial(pdf_fuente_path_obj, temp_dir_p
                 # simplemente la ignoramos y no hacemos nada.
             # --- FIN DE LA MODIFICACIÓN ---
 
+        ocr_escaneo.reportar_escalado_ocr(estados_paginas, "Predial")
         print("    - Ordenando expedientes encontrados por orden de aparición en el PDF...")
         # El resto de la función para ordenar y crear los archivos PDF no necesita cambios.
         expedientes_ordenados = sorted(
@@ -1189,6 +1380,7 @@ def run_scan_and_process_predial(df_bd_maestra_global, df_csv_principal_global,
         pytesseract.get_tesseract_version() # Lanza error si Tesseract no está o no se encuentra
         # fitz y PIL se verifican en los imports iniciales, pero una verificación aquí no está de más.
         if 'fitz' not in sys.modules: raise ImportError("PyMuPDF (fitz) no está disponible.")
+        print(f"    - Motor OCR: {ocr_escaneo.descripcion_motor_ocr()}")
     except Exception as e_dep_ocr_scan_predial:
         print(f"    - (!) ERROR CRÍTICO (Scan Predial): Falta una dependencia de OCR o Tesseract no está configurado: {e_dep_ocr_scan_predial}")
         print("        El modo Escaneo de Predial no puede continuar. Verifique las instalaciones.")
@@ -1328,52 +1520,113 @@ def run_scan_and_process_predial(df_bd_maestra_global, df_csv_principal_global,
     print("\n--- Modo Escaneo de Documentos de PREDIAL Finalizado ---")
     return df_bd_maestra_modificada_total_scan_predial
 
-def extract_expediente_from_page_scan_predial(page_fitz_obj, page_num_debug, config_predial_actual):
+# Modo que va en el código de ID impreso en los documentos de Predial ("GOBID|PREDIAL|<expediente>")
+CODIGO_ID_MODO_PREDIAL = "PREDIAL"
+# Franjas de la página donde se busca el expediente (fracciones de la altura)
+OCR_REGION_SUPERIOR_SCAN_PREDIAL = (0.0, 0.35) # 35% superior
+OCR_REGION_INFERIOR_SCAN_PREDIAL = (0.80, 1.0) # 20% inferior
+# Pase rápido del OCR adaptativo (zoom bajo, se puede cambiar con "ocr_zoom_rapido_predial") y
+# caracteres que puede tener cada franja: "Expediente Catastral:"/"EXP" arriba, "EXP." abajo
+OCR_ZOOM_RAPIDO_SCAN_PREDIAL = 1.5
+OCR_LISTA_BLANCA_SUPERIOR_SCAN_PREDIAL = "ExpedintCaslrXPEXPEDINTCASLR:0123456789"
+OCR_LISTA_BLANCA_INFERIOR_SCAN_PREDIAL = "EXPexp.0123456789"
+
+def firma_cache_ocr_scan_predial(config_predial_actual, expedientes_validos=None):
+    """Configuración que determina el resultado de extract_expediente_from_page_scan_predial (clave de la caché de OCR)."""
+    return repr((
+        OCR_REGION_SUPERIOR_SCAN_PREDIAL, OCR_REGION_INFERIOR_SCAN_PREDIAL,
+        float(config_predial_actual.get("ocr_zoom_factor_predial", 2.5)),
+        float(config_predial_actual.get("ocr_zoom_rapido_predial", OCR_ZOOM_RAPIDO_SCAN_PREDIAL)),
+        OCR_LISTA_BLANCA_SUPERIOR_SCAN_PREDIAL, OCR_LISTA_BLANCA_INFERIOR_SCAN_PREDIAL,
+        EXPEDIENTE_REGEX_SCAN_PREDIAL_NODOT.pattern, EXPEDIENTE_REGEX_SCAN_PREDIAL_DOT.pattern,
+        ocr_escaneo.firma_identificadores_validos(expedientes_validos),
+    ))
+
+def extract_expediente_from_page_scan_predial(page_fitz_obj, page_num_debug, config_predial_actual, expedientes_validos=None):
     """
     Extrae expedientes de la parte SUPERIOR e INFERIOR, los normaliza
     (quitando ceros iniciales) y los compara para validación.
+    Si la página trae el código de ID impreso se usa ese. Si no, en cada franja se usa la capa de
+    texto del PDF si la tiene y OCR si no: primero a zoom bajo y, para cada franja sin expediente o
+    cuyo expediente no está en 'expedientes_validos' (BD y CSV, sin ceros iniciales), a la
+    resolución configurada.
     """
     exp_top_norm = None
     exp_bottom_norm = None
 
+    def es_valido(match):
+        return bool(match) and (expedientes_validos is None or match.group(1).lstrip('0') in expedientes_validos)
+
     try:
         zoom = float(config_predial_actual.get("ocr_zoom_factor_predial", 2.5))
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page_fitz_obj.get_pixmap(colorspace=fitz.csGRAY, matrix=mat, alpha=False)
-        img = Image.frombytes("L", [pix.width, pix.height], pix.samples)
-        img_width, img_height = img.size
-
-        # --- Búsqueda en la parte SUPERIOR ---
-        top_crop_end_y = int(img_height * 0.35) # Buscar en el 35% superior
-        area_top = (0, 0, img_width, top_crop_end_y)
-        texto_top = pytesseract.image_to_string(img.crop(area_top), lang='spa', config="--psm 4")
-        
-        match_top = EXPEDIENTE_REGEX_SCAN_PREDIAL_NODOT.search(texto_top)
+        zoom_rapido = float(config_predial_actual.get("ocr_zoom_rapido_predial", OCR_ZOOM_RAPIDO_SCAN_PREDIAL))
+
+        # Si el documento lleva impreso el código de ID, el expediente sale de ahí sin OCR (también
+        # en las hojas de continuación, que así no dependen del último expediente visto)
+        expedientes_codigo = ocr_escaneo.leer_codigo_id(page_fitz_obj, CODIGO_ID_MODO_PREDIAL)
+        if expedientes_codigo:
+            return list(dict.fromkeys(exp.lstrip('0') for exp in expedientes_codigo)), "CODIGO_OK"
+
+        # Primero la capa de texto del PDF en las mismas franjas; OCR solo para lo que ahí no esté
+        match_top = EXPEDIENTE_REGEX_SCAN_PREDIAL_NODOT.search(ocr_escaneo.texto_de_franja(page_fitz_obj, *OCR_REGION_SUPERIOR_SCAN_PREDIAL))
+        match_bottom = EXPEDIENTE_REGEX_SCAN_PREDIAL_DOT.search(ocr_escaneo.texto_de_franja(page_fitz_obj, *OCR_REGION_INFERIOR_SCAN_PREDIAL))
+        # Los estados llevan "TEXTO_" cuando todo salió de la capa de texto, "OCR_RAPIDO_" si bastó el
+        # pase de zoom bajo y "OCR_" (u "OCR_REVALIDADO_" si lo leído no era válido) si hizo falta el de alta resolución
+        prefijo_estado = "TEXTO_"
+
+        # Una página en blanco no se pasa por OCR (el raster solo decide esto, no si la hoja se descarta)
+        if not (match_top or match_bottom) and (
+            is_page_blank_scan_predial(page_fitz_obj) or ocr_escaneo.pagina_en_blanco_por_raster(page_fitz_obj)
+        ):
+            return [], ocr_escaneo.ESTADO_PAGINA_EN_BLANCO
+
+        # Cada franja se sigue leyendo, pase tras pase, hasta tener un expediente válido; así la
+        # comparación superior/inferior nunca depende solo de la lectura a zoom bajo
+        top_resuelto = es_valido(match_top)
+        bottom_resuelto = es_valido(match_bottom)
+        for zoom_pase, es_rapido in ocr_escaneo.pases_ocr(zoom_rapido, zoom):
+            if top_resuelto and bottom_resuelto:
+                break
+            if es_rapido:
+                prefijo_estado = ocr_escaneo.PREFIJO_ESTADO_OCR_RAPIDO
+            elif (match_top and not top_resuelto) or (match_bottom and not bottom_resuelto):
+                prefijo_estado = ocr_escaneo.PREFIJO_ESTADO_OCR_ALTA_POR_VALIDACION
+            else:
+                prefijo_estado = ocr_escaneo.PREFIJO_ESTADO_OCR_ALTA
+            # --- Búsqueda en la parte SUPERIOR ---
+            # Solo se rasteriza la franja a leer, directamente en escala de grises. Si el pase no
+            # encuentra nada se conserva la lectura anterior.
+            if not top_resuelto:
+                img_top = ocr_escaneo.renderizar_franja_gris(page_fitz_obj, zoom_pase, *OCR_REGION_SUPERIOR_SCAN_PREDIAL)
+                config_top = ocr_escaneo.config_de_pase("--psm 4", OCR_LISTA_BLANCA_SUPERIOR_SCAN_PREDIAL, es_rapido)
+                match_top = EXPEDIENTE_REGEX_SCAN_PREDIAL_NODOT.search(ocr_escaneo.imagen_a_texto(img_top, lang='spa', config=config_top)) or match_top
+                top_resuelto = es_valido(match_top)
+            # --- Búsqueda en la parte INFERIOR ---
+            if not bottom_resuelto:
+                img_bottom = ocr_escaneo.renderizar_franja_gris(page_fitz_obj, zoom_pase, *OCR_REGION_INFERIOR_SCAN_PREDIAL)
+                config_bottom = ocr_escaneo.config_de_pase("--psm 6", OCR_LISTA_BLANCA_INFERIOR_SCAN_PREDIAL, es_rapido)
+                match_bottom = EXPEDIENTE_REGEX_SCAN_PREDIAL_DOT.search(ocr_escaneo.imagen_a_texto(img_bottom, lang='spa', config=config_bottom)) or match_bottom
+                bottom_resuelto = es_valido(match_bottom)
+
         if match_top:
             # Normalización: quitar ceros a la izquierda
             exp_top_norm = match_top.group(1).lstrip('0')
 
-        # --- Búsqueda en la parte INFERIOR ---
-        bottom_crop_start_y = int(img_height * 0.80) # Buscar en el 20% inferior
-        area_bottom = (0, bottom_crop_start_y, img_width, img_height)
-        texto_bottom = pytesseract.image_to_string(img.crop(area_bottom), lang='spa', config="--psm 6")
-        
-        match_bottom = EXPEDIENTE_REGEX_SCAN_PREDIAL_DOT.search(texto_bottom)
         if match_bottom:
             # Normalización: quitar ceros a la izquierda
             exp_bottom_norm = match_bottom.group(1).lstrip('0')
-        
+
         # --- Lógica de Decisión ---
         if exp_top_norm and exp_bottom_norm:
             if exp_top_norm == exp_bottom_norm:
-                return [exp_top_norm], "OCR_MATCH"
+                return [exp_top_norm], f"{prefijo_estado}MATCH"
             else:
                 # Si hay discrepancia, devuelve ambos para que la siguiente función decida
-                return [exp_top_norm, exp_bottom_norm], "OCR_DISCREPANCIA"
+                return [exp_top_norm, exp_bottom_norm], f"{prefijo_estado}DISCREPANCIA"
         elif exp_top_norm:
-            return [exp_top_norm], "OCR_SOLO_TOP"
+            return [exp_top_norm], f"{prefijo_estado}SOLO_TOP"
         elif exp_bottom_norm:
-            return [exp_bottom_norm], "OCR_SOLO_BOTTOM"
+            return [exp_bottom_norm], f"{prefijo_estado}SOLO_BOTTOM"
         else:
             return [], "OCR_NO_ENCONTRADO"
 
@@ -1569,6 +1822,102 @@ def formatear_valor_v6(valor, nombre_columna, tipos_columnas):
     return locale.format_string("%.2f", numero, grouping=True)
 
 # --- Nueva Función Core para ser llamada por generador_maestro.py ---
+class RegistrosBDMaestraPredial:
+    """
+    Registros de la BD Maestra en memoria durante una generación de Predial.
+
+    Las búsquedas por expediente son un acceso a diccionario; los cambios sobre filas existentes
+    y las filas nuevas se acumulan y se vuelcan a un DataFrame tipado una sola vez (a_dataframe).
+    Como con el filtro anterior, si un expediente aparece varias veces se usa su última fila.
+    """
+
+    def __init__(self, df_base, col_expediente, columnas_maestras, tipos_maestros):
+        self._df_base = df_base
+        self._col_expediente = col_expediente
+        self._columnas_maestras = list(columnas_maestras)
+        self._tipos_maestros = tipos_maestros
+        self._posiciones = {} # expediente (str) -> posición de fila (base o nueva)
+        for posicion, valor in enumerate(df_base[col_expediente].astype(str).tolist()):
+            self._posiciones[valor] = posicion
+        self._cambios = {} # posición en df_base -> {columna: valor}
+        self._nuevos = [] # registros nuevos, en orden de alta
+
+    def buscar(self, expediente):
+        """Devuelve la posición del registro del expediente, o None si no existe."""
+        return self._posiciones.get(str(expediente))
+
+    def valor(self, posicion, columna):
+        total_base = len(self._df_base)
+        if posicion >= total_base:
+            return self._nuevos[posicion - total_base].get(columna, pd.NA)
+        cambios = self._cambios.get(posicion)
+        if cambios and columna in cambios:
+            return cambios[columna]
+        return self._df_base[columna].iat[posicion]
+
+    def actualizar(self, posicion, datos):
+        """Actualiza las columnas existentes del registro con los valores de `datos`."""
+        total_base = len(self._df_base)
+        if posicion >= total_base:
+            columnas_validas = set(self._columnas_maestras) | set(self._df_base.columns)
+            self._nuevos[posicion - total_base].update({k: v for k, v in datos.items() if k in columnas_validas})
+        else:
+            self._cambios.setdefault(posicion, {}).update({k: v for k, v in datos.items() if k in self._df_base.columns})
+        if self._col_expediente in datos:
+            self._registrar_posicion(str(datos[self._col_expediente]), posicion)
+
+    def agregar(self, datos):
+        """Añade un registro nuevo (con todas las columnas maestras) y devuelve su posición."""
+        posicion = len(self._df_base) + len(self._nuevos)
+        self._nuevos.append(dict(datos))
+        self._registrar_posicion(str(datos.get(self._col_expediente, "")), posicion)
+        return posicion
+
+    def _registrar_posicion(self, expediente, posicion):
+        if self._posiciones.get(expediente, -1) < posicion:
+            self._posiciones[expediente] = posicion
+
+    def a_dataframe(self):
+        """Vuelca los cambios y los registros nuevos a un DataFrame con los tipos de la BD Maestra."""
+        df_resultado = self._df_base.copy()
+        if not self._cambios and not self._nuevos:
+            return df_resultado
+
+        # Cambios sobre filas existentes: una asignación por columna
+        cambios_por_columna = {}
+        for posicion, cambios in self._cambios.items():
+            for columna, valor in cambios.items():
+                cambios_por_columna.setdefault(columna, []).append((posicion, valor))
+        for columna, cambios in cambios_por_columna.items():
+            valores = df_resultado[columna].astype(object).to_numpy(copy=True)
+            for posicion, valor in cambios:
+                valores[posicion] = valor
+            df_resultado[columna] = valores
+
+        if self._nuevos:
+            df_nuevos = pd.DataFrame(self._nuevos, columns=self._columnas_maestras)
+            df_resultado = pd.concat([df_resultado, df_nuevos], ignore_index=True)
+
+        try:
+            tipos_a_aplicar = {k: v for k, v in self._tipos_maestros.items() if k in df_resultado.columns}
+            df_resultado = df_resultado.astype(tipos_a_aplicar)
+        except Exception as e_astype:
+            print(f"    (*) Advertencia: Fallo al aplicar tipos a la BD Maestra. Error: {e_astype}")
+        return df_resultado
+
+def construir_variante_plantilla_predial(plantilla_path, anos_inactivos, periodo_año, periodo_bimestre, parrafo_millar):
+    """
+    Carga la plantilla y aplica la poda estructural que solo depende de los años inactivos y
+    del periodo, más el párrafo de millar. Devuelve el DOCX serializado en memoria.
+    Las filas de áreas vacías dependen de los valores de cada expediente y no se podan aquí.
+    """
+    doc_variante = Document(plantilla_path)
+    eliminar_elementos_inactivos_v_usuario(doc_variante, list(anos_inactivos), periodo_año, periodo_bimestre, [], procesar_areas=False)
+    reemplazar_parrafo_con_negritas(doc_variante, "[PARRAFO_MILLAR]", parrafo_millar, "“INMUEBLE”")
+    buffer_variante = io.BytesIO()
+    doc_variante.save(buffer_variante)
+    return buffer_variante.getvalue()
+
 def generar_documentos_predial_core(
     df_datos_para_procesar,
     pm_set_actual,
@@ -1659,7 +2008,6 @@ def generar_documentos_predial_core(
         return df_bd_maestra_actualizada
 
     generados_count_logica = 0
-    df_bd_maestra_para_iteracion = df_bd_maestra_actualizada.copy() # Trabajar sobre una copia
 
     # Rutas de salida específicas del modo
     carpeta_colonias_out_modo = carpeta_principal_salida / "COLONIAS"
@@ -1673,11 +2021,23 @@ def generar_documentos_predial_core(
     periodo_col_datos = "PERIODO" # Asumir
 
     generados_count_logica = 0
-    df_bd_maestra_para_iteracion = df_bd_maestra_actualizada.copy()
+    # Los cambios a la BD Maestra se acumulan en memoria y se vuelcan a un DataFrame al final
+    registros_bd_maestra = RegistrosBDMaestraPredial(
+        df_bd_maestra_actualizada, col_expediente_bd,
+        config_predial_actual["db_master_columns"], config_predial_actual["db_master_types"]
+    )
 
     letra_actual_para_ciclo = letra_lote
     contador_actual_para_ciclo = contador_inicial_lote
 
+    # Variantes de plantilla ya podadas, por (años inactivos, periodo, párrafo de millar)
+    variantes_plantilla_cache = {}
+
+    # El citatorio se convierte una sola vez; por expediente solo se estampa el número
+    citatorio_base_pdf = preparar_citatorio_base_pdf(config_predial_actual)
+    if citatorio_base_pdf is not None:
+        print("  (Predial Logic Core) Citatorio pre-renderizado; el expediente se estampará sobre el PDF.")
+
     for index, row in df_datos_listos_para_bucle.iterrows():
         if max_docs_a_generar > 0 and generados_count_logica >= max_docs_a_generar:
             print(f"  (Predial Logic Core) Límite de {max_docs_a_generar} documentos alcanzado. Deteniendo procesamiento de este lote.")
@@ -1764,8 +2124,6 @@ def generar_documentos_predial_core(
                  else: fecha_texto_str_calc = "(num2words no instalado)"
             ano_placeholder_calc = str(min(anos_activos)) if anos_activos else str(now.year)
 
-            
-            doc = Document(plantilla_path)
 
             periodo_str_calc = str(row.get(periodo_col_datos, "")).strip()
             periodo_año_calc = 0; periodo_bim_calc = 0
@@ -1776,6 +2134,74 @@ def generar_documentos_predial_core(
                      bimestre_final_para_bd = f"{periodo_bim_calc}-{periodo_año_calc}"
                  except: bimestre_final_para_bd = ""
             else: bimestre_final_para_bd = ""
+
+            # --- INICIO DE LA NUEVA LÓGICA PARA [PARRAFO_MILLAR] Y [MILLAR_TEXTO] ---
+            print("      Determinando párrafo y texto de millar...")
+            
+            # Obtener el nombre real de la columna 'MILLAR' desde la configuración
+            millar_col_name = "MILLAR" # Nombre que pusimos en config_columnas.xlsx
+            parrafo_final_millar = "Párrafo por defecto o error: El valor de millar no fue reconocido."
+            millar_texto_final = "X-X" # Valor por defecto
+
+            if millar_col_name in row.index:
+                # Usar safe_float para convertir el valor de forma segura
+                millar_valor = safe_float(row.get(millar_col_name, 0.0), 0.0)
+
+                if math.isclose(millar_valor, 0.002):
+                    millar_texto_final = "2-DOS"
+                    parrafo_final_millar = (
+                        "De conformidad con el artículo 21 bis-8 primer párrafo de la Ley de Hacienda para los Municipios del Estado de Nuevo León, "
+                        "el valor catastral del “INMUEBLE” de cada año descrito, se le aplica la tasa del 2-dos al millar, es decir, "
+                        "se multiplica dicho valor catastral por .002, por lo que, tratándose de predios con uso de casa habitación, como en el presente caso, "
+                        "conforme a lo establecido en el segundo párrafo del artículo ya mencionado, se multiplica el valor catastral mencionado por un factor de .002, "
+                        "de lo que resulta el Impuesto Predial adeudado, el cual queda de la siguiente manera:"
+                    )
+                elif math.isclose(millar_valor, 0.003):
+                    millar_texto_final = "3-TRES"
+                    parrafo_final_millar = (
+                        "De conformidad con el artículo 21 bis-8 primer párrafo de la Ley de Hacienda para los Municipios del Estado de Nuevo León, "
+                        "el valor catastral del “INMUEBLE” de cada año descrito, se le aplica la tasa del 2-dos al millar, es decir, "
+                        "se multiplica dicho valor catastral por .002 y, en el caso de predios con cualquier uso distinto al de casa habitación, "
+                        "como en el presente caso, dado que se trata de un predio con una edificación comercial, se pagará el impuesto predial adicionando 1-uno al millar a la tasa mencionada, "
+                        "conforme a lo establecido en el tercer párrafo del artículo ya mencionado, por lo que una vez adicionada la tasa de 2-dos al millar más 1-uno al millar, "
+                        "da como resultado por un factor de .003, de lo que resulta en el Impuesto Predial adeudado, el cual queda de la siguiente manera:"
+                    )
+                elif math.isclose(millar_valor, 0.004):
+                    millar_texto_final = "4-CUATRO"
+                    parrafo_final_millar = (
+                        "De conformidad con el artículo 21 bis-8 primer párrafo de la Ley de Hacienda para los Municipios del Estado de Nuevo León, "
+                        "el valor catastral del “INMUEBLE” de cada año descrito, se le aplica la tasa del 2-dos al millar, es decir, "
+                        "se multiplica dicho valor catastral por .002 y en el caso de predios con cualquier uso distinto al de casa habitación, "
+                        "como en el presente caso, dado que se trata de un predio baldío, se pagará el impuesto predial adicionando 2-dos al millar a la tasa mencionada, "
+                        "conforme a lo establecido en el segundo párrafo del artículo ya mencionado, por lo que una vez adicionada la tasa de 2-dos al millar más 2-dos al millar, "
+                        "da como resultado una tasa del 4-cautro al millar, es decir, se multiplica el valor catastral mencionado por un factor de .004, "
+                        "de lo que resulta el Impuesto Predial adeudado, el cual queda de la siguiente manera:"
+                    )
+                else:
+                    # Este es el párrafo original que me diste, lo usaré como fallback
+                    millar_texto_final = f"({millar_valor:.3f})-ERROR"
+                    parrafo_final_millar = (
+                         "De conformidad con el artículo 21 bis-8 primer párrafo de la Ley de Hacienda para los Municipios del Estado de Nuevo León, el valor catastral del “INMUEBLE” de cada año descrito, "
+                         "se le aplica la tasa del 2-dos al millar, es decir, se multiplica dicho valor catastral por .002  y, en el caso de predios con cualquier uso distinto al de casa habitacion, "
+                         "como en el presente caso, dado que se trata de un predio con una edificacion comercial, se pagara el impuesto predial adicionando 1-uno al millar a la tasa mencionada, "
+                         "conforme a lo establecido en el tercer parrafo del articulo ya mencionado, por lo que una vez adicionada la tasa de 2-dos al millar mas 1- al millar, da como resultado una tasa del 3-tres al millar, "
+                         "es decir se multiplica el valor catastral mencionado por un factor de .003, de lo que resulta en el Impuesto Predial Adeudado, el cual queda de la siguiente manera:"
+                    )
+                    print(f"      (*) Advertencia: Valor de Millar '{millar_valor}' no reconocido para Exp {expediente_actual}. Usando párrafo por defecto.")
+
+            # --- FIN DE LA NUEVA LÓGICA ---
+
+            # La poda por años/periodo y el párrafo de millar no dependen de los montos del
+            # expediente: se construyen una vez por variante y cada expediente parte de una copia.
+            clave_variante = (tuple(anos_inactivos), periodo_año_calc, periodo_bim_calc, parrafo_final_millar)
+            if clave_variante not in variantes_plantilla_cache:
+                print(f"      Construyendo variante de plantilla (inactivos={anos_inactivos}, periodo={periodo_bim_calc}-{periodo_año_calc})...")
+                variantes_plantilla_cache[clave_variante] = construir_variante_plantilla_predial(
+                    plantilla_path, anos_inactivos, periodo_año_calc, periodo_bim_calc, parrafo_final_millar
+                )
+            doc = Document(io.BytesIO(variantes_plantilla_cache[clave_variante]))
+            # Párrafos con placeholders: se indexan una vez y las fases de reemplazo solo visitan estos
+            parrafos_con_placeholders = indexar_parrafos_con_placeholders(doc)
             
             initial_replacements_calc = {} # Asegúrate que se inicializa antes del bucle
             placeholders_sumas_total_calc = [
@@ -1861,10 +2287,10 @@ def generar_documentos_predial_core(
                         # print(f"DEBUG: {monto_act_ph} no encontrado o None. Forzando {sancion_ph} = {valor_cero_formateado_para_sancion}") # Descomenta para depurar
 
             # Ahora sí, se llama a la función de reemplazo inicial con initial_replacements_calc ya modificado
-            reemplazar_en_documento_v2(doc, initial_replacements_calc, fase="inicial") # Usa la de Predial_logica
+            parrafos_con_placeholders = reemplazar_en_parrafos_indexados(parrafos_con_placeholders, initial_replacements_calc, fase="inicial")
             
-            tablas_protegidas_calc = []
-            eliminar_elementos_inactivos_v_usuario(doc, anos_inactivos, periodo_año_calc, periodo_bim_calc, tablas_protegidas_calc) # Usa la de Predial_logica
+            # La variante ya trae la poda por años; aquí solo quedan las filas de áreas, que dependen de los valores
+            eliminar_filas_areas_vacias_documento(doc)
             procesar_tablas_suelo_construccion(doc, anos_activos) # Usa la de Predial_logica
 
             # --- Cálculos de sumas (estos ya estaban bien por tus cambios anteriores) ---
@@ -1943,77 +2369,12 @@ def generar_documentos_predial_core(
             # EL BLOQUE DE FORZAR SANCIONES YA NO VA AQUÍ, SE MOVIÓ ARRIBA
             # ANTES DE LA PRIMERA LLAMADA A reemplazar_en_documento_v2
 
-            reemplazar_en_documento_v2(doc, final_replacements_calc, fase="final")
-
-            # --- INICIO DE LA NUEVA LÓGICA PARA [PARRAFO_MILLAR] Y [MILLAR_TEXTO] ---
-            print("      Determinando párrafo y texto de millar...")
-            
-            # Obtener el nombre real de la columna 'MILLAR' desde la configuración
-            millar_col_name = "MILLAR" # Nombre que pusimos en config_columnas.xlsx
-            parrafo_final_millar = "Párrafo por defecto o error: El valor de millar no fue reconocido."
-            millar_texto_final = "X-X" # Valor por defecto
-
-            if millar_col_name in row.index:
-                # Usar safe_float para convertir el valor de forma segura
-                millar_valor = safe_float(row.get(millar_col_name, 0.0), 0.0)
-
-                if math.isclose(millar_valor, 0.002):
-                    millar_texto_final = "2-DOS"
-                    parrafo_final_millar = (
-                        "De conformidad con el artículo 21 bis-8 primer párrafo de la Ley de Hacienda para los Municipios del Estado de Nuevo León, "
-                        "el valor catastral del “INMUEBLE” de cada año descrito, se le aplica la tasa del 2-dos al millar, es decir, "
-                        "se multiplica dicho valor catastral por .002, por lo que, tratándose de predios con uso de casa habitación, como en el presente caso, "
-                        "conforme a lo establecido en el segundo párrafo del artículo ya mencionado, se multiplica el valor catastral mencionado por un factor de .002, "
-                        "de lo que resulta el Impuesto Predial adeudado, el cual queda de la siguiente manera:"
-                    )
-                elif math.isclose(millar_valor, 0.003):
-                    millar_texto_final = "3-TRES"
-                    parrafo_final_millar = (
-                        "De conformidad con el artículo 21 bis-8 primer párrafo de la Ley de Hacienda para los Municipios del Estado de Nuevo León, "
-                        "el valor catastral del “INMUEBLE” de cada año descrito, se le aplica la tasa del 2-dos al millar, es decir, "
-                        "se multiplica dicho valor catastral por .002 y, en el caso de predios con cualquier uso distinto al de casa habitación, "
-                        "como en el presente caso, dado que se trata de un predio con una edificación comercial, se pagará el impuesto predial adicionando 1-uno al millar a la tasa mencionada, "
-                        "conforme a lo establecido en el tercer párrafo del artículo ya mencionado, por lo que una vez adicionada la tasa de 2-dos al millar más 1-uno al millar, "
-                        "da como resultado por un factor de .003, de lo que resulta en el Impuesto Predial adeudado, el cual queda de la siguiente manera:"
-                    )
-                elif math.isclose(millar_valor, 0.004):
-                    millar_texto_final = "4-CUATRO"
-                    parrafo_final_millar = (
-                        "De conformidad con el artículo 21 bis-8 primer párrafo de la Ley de Hacienda para los Municipios del Estado de Nuevo León, "
-                        "el valor catastral del “INMUEBLE” de cada año descrito, se le aplica la tasa del 2-dos al millar, es decir, "
-                        "se multiplica dicho valor catastral por .002 y en el caso de predios con cualquier uso distinto al de casa habitación, "
-                        "como en el presente caso, dado que se trata de un predio baldío, se pagará el impuesto predial adicionando 2-dos al millar a la tasa mencionada, "
-                        "conforme a lo establecido en el segundo párrafo del artículo ya mencionado, por lo que una vez adicionada la tasa de 2-dos al millar más 2-dos al millar, "
-                        "da como resultado una tasa del 4-cautro al millar, es decir, se multiplica el valor catastral mencionado por un factor de .004, "
-                        "de lo que resulta el Impuesto Predial adeudado, el cual queda de la siguiente manera:"
-                    )
-                else:
-                    # Este es el párrafo original que me diste, lo usaré como fallback
-                    millar_texto_final = f"({millar_valor:.3f})-ERROR"
-                    parrafo_final_millar = (
-                         "De conformidad con el artículo 21 bis-8 primer párrafo de la Ley de Hacienda para los Municipios del Estado de Nuevo León, el valor catastral del “INMUEBLE” de cada año descrito, "
-                         "se le aplica la tasa del 2-dos al millar, es decir, se multiplica dicho valor catastral por .002  y, en el caso de predios con cualquier uso distinto al de casa habitacion, "
-                         "como en el presente caso, dado que se trata de un predio con una edificacion comercial, se pagara el impuesto predial adicionando 1-uno al millar a la tasa mencionada, "
-                         "conforme a lo establecido en el tercer parrafo del articulo ya mencionado, por lo que una vez adicionada la tasa de 2-dos al millar mas 1- al millar, da como resultado una tasa del 3-tres al millar, "
-                         "es decir se multiplica el valor catastral mencionado por un factor de .003, de lo que resulta en el Impuesto Predial Adeudado, el cual queda de la siguiente manera:"
-                    )
-                    print(f"      (*) Advertencia: Valor de Millar '{millar_valor}' no reconocido para Exp {expediente_actual}. Usando párrafo por defecto.")
-
             # Añadir el texto del millar al diccionario de reemplazos finales
             # El formato de este placeholder se tomará del que le diste en la plantilla.
             final_replacements_calc["[MILLAR_TEXTO]"] = millar_texto_final
 
-            # --- FIN DE LA NUEVA LÓGICA ---
-
-
-            # Llamada a la función de reemplazo de placeholders finales (esta línea ya existe)
-            reemplazar_en_documento_v2(doc, final_replacements_calc, fase="final")
-            
-            # --- NUEVA LLAMADA PARA REEMPLAZAR EL PÁRRAFO COMPLETO ---
-            # Esto se hace DESPUÉS de los reemplazos normales
-            print("      Reemplazando párrafo de millar con formato...")
-            reemplazar_parrafo_con_negritas(doc, "[PARRAFO_MILLAR]", parrafo_final_millar, "“INMUEBLE”")
-            # --- FIN DE LA NUEVA LLAMADA ---
+            # Una sola fase final (antes eran dos pasadas: sin y con [MILLAR_TEXTO])
+            reemplazar_en_parrafos_indexados(parrafos_con_placeholders, final_replacements_calc, fase="final")
 
             if verificar_ausencia_info_construccion_v2(row, anos_activos): # Usa la de Predial_logica
                 eliminar_palabra_especifica_del_documento(doc, "CONSTRUCCION") # Usa la de Predial_logica
@@ -2033,7 +2394,7 @@ def generar_documentos_predial_core(
 
             # 2. Generar el PDF del citatorio
             with tempfile.TemporaryDirectory() as temp_dir_citatorio:
-                ruta_temp_pdf_citatorio = _generar_citatorio_pdf_interno(expediente_actual, config_predial_actual, Path(temp_dir_citatorio))
+                ruta_temp_pdf_citatorio = _generar_citatorio_pdf_interno(expediente_actual, config_predial_actual, Path(temp_dir_citatorio), citatorio_base_pdf)
                 if not ruta_temp_pdf_citatorio:
                     raise RuntimeError(f"Fallo al generar el PDF del citatorio para el expediente {expediente_actual}")
 
@@ -2064,6 +2425,10 @@ def generar_documentos_predial_core(
 
                 with open(ruta_pdf_final_unido_temp, 'wb') as f_out:
                     writer_final.write(f_out)
+
+            # QR con el expediente en cada página (citatorio incluido), para que el escaneo lo identifique sin OCR
+            if ocr_escaneo.ESTAMPAR_CODIGO_ID:
+                ocr_escaneo.estampar_codigo_id_pdf(ruta_pdf_final_unido_temp, CODIGO_ID_MODO_PREDIAL, str(expediente_actual).strip())
             
             paginas_doc_completo_contadas = len(writer_final.pages)
             print(f"    (Predial Logic Core) PDF final unido creado con {paginas_doc_completo_contadas} páginas.")
@@ -2143,23 +2508,18 @@ def generar_documentos_predial_core(
                 datos_para_actualizar["Ruta PDF Generado"] = ""
 
             # 2. Verificar si el expediente ya existe en la BD Maestra
-            indices_existentes_bd = df_bd_maestra_para_iteracion.index[
-                df_bd_maestra_para_iteracion[col_expediente_bd].astype(str) == str(expediente_actual)
-            ].tolist()
+            posicion_existente_bd = registros_bd_maestra.buscar(expediente_actual)
 
-            if indices_existentes_bd:
+            if posicion_existente_bd is not None:
                 # El registro YA EXISTE. Recuperar su ID y usarlo en el log.
-                id_existente = df_bd_maestra_para_iteracion.loc[indices_existentes_bd[-1], 'ID']
+                id_existente = registros_bd_maestra.valor(posicion_existente_bd, 'ID')
 
                 # --- AHORA IMPRIMIMOS EL LOG CON EL ID CORRECTO ---
                 print(f"\n  --- (Predial Logic Core) ({generados_count_logica + 1}/{len(df_datos_listos_para_bucle)}) ID: {id_existente} | Exp: {expediente_actual} ---")
                 print(f"    (Predial Logic Core) RESPETANDO ID de lote existente '{id_existente}'...")
 
-                idx_actualizar_bd = indices_existentes_bd[-1]
                 # Actualizar los campos del registro existente
-                for col_nombre, valor_nuevo in datos_para_actualizar.items():
-                    if col_nombre in df_bd_maestra_para_iteracion.columns:
-                        df_bd_maestra_para_iteracion.loc[idx_actualizar_bd, col_nombre] = valor_nuevo
+                registros_bd_maestra.actualizar(posicion_existente_bd, datos_para_actualizar)
             else:
                 # El registro es NUEVO. Generar, asignar e imprimir el nuevo ID
 
@@ -2184,17 +2544,9 @@ def generar_documentos_predial_core(
                         tipo_col = config_predial_actual["db_master_types"].get(col_maestra)
                         datos_para_actualizar[col_maestra] = pd.NA if tipo_col == 'Int64' else ""
 
-                df_nueva_fila = pd.DataFrame([datos_para_actualizar], columns=config_predial_actual["db_master_columns"])
-                df_bd_maestra_para_iteracion = pd.concat([df_bd_maestra_para_iteracion, df_nueva_fila], ignore_index=True)
+                registros_bd_maestra.agregar(datos_para_actualizar)
 # ...
 
-            # Re-asegurar tipos de datos al final de cada iteración
-            try:
-                tipos_a_aplicar = {k: v for k, v in config_predial_actual["db_master_types"].items() if k in df_bd_maestra_para_iteracion.columns}
-                df_bd_maestra_para_iteracion = df_bd_maestra_para_iteracion.astype(tipos_a_aplicar)
-            except Exception as e_astype:
-                 print(f"    (*) Advertencia: Fallo menor en re-astype para Exp {expediente_actual}. Error: {e_astype}")
-
             if pdf_generado_final_ok:
                 generados_count_logica += 1
                 print(f"    (Predial Logic Core) PDF generado para Exp {expediente_actual} es OK. Procediendo a registrar ruta y subir...")
@@ -2226,7 +2578,8 @@ def generar_documentos_predial_core(
     print(f"\n  --- (Predial Logic Core) Proceso Finalizado ---")
     print(f"  Documentos PDF (según modo) generados/intentados en esta ejecución lógica: {generados_count_logica}")
     
-    return df_bd_maestra_para_iteracion
+    # Volcado único de los registros acumulados, con los tipos de la BD Maestra
+    return registros_bd_maestra.a_dataframe()
 
     
 def formatear_texto_moneda(valor):
@@ -2279,15 +2632,23 @@ def replace_text_in_paragraph(paragraph, replacements):
             if key not in str_value:
                 processed_text = processed_text.replace(key, str_value)
                 found_placeholders_in_para = True
+    processed_text = limpiar_texto_domicilio(processed_text)
+    if not found_placeholders_in_para or full_text == processed_text: 
+        return
+    reconstruir_parrafo_con_texto(paragraph, processed_text)
+
+def limpiar_texto_domicilio(processed_text):
+    """Quita comas sobrantes en los párrafos de domicilio/ubicación tras el reemplazo."""
     if any(phrase in processed_text for phrase in ["DOMICILIO FISCAL:", "UBICACIÓN DEL PREDIO:"]):
         parts = [part.strip() for part in processed_text.split(',')]
         non_empty_parts = [part for part in parts if part]
         cleaned_text = ', '.join(non_empty_parts)
         cleaned_text = re.sub(r',\s*CP\s+(\d+)', r' CP \1', cleaned_text)
         processed_text = cleaned_text
-    if not found_placeholders_in_para or full_text == processed_text: 
-        return
+    return processed_text
 
+def reconstruir_parrafo_con_texto(paragraph, processed_text):
+    """Sustituye los runs del párrafo por uno solo con el texto dado, conservando el formato del primero."""
     try:
         first_run = paragraph.runs[0] if paragraph.runs else None
         p_alignment = paragraph.alignment
@@ -2379,6 +2740,108 @@ def reemplazar_en_documento_v2(document, replacements, fase=""):
                                     print(f"Warn ({fase}): Error celda H/F {cell_idx_hf}: {cell_err_hf}")
                                     continue
 
+def indexar_parrafos_con_placeholders(document):
+    """
+    Recorre el documento una sola vez (cuerpo, tablas, encabezados y pies, igual que
+    reemplazar_en_documento_v2) y devuelve los párrafos que contienen algún '['.
+    La poda posterior solo elimina filas y tablas, así que el índice sigue siendo válido
+    para todas las fases de reemplazo del mismo documento.
+    """
+    parrafos_indexados = []
+    elementos_vistos = set()
+
+    def _agregar_parrafo(paragraph):
+        try:
+            if paragraph._element is None or paragraph._element in elementos_vistos:
+                return
+            elementos_vistos.add(paragraph._element)
+            if '[' in paragraph.text:
+                parrafos_indexados.append(paragraph)
+        except Exception as e_par:
+            print(f"Warn (indexado): No se pudo leer párrafo: {e_par}")
+
+    def _agregar_tabla(table):
+        if table._element is None or table._element.getparent() is None:
+            return
+        for row in table.rows:
+            try:
+                for cell in row.cells:
+                    for paragraph in cell.paragraphs:
+                        _agregar_parrafo(paragraph)
+            except Exception as e_row:
+                print(f"Warn (indexado): No get celdas tabla: {e_row}")
+
+    for paragraph in document.paragraphs:
+        _agregar_parrafo(paragraph)
+    for table in document.tables:
+        _agregar_tabla(table)
+    for section in document.sections:
+        for header_footer_part in [section.header, section.footer, section.first_page_header, section.first_page_footer, section.even_page_header, section.even_page_footer]:
+            if header_footer_part is not None:
+                for paragraph in header_footer_part.paragraphs:
+                    _agregar_parrafo(paragraph)
+                if hasattr(header_footer_part, 'tables'):
+                    for table in header_footer_part.tables:
+                        _agregar_tabla(table)
+    return parrafos_indexados
+
+def replace_text_in_paragraph_compilado(paragraph, patron, valores, replacements):
+    """
+    Igual que replace_text_in_paragraph, pero con todas las claves en una sola alternación
+    compilada. Si el resultado vuelve a contener una clave (un valor trae otro placeholder),
+    se usa el reemplazo secuencial para conservar su encadenado.
+    """
+    try:
+        is_header_footer = paragraph._element.getparent().tag.lower().endswith(('hdr', 'ftr'))
+    except Exception:
+        is_header_footer = False
+    if is_header_footer:
+        # En encabezados y pies solo se reemplaza [EXPEDIENTE]
+        replace_text_in_paragraph(paragraph, replacements)
+        return
+    try:
+        full_text = paragraph.text
+    except Exception:
+        return
+    if '[' not in full_text:
+        return
+
+    processed_text, n_reemplazos = patron.subn(lambda m: valores[m.group(0)], full_text)
+    if not n_reemplazos:
+        return
+    if patron.search(processed_text):
+        replace_text_in_paragraph(paragraph, replacements)
+        return
+    processed_text = limpiar_texto_domicilio(processed_text)
+    if full_text == processed_text:
+        return
+    reconstruir_parrafo_con_texto(paragraph, processed_text)
+
+def reemplazar_en_parrafos_indexados(parrafos_indexados, replacements, fase=""):
+    """
+    Aplica los reemplazos solo sobre los párrafos indexados, con una alternación compilada una
+    vez por llamada (claves de mayor a menor longitud, como replace_text_in_paragraph).
+    Devuelve los párrafos que aún contienen '[' para la siguiente fase.
+    """
+    print(f"      Aplicando {len(replacements)} reemplazos {fase} sobre {len(parrafos_indexados)} párrafos...")
+    valores = {k: (str(v) if v is not None else "") for k, v in replacements.items()}
+    # Las claves cuyo valor las contiene nunca se reemplazan (misma regla que replace_text_in_paragraph)
+    claves = [k for k in sorted(valores, key=len, reverse=True) if k not in valores[k]]
+    patron = re.compile("|".join(re.escape(k) for k in claves)) if claves else None
+
+    parrafos_pendientes = []
+    for paragraph in parrafos_indexados:
+        if paragraph._element is None or paragraph._element.getparent() is None:
+            continue
+        if patron is not None:
+            replace_text_in_paragraph_compilado(paragraph, patron, valores, replacements)
+        try:
+            if '[' in paragraph.text:
+                parrafos_pendientes.append(paragraph)
+        except Exception:
+            continue
+    return parrafos_pendientes
+
 def eliminar_filas_areas_vacias(table):
     try:
         if not table.rows: 
@@ -2433,7 +2896,28 @@ def eliminar_filas_areas_vacias(table):
     except Exception as ex_table:
         print("Error CRITICO procesando tabla de areas: %s" % ex_table)
 
-def eliminar_elementos_inactivos_v_usuario(document, anos_inactivos, periodo_año, periodo_bimestre, tablas_protegidas):
+def eliminar_filas_areas_vacias_documento(document):
+    """
+    Aplica eliminar_filas_areas_vacias a las tablas de SUPERFICIE del documento, saltando
+    las mismas tablas (totales e INPC) que salta eliminar_elementos_inactivos_v_usuario.
+    """
+    for table in list(document.tables):
+        if table._element is None or table._element.getparent() is None or not table.rows:
+            continue
+        try:
+            header_texts = [cell.text.strip().upper() for cell in table.rows[0].cells]
+        except Exception as e_headers:
+            print("--- Debug WARN: No se pudieron leer encabezados de tabla de areas: %s" % e_headers)
+            continue
+        if any("IMPORTE TOTAL DE CONTRIBUCIONES OMITIDAS" in h for h in header_texts):
+            continue
+        if header_texts and "BIMESTRE/AÑO" in header_texts[0] \
+        and any("ÍNDICE NACIONAL DE PRECIOS" in ht for ht in header_texts):
+            continue
+        if any("SUPERFICIE" in txt for txt in header_texts):
+            eliminar_filas_areas_vacias(table)
+
+def eliminar_elementos_inactivos_v_usuario(document, anos_inactivos, periodo_año, periodo_bimestre, tablas_protegidas, procesar_areas=True):
     if not anos_inactivos:
         print("      No hay años inactivos para eliminar secciones.")
     else:
@@ -2558,7 +3042,8 @@ def eliminar_elementos_inactivos_v_usuario(document, anos_inactivos, periodo_añ
                     continue
 
             if any("SUPERFICIE" in txt for txt in header_texts):
-                eliminar_filas_areas_vacias(table)
+                if procesar_areas:
+                    eliminar_filas_areas_vacias(table)
                 processed_as_area_table = True
 
             if anos_inactivos:
@@ -1,6 +1,7 @@
 # GOBIERNO/generador_maestro.py
 
 import os
+import posixpath
 import pandas as pd
 from pathlib import Path
 import threading
@@ -12,6 +13,11 @@ import sys
 from openpyxl import load_workbook, Workbook # Necesario para guardar_bd_maestra_unificada
 from openpyxl.utils.dataframe import dataframe_to_rows # Necesario para guardar_bd_maestra_unificada
 from openpyxl.utils.exceptions import InvalidFileException # Para manejo de errores en carga
+from openpyxl.utils import get_column_letter, column_index_from_string # Para el guardado incremental
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+import zipfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape as xml_escape
 import threading
 import unicodedata
 from docx import Document
@@ -20,16 +26,54 @@ import time  # Para las pausas
 import traceback # Para mostrar errores inesperados detallados
 import paramiko 
 import shutil
+import atexit
 import copy
+import sqlite3
+import json
+import hashlib
 
 import GeneradorPredial_logica
 import GeneradorMultas_logica
 
+try:
+    import pyarrow # Necesario para la caché Feather de BASE_DE_DATOS.xlsx
+    PYARROW_INSTALLED = True
+except ImportError:
+    PYARROW_INSTALLED = False
+
 # --- CONSTANTES GLOBALES DEL SCRIPT INTEGRADOR ---
 SCRIPT_BASE_PATH = Path(__file__).resolve().parent  # Directorio GOBIERNO/
 KEYWORD_MULTAS = "MULTAS"
 KEYWORD_PREDIAL = "PREDIAL"
 
+# --- Servidor SFTP de documentos ---
+# Se pueden sobreescribir por variables de entorno (p. ej. para probar contra un SFTP local).
+SFTP_HOST = os.environ.get("GOB_SFTP_HOST", "asesorescloud.ddns.net")
+SFTP_PORT = int(os.environ.get("GOB_SFTP_PORT", "58123"))
+SFTP_USUARIO = os.environ.get("GOB_SFTP_USUARIO", "afc")
+SFTP_PASSWORD = os.environ.get("GOB_SFTP_PASSWORD", "asesores")
+SFTP_TIMEOUT = 10
+
+# --- Almacén SQLite opcional para la BD Maestra ---
+# Con GOB_BD_MAESTRA_SQLITE=1 la copia autoritativa de la BD Maestra vive en un archivo .sqlite
+# junto al Excel; el .xlsx pasa a ser un formato de exportación que se genera bajo demanda.
+BD_MAESTRA_USAR_SQLITE = os.environ.get("GOB_BD_MAESTRA_SQLITE", "0").strip().lower() in ("1", "si", "true")
+BD_MAESTRA_SQLITE_TABLA = "bd_maestra"
+
+# --- Guardado incremental del Excel de la BD Maestra (opcional) ---
+# Con GOB_BD_MAESTRA_GUARDADO_INCREMENTAL=1 solo se reescriben, en el XML de la hoja, las celdas que
+# cambiaron desde la última lectura/guardado; por defecto se reescribe la hoja completa como siempre.
+# Ojo: el resultado no es idéntico al de un guardado completo. Los cambios se detectan contra el
+# DataFrame ya tipado, así que las celdas sin cambios conservan el valor crudo que tenían en disco
+# (fechas como fecha, IDs guardados como número, texto en columnas Int64...), mientras que el
+# guardado completo las normaliza al tipo del DataFrame.
+BD_MAESTRA_GUARDADO_INCREMENTAL = os.environ.get("GOB_BD_MAESTRA_GUARDADO_INCREMENTAL", "0").strip().lower() in ("1", "si", "true")
+
+# --- Caché columnar de BASE_DE_DATOS.xlsx ---
+# Carpeta (dentro de la carpeta de cada modo) donde se guarda la última lectura en formato Feather.
+CACHE_DATOS_DIRNAME = "_cache_datos"
+CACHE_DATOS_VERSION = 1
+
 # Al inicio de generador_maestro.py, DESPUÉS de definir SCRIPT_BASE_PATH
 # Asegúrate que GeneradorFER_logica.py está en el mismo directorio o en PYTHONPATH
 try:
@@ -157,9 +201,31 @@ MODO_ACCION_REPORTE_DESPACHOS_MULTAS = "REPORTE_DESPACHOS_MULTAS" # << NUEVA CON
 
 
 excel_lock = threading.Lock()
+# Última versión conocida de cada hoja BD_Maestra (ruta -> snapshot), para el guardado incremental
+snapshots_bd_maestra_excel = {}
 
 
-def cargar_bd_maestra_unificada(mode_config):
+def convertir_columna_bd_unificada(serie, expected_dtype_str, col_name):
+    """
+    Convierte una columna completa de la BD Maestra al tipo definido en mode_config["db_master_types"].
+    Es la regla de conversión que usan tanto la carga (cargar_bd_maestra_unificada) como el
+    upsert en bloque (upsert_bd_maestra_unificada). Si la conversión falla, la columna queda como string.
+    """
+    try:
+        if expected_dtype_str == 'str':
+            return serie.fillna("").astype(str)
+        elif expected_dtype_str == 'Int64':
+            return pd.to_numeric(serie, errors='coerce').astype('Int64')
+        else:
+            if expected_dtype_str in ['float64', 'float32', 'int32']:
+                return pd.to_numeric(serie.replace('', pd.NA), errors='coerce').astype(expected_dtype_str)
+            else:
+                return serie.astype(expected_dtype_str)
+    except Exception as e_type_conv:
+        print(f"      - (!) Advertencia: No se pudo convertir columna '{col_name}'. Se usará string. Error: {e_type_conv}")
+        return serie.astype(str).fillna("")
+
+def cargar_bd_maestra_unificada(mode_config, forzar_excel=False):
     """
     Carga la Base de Datos Maestra desde el archivo Excel especificado en mode_config.
     Si el archivo no existe, o la hoja 'BD_Maestra' no existe,
@@ -168,7 +234,11 @@ def cargar_bd_maestra_unificada(mode_config):
     y tengan los tipos de datos definidos en mode_config["db_master_types"].
     Las columnas ID (definidas por mode_config["col_expediente"]) se fuerzan a string.
     *** VERSIÓN MODIFICADA PARA PRESERVAR COLUMNAS EXTRA COMO 'MOVIMIENTO' ***
+    Si el modo usa el almacén SQLite (y no se pide forzar_excel), la BD se lee desde ahí.
     """
+    if mode_config.get("usar_bd_sqlite") and not forzar_excel:
+        return cargar_bd_maestra_sqlite(mode_config)
+
     ruta_excel_bd = Path(mode_config["master_db_file_path"])
     sheet_name_bd = "BD_Maestra"
     defined_columns = mode_config["db_master_columns"]
@@ -215,20 +285,8 @@ def cargar_bd_maestra_unificada(mode_config):
                         else:
                             df[col_name] = ""
 
-                    # --- Lógica de conversión de tipos (sin cambios) ---
-                    try:
-                        if expected_dtype_str == 'str':
-                            df[col_name] = df[col_name].fillna("").astype(str)
-                        elif expected_dtype_str == 'Int64':
-                            df[col_name] = pd.to_numeric(df[col_name], errors='coerce').astype('Int64')
-                        else:
-                            if expected_dtype_str in ['float64', 'float32', 'int32']:
-                                df[col_name] = pd.to_numeric(df[col_name].replace('', pd.NA), errors='coerce').astype(expected_dtype_str)
-                            else:
-                                df[col_name] = df[col_name].astype(expected_dtype_str)
-                    except Exception as e_type_conv:
-                        print(f"      - (!) Advertencia: No se pudo convertir columna '{col_name}'. Se usará string. Error: {e_type_conv}")
-                        df[col_name] = df[col_name].astype(str).fillna("")
+                    # --- Lógica de conversión de tipos (compartida con el upsert en bloque) ---
+                    df[col_name] = convertir_columna_bd_unificada(df[col_name], expected_dtype_str, col_name)
 
                 # --- INICIO DEL CAMBIO ---
                 # Construir la lista final de columnas, preservando las extras como 'MOVIMIENTO'
@@ -245,6 +303,7 @@ def cargar_bd_maestra_unificada(mode_config):
                 # --- FIN DEL CAMBIO ---
                 
                 print(f"    - BD Maestra para '{mode_config['mode_name']}' cargada. {len(df)} registros. Columnas detectadas: {df.columns.tolist()}")
+                registrar_snapshot_bd_maestra_excel(ruta_excel_bd, df, columnas_hoja=original_excel_columns)
                 return df
             except InvalidFileException:
                 print(f"    - (!) ERROR CRITICO: Archivo BD Maestra '{ruta_excel_bd}' está corrupto.")
@@ -441,6 +500,90 @@ def actualizar_o_agregar_registro_bd_unificada(df_bd, registro_data, mode_config
              print(f"      - (!) Advertencia: Falla en astype final después de concat para ID {id_valor_buscado}. Error: {e_final_astype}.")
     return df_bd
 
+def upsert_bd_maestra_unificada(df_bd, df_cambios, mode_config):
+    """
+    Aplica en bloque un DataFrame de cambios sobre la BD Maestra unificada.
+    Cada fila de df_cambios se identifica por la columna ID del modo (mode_config["col_expediente"]):
+    - Si el ID ya existe en la BD, se sobrescriben solo las columnas presentes en df_cambios
+      (sobre la última fila con ese ID, igual que actualizar_o_agregar_registro_bd_unificada).
+    - Si no existe, se agrega una fila nueva con las columnas definidas; las que no vengan
+      en df_cambios se inicializan a NA/"" según su tipo.
+    Los valores se convierten con las mismas reglas que cargar_bd_maestra_unificada.
+    Si un ID aparece varias veces en df_cambios, prevalece la última fila.
+    """
+    id_column_name = mode_config["col_expediente"]
+    defined_columns = mode_config["db_master_columns"]
+    defined_types = mode_config["db_master_types"]
+
+    if df_cambios is None or df_cambios.empty:
+        return df_bd
+    if id_column_name not in df_cambios.columns:
+        print(f"    - (!) Error: Los cambios para la BD no traen la columna ID '{id_column_name}'. No se aplicó nada.")
+        return df_bd
+
+    # --- Normalizar IDs y convertir los cambios con las reglas de la BD ---
+    df_cambios = df_cambios.copy()
+    df_cambios.columns = [str(col).strip() for col in df_cambios.columns]
+    df_cambios[id_column_name] = df_cambios[id_column_name].fillna("").astype(str).str.strip()
+    sin_id = df_cambios[id_column_name] == ""
+    if sin_id.any():
+        print(f"    - (!) Error: Se omitieron {int(sin_id.sum())} cambio(s) sin ID ('{id_column_name}').")
+        df_cambios = df_cambios[~sin_id]
+    df_cambios = df_cambios.drop_duplicates(subset=id_column_name, keep='last')
+
+    for col_name in df_cambios.columns:
+        if col_name == id_column_name or col_name not in defined_types:
+            continue
+        tipo_esperado = defined_types[col_name]
+        df_cambios[col_name] = convertir_columna_bd_unificada(df_cambios[col_name], tipo_esperado, col_name)
+        if tipo_esperado == 'str':
+            df_cambios[col_name] = df_cambios[col_name].str.strip()
+
+    # --- Localizar la última fila de cada ID existente en la BD ---
+    df_bd = df_bd.copy()
+    if id_column_name not in df_bd.columns:
+        print(f"    - (!) Error Crítico: Columna ID '{id_column_name}' no existe en el DataFrame de BD. Se creará vacía.")
+        df_bd[id_column_name] = ""
+    df_bd[id_column_name] = df_bd[id_column_name].astype(str).str.strip()
+
+    posicion_por_id = pd.Series(range(len(df_bd)), index=df_bd[id_column_name].to_numpy())
+    posicion_por_id = posicion_por_id[~posicion_por_id.index.duplicated(keep='last')]
+    es_existente = df_cambios[id_column_name].isin(posicion_por_id.index)
+    df_actualizar = df_cambios[es_existente]
+    df_agregar = df_cambios[~es_existente]
+
+    # --- Actualizaciones: una asignación por columna ---
+    if not df_actualizar.empty:
+        posiciones = posicion_por_id.loc[df_actualizar[id_column_name]].to_numpy()
+        for col_name in df_actualizar.columns:
+            if col_name == id_column_name or col_name not in df_bd.columns:
+                continue
+            columna = df_bd[col_name].copy()
+            try:
+                columna.iloc[posiciones] = df_actualizar[col_name].to_numpy()
+            except Exception as e_conv_update:
+                print(f"      - (!) Advertencia (Actualizar BD): No se pudieron asignar los valores de '{col_name}' con su tipo. Se usará string. Error: {e_conv_update}")
+                columna = columna.astype(object)
+                columna.iloc[posiciones] = df_actualizar[col_name].astype(str).to_numpy()
+            df_bd[col_name] = columna
+
+    # --- Altas: un solo concat con todas las filas nuevas ---
+    if not df_agregar.empty:
+        df_nuevas = df_agregar.reindex(columns=defined_columns)
+        for col_name in defined_columns:
+            tipo_col = defined_types.get(col_name, 'str')
+            if col_name not in df_agregar.columns:
+                df_nuevas[col_name] = pd.NA if tipo_col == 'Int64' else ""
+            df_nuevas[col_name] = convertir_columna_bd_unificada(df_nuevas[col_name], tipo_col, col_name)
+        df_bd = pd.concat([df_bd, df_nuevas], ignore_index=True)
+        try:
+            df_bd = df_bd.astype(defined_types)
+        except Exception as e_final_astype:
+            print(f"      - (!) Advertencia: Falla en astype final después del upsert en bloque. Error: {e_final_astype}.")
+
+    print(f"    - BD Maestra (upsert en bloque): {len(df_actualizar)} registro(s) actualizados, {len(df_agregar)} agregados.")
+    return df_bd
+
 def limpiar_texto(texto_original):
     """
     Limpia un texto para ser usado en nombres de archivo o identificadores.
@@ -561,17 +704,447 @@ def cargar_pm_xlsx(mode_config):
         print(f"    - (!) Error crítico leyendo PM desde '{filepath.name}': {e}")
         return pm_expedientes_set
     
-def guardar_bd_maestra_unificada(df_a_guardar, mode_config, is_test_mode=False, processed_ids_in_batch=None):
+class AlmacenBDMaestraSQLite:
+    """
+    Copia autoritativa de la BD Maestra en un archivo SQLite.
+
+    Cada fila se identifica por (ID del modo, ocurrencia), donde la ocurrencia numera las filas
+    que comparten ID en el orden en que aparecen; así se conservan tal cual los IDs duplicados
+    que pudiera traer el Excel. Las columnas del modo se guardan con afinidad INTEGER/REAL/TEXT
+    según db_master_types y las columnas extra (ej. 'MOVIMIENTO') como TEXT.
+    Las escrituras se hacen fila a fila dentro de una transacción: solo se tocan las filas que cambiaron.
+    Las lecturas cargan la tabla completa (los flujos trabajan sobre el DataFrame de toda la BD).
+    """
+
+    def __init__(self, ruta_sqlite, mode_config):
+        self.ruta_sqlite = Path(ruta_sqlite)
+        self.id_column_name = mode_config["col_expediente"]
+        self.defined_columns = list(mode_config["db_master_columns"])
+        self.defined_types = mode_config["db_master_types"]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _q(nombre):
+        return '"' + str(nombre).replace('"', '""') + '"'
+
+    def _afinidad(self, col_name):
+        tipo = self.defined_types.get(col_name, 'str')
+        if tipo in ('Int64', 'int32'):
+            return 'INTEGER'
+        if tipo in ('float64', 'float32'):
+            return 'REAL'
+        return 'TEXT'
+
+    @staticmethod
+    def _valor_sqlite(valor, afinidad):
+        """Convierte un valor de pandas al tipo Python que se guarda en una columna con la afinidad dada."""
+        try:
+            if pd.isna(valor):
+                return None
+        except (TypeError, ValueError):
+            pass
+        if afinidad == 'INTEGER':
+            try:
+                return int(valor)
+            except (TypeError, ValueError):
+                return str(valor)
+        if afinidad == 'REAL':
+            try:
+                return float(valor)
+            except (TypeError, ValueError):
+                return str(valor)
+        return str(valor)
+
+    def _conectar(self):
+        self.ruta_sqlite.parent.mkdir(parents=True, exist_ok=True)
+        return sqlite3.connect(self.ruta_sqlite, timeout=30)
+
+    def _columnas_tabla(self, conn):
+        filas = conn.execute(f"PRAGMA table_info({self._q(BD_MAESTRA_SQLITE_TABLA)})").fetchall()
+        return [fila[1] for fila in filas if fila[1] != "_ocurrencia"]
+
+    def _asegurar_esquema(self, conn, columnas):
+        """Crea la tabla y el índice por ID si no existen y añade las columnas que falten."""
+        existentes = self._columnas_tabla(conn)
+        if not existentes:
+            definicion = ", ".join(f"{self._q(col)} {self._afinidad(col)}" for col in columnas)
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self._q(BD_MAESTRA_SQLITE_TABLA)} ({definicion}, \"_ocurrencia\" INTEGER NOT NULL)")
+            existentes = list(columnas)
+        else:
+            for col in columnas:
+                if col not in existentes:
+                    conn.execute(f"ALTER TABLE {self._q(BD_MAESTRA_SQLITE_TABLA)} ADD COLUMN {self._q(col)} {self._afinidad(col)}")
+                    existentes.append(col)
+        conn.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS \"ix_{BD_MAESTRA_SQLITE_TABLA}_id\" "
+            f"ON {self._q(BD_MAESTRA_SQLITE_TABLA)} ({self._q(self.id_column_name)}, \"_ocurrencia\")"
+        )
+        return existentes
+
+    def tiene_registros(self):
+        if not self.ruta_sqlite.exists():
+            return False
+        with self._lock:
+            conn = self._conectar()
+            try:
+                if not self._columnas_tabla(conn):
+                    return False
+                return conn.execute(f"SELECT 1 FROM {self._q(BD_MAESTRA_SQLITE_TABLA)} LIMIT 1").fetchone() is not None
+            finally:
+                conn.close()
+
+    def cargar(self):
+        """Devuelve la BD completa como DataFrame, con los mismos tipos que cargar_bd_maestra_unificada."""
+        with self._lock:
+            conn = self._conectar()
+            try:
+                columnas = self._asegurar_esquema(conn, self.defined_columns)
+                select_cols = ", ".join(self._q(col) for col in columnas)
+                df = pd.read_sql_query(f"SELECT {select_cols} FROM {self._q(BD_MAESTRA_SQLITE_TABLA)} ORDER BY rowid", conn)
+            finally:
+                conn.close()
+        for col_name in df.columns:
+            df[col_name] = convertir_columna_bd_unificada(df[col_name], self.defined_types.get(col_name, 'str'), col_name)
+        return df
+
+    def sincronizar(self, df):
+        """
+        Deja la tabla igual que `df` escribiendo solo la diferencia, en una sola transacción:
+        UPDATE de las filas que cambiaron, INSERT de las nuevas y DELETE de las que ya no están.
+        Devuelve (actualizadas, agregadas, eliminadas).
+        """
+        df = df.copy()
+        df[self.id_column_name] = df[self.id_column_name].fillna("").astype(str).str.strip()
+        columnas = list(self.defined_columns) + [c for c in df.columns if c not in self.defined_columns]
+        df = df.reindex(columns=columnas)
+        ocurrencias = df.groupby(self.id_column_name, sort=False).cumcount().tolist()
+
+        with self._lock:
+            conn = self._conectar()
+            try:
+                with conn:
+                    columnas_tabla = self._asegurar_esquema(conn, columnas)
+                    afinidades = [self._afinidad(col) for col in columnas_tabla]
+                    select_cols = ", ".join(self._q(col) for col in columnas_tabla)
+                    idx_id = columnas_tabla.index(self.id_column_name)
+                    guardadas = {}
+                    for fila in conn.execute(f"SELECT {select_cols}, \"_ocurrencia\" FROM {self._q(BD_MAESTRA_SQLITE_TABLA)}"):
+                        guardadas[(fila[idx_id], fila[-1])] = tuple(fila[:-1])
+
+                    set_cols = ", ".join(f"{self._q(col)} = ?" for col in columnas_tabla)
+                    sql_update = (f"UPDATE {self._q(BD_MAESTRA_SQLITE_TABLA)} SET {set_cols} "
+                                  f"WHERE {self._q(self.id_column_name)} = ? AND \"_ocurrencia\" = ?")
+                    marcadores = ", ".join("?" for _ in range(len(columnas_tabla) + 1))
+                    sql_insert = f"INSERT INTO {self._q(BD_MAESTRA_SQLITE_TABLA)} ({select_cols}, \"_ocurrencia\") VALUES ({marcadores})"
+
+                    df_tabla = df.reindex(columns=columnas_tabla)
+                    actualizar, agregar, vistas = [], [], set()
+                    for valores, ocurrencia in zip(df_tabla.itertuples(index=False, name=None), ocurrencias):
+                        fila_nueva = tuple(self._valor_sqlite(v, a) for v, a in zip(valores, afinidades))
+                        clave = (fila_nueva[idx_id], ocurrencia)
+                        vistas.add(clave)
+                        fila_guardada = guardadas.get(clave)
+                        if fila_guardada is None:
+                            agregar.append(fila_nueva + (ocurrencia,))
+                        elif fila_guardada != fila_nueva:
+                            actualizar.append(fila_nueva + clave)
+                    eliminar = [clave for clave in guardadas if clave not in vistas]
+
+                    if actualizar:
+                        conn.executemany(sql_update, actualizar)
+                    if agregar:
+                        conn.executemany(sql_insert, agregar)
+                    if eliminar:
+                        conn.executemany(
+                            f"DELETE FROM {self._q(BD_MAESTRA_SQLITE_TABLA)} WHERE {self._q(self.id_column_name)} = ? AND \"_ocurrencia\" = ?",
+                            eliminar
+                        )
+            finally:
+                conn.close()
+        return len(actualizar), len(agregar), len(eliminar)
+
+_almacenes_bd_sqlite = {}
+_almacenes_bd_sqlite_lock = threading.Lock()
+
+def obtener_almacen_bd_sqlite(mode_config):
+    """Devuelve (creándolo la primera vez) el almacén SQLite del modo."""
+    ruta_sqlite = Path(mode_config["master_db_sqlite_path"])
+    with _almacenes_bd_sqlite_lock:
+        almacen = _almacenes_bd_sqlite.get(ruta_sqlite)
+        if almacen is None:
+            almacen = AlmacenBDMaestraSQLite(ruta_sqlite, mode_config)
+            _almacenes_bd_sqlite[ruta_sqlite] = almacen
+        return almacen
+
+def cargar_bd_maestra_sqlite(mode_config):
+    """
+    Carga la BD Maestra desde el almacén SQLite del modo.
+    La primera vez (almacén vacío) importa el Excel existente para no perder el historial.
+    """
+    almacen = obtener_almacen_bd_sqlite(mode_config)
+    try:
+        if not almacen.tiene_registros():
+            print(f"    - Almacén SQLite vacío para '{mode_config['mode_name']}'. Importando BD Maestra desde Excel...")
+            df_importada = cargar_bd_maestra_unificada(mode_config, forzar_excel=True)
+            if not df_importada.empty:
+                _, agregadas, _ = almacen.sincronizar(df_importada)
+                print(f"    - {agregadas} registros importados a '{almacen.ruta_sqlite.name}'.")
+            return df_importada
+        print(f"    - Cargando BD Maestra para '{mode_config['mode_name']}' desde SQLite: {almacen.ruta_sqlite}")
+        df = almacen.cargar()
+        print(f"    - BD Maestra para '{mode_config['mode_name']}' cargada. {len(df)} registros.")
+        return df
+    except sqlite3.Error as e_sqlite:
+        print(f"    - (!) ERROR CRITICO: No se pudo leer el almacén SQLite '{almacen.ruta_sqlite}'. Error: {e_sqlite}")
+        sys.exit(1)
+
+def guardar_bd_maestra_sqlite(df_a_guardar, mode_config):
+    """Guarda en el almacén SQLite solo las filas que cambiaron. No genera el Excel."""
+    almacen = obtener_almacen_bd_sqlite(mode_config)
+    try:
+        actualizadas, agregadas, eliminadas = almacen.sincronizar(df_a_guardar)
+        print(f"    -> BD Maestra guardada en SQLite ({actualizadas} actualizadas, {agregadas} agregadas, {eliminadas} eliminadas).")
+        return True
+    except sqlite3.Error as e_sqlite:
+        print(f"    - (!) ERROR CRÍTICO al guardar BD Maestra en SQLite '{almacen.ruta_sqlite}': {e_sqlite}")
+        traceback.print_exc()
+        return False
+
+def exportar_bd_maestra_sqlite_a_excel(mode_config, is_test_mode=False):
+    """Genera el Excel de la BD Maestra a partir del almacén SQLite (y lo sube al servidor, como cualquier guardado)."""
+    print(f"    - Exportando BD Maestra de '{mode_config['mode_name']}' desde SQLite a Excel...")
+    df_bd = cargar_bd_maestra_sqlite(mode_config)
+    return guardar_bd_maestra_unificada(df_bd, mode_config, is_test_mode=is_test_mode, forzar_excel=True)
+
+def _valor_celda_bd(valor):
+    """Valor tal como se escribe en la celda (igual que el guardado completo: NA -> celda vacía)."""
+    try:
+        if pd.isna(valor):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if hasattr(valor, "item") and not isinstance(valor, str):
+        return valor.item() # escalares de numpy -> tipos de Python
+    return valor
+
+def registrar_snapshot_bd_maestra_excel(ruta_excel_bd, df, columnas_hoja=None):
+    """
+    Recuerda el contenido de la hoja BD_Maestra tal como quedó en disco (tras cargarla o guardarla).
+    Las filas de `df` están en el orden de la hoja; cada etiqueta del índice queda asociada a su fila,
+    de modo que el siguiente guardado pueda reconocer qué registros ya existen en el archivo.
+    `columnas_hoja` es el orden de los encabezados en el archivo (por defecto, el de `df`).
+    """
+    ruta_excel_bd = Path(ruta_excel_bd)
+    try:
+        estado_archivo = ruta_excel_bd.stat()
+    except OSError:
+        snapshots_bd_maestra_excel.pop(ruta_excel_bd, None)
+        return
+    snapshots_bd_maestra_excel[ruta_excel_bd] = {
+        "firma_archivo": (estado_archivo.st_mtime_ns, estado_archivo.st_size),
+        "columnas_hoja": [str(col) for col in (columnas_hoja if columnas_hoja is not None else df.columns)],
+        "valores": {str(col): [_valor_celda_bd(v) for v in df[col].tolist()] for col in df.columns},
+        "fila_por_etiqueta": pd.Series(range(len(df)), index=df.index) if df.index.is_unique else None,
+    }
+
+# --- Parcheo directo del XML de la hoja (guardado incremental) ---
+PATRON_FILA_XLSX = re.compile(rb'<row\b[^>]*?\br="(\d+)"[^>]*?(?:/>|>.*?</row>)', re.S)
+PATRON_CELDA_XLSX = re.compile(r'<c\b[^>]*?\br="([A-Z]+)\d+"[^>]*?(?:/>|>.*?</c>)', re.S)
+PATRON_ESTILO_CELDA_XLSX = re.compile(r'^<c\b[^>]*?\s(s="\d+")')
+
+def _celda_xml_bd(ref, valor, estilo=""):
+    """XML de una celda con el mismo formato que escribe openpyxl (texto como inlineStr). None si el valor no es simple."""
+    estilo = f" {estilo}" if estilo else ""
+    if valor is None:
+        return f'<c r="{ref}"{estilo}/>'
+    if isinstance(valor, bool):
+        return f'<c r="{ref}"{estilo} t="b"><v>{int(valor)}</v></c>'
+    if isinstance(valor, int):
+        return f'<c r="{ref}"{estilo} t="n"><v>{valor}</v></c>'
+    if isinstance(valor, float):
+        return f'<c r="{ref}"{estilo} t="n"><v>{repr(valor)}</v></c>'
+    if isinstance(valor, str):
+        if ILLEGAL_CHARACTERS_RE.search(valor):
+            return None
+        return f'<c r="{ref}"{estilo} t="inlineStr"><is><t xml:space="preserve">{xml_escape(valor)}</t></is></c>'
+    return None
+
+def _parte_xml_de_hoja(zip_libro, sheet_name_bd):
+    """Ruta dentro del .xlsx del XML de la hoja con ese nombre, o None."""
+    ns_main = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+    ns_rel = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+    libro = ET.fromstring(zip_libro.read("xl/workbook.xml"))
+    rel_id = None
+    for hoja in libro.iter(f"{ns_main}sheet"):
+        if hoja.get("name") == sheet_name_bd:
+            rel_id = hoja.get(f"{ns_rel}id")
+    if rel_id is None:
+        return None
+    relaciones = ET.fromstring(zip_libro.read("xl/_rels/workbook.xml.rels"))
+    for relacion in relaciones:
+        if relacion.get("Id") == rel_id:
+            destino = relacion.get("Target", "")
+            return destino.lstrip("/") if destino.startswith("/") else "xl/" + destino
+    return None
+
+def _parchear_fila_xml(fila_xml, num_fila, celdas_nuevas):
+    """Reemplaza/inserta celdas ({num_columna: valor}) en el XML de una fila. None si no se puede."""
+    inicio_celdas = fila_xml.find(">") + 1
+    if fila_xml.endswith("/>") and inicio_celdas == len(fila_xml):
+        apertura, contenido = fila_xml[:-2].rstrip() + ">", ""
+    else:
+        apertura, contenido = fila_xml[:inicio_celdas], fila_xml[inicio_celdas:-len("</row>")]
+    apertura = re.sub(r'\sspans="[^"]*"', "", apertura)
+
+    celdas = {}
+    for celda in PATRON_CELDA_XLSX.finditer(contenido):
+        celdas[column_index_from_string(celda.group(1))] = celda.group(0)
+    if sum(len(c) for c in celdas.values()) != len(contenido.strip()):
+        return None # contenido que no son celdas simples
+    for num_col, valor in celdas_nuevas.items():
+        estilo = ""
+        if num_col in celdas:
+            coincidencia_estilo = PATRON_ESTILO_CELDA_XLSX.search(celdas[num_col])
+            estilo = coincidencia_estilo.group(1) if coincidencia_estilo else ""
+        celda_xml = _celda_xml_bd(f"{get_column_letter(num_col)}{num_fila}", valor, estilo)
+        if celda_xml is None:
+            return None
+        celdas[num_col] = celda_xml
+    return apertura + "".join(celdas[c] for c in sorted(celdas)) + "</row>"
+
+def preparar_parche_bd_maestra_excel(ruta_excel_bd, sheet_name_bd, df_listo_guardar, id_column_name):
+    """
+    Intenta preparar el guardado como parche sobre la hoja existente: solo se reescriben las celdas
+    que cambiaron respecto al último snapshot y las filas nuevas se agregan al final, editando
+    directamente el XML de la hoja dentro del .xlsx (sin cargar el libro completo con openpyxl).
+    Devuelve (parte_xml_hoja, xml_nuevo, celdas_modificadas, filas_nuevas), o None si hay que
+    reescribir la hoja completa (sin snapshot, archivo modificado por fuera, columnas distintas,
+    filas eliminadas o reordenadas, o contenido que no se sabe parchear).
+    """
+    ruta_excel_bd = Path(ruta_excel_bd)
+    snapshot = snapshots_bd_maestra_excel.get(ruta_excel_bd)
+    if snapshot is None or snapshot["fila_por_etiqueta"] is None or not ruta_excel_bd.exists():
+        return None
+    estado_archivo = ruta_excel_bd.stat()
+    if (estado_archivo.st_mtime_ns, estado_archivo.st_size) != snapshot["firma_archivo"]:
+        print("    - El Excel de la BD Maestra cambió fuera de este proceso. Se reescribirá completo.")
+        return None
+
+    columnas = [str(col) for col in df_listo_guardar.columns]
+    if columnas != snapshot["columnas_hoja"] or not df_listo_guardar.index.is_unique:
+        return None
+
+    # Las filas existentes deben conservar su posición en la hoja y las nuevas ir después
+    num_existentes = len(snapshot["fila_por_etiqueta"])
+    if len(df_listo_guardar) < num_existentes:
+        return None
+    filas_en_hoja = snapshot["fila_por_etiqueta"].reindex(df_listo_guardar.index)
+    if filas_en_hoja.iloc[:num_existentes].isna().any() or filas_en_hoja.iloc[num_existentes:].notna().any():
+        return None
+    if filas_en_hoja.iloc[:num_existentes].astype(int).tolist() != list(range(num_existentes)):
+        return None
+    if id_column_name in df_listo_guardar.columns:
+        ids_nuevos = [_valor_celda_bd(v) for v in df_listo_guardar[id_column_name].iloc[:num_existentes].tolist()]
+        if ids_nuevos != snapshot["valores"][id_column_name]:
+            return None
+
+    # --- Diferencias respecto al snapshot: {fila_hoja: {num_columna: valor}} ---
+    cambios_por_fila = {}
+    for num_col, col_name in enumerate(columnas, start=1):
+        anteriores = snapshot["valores"][col_name]
+        nuevos = df_listo_guardar[col_name].iloc[:num_existentes].tolist()
+        for pos, (anterior, nuevo) in enumerate(zip(anteriores, nuevos)):
+            nuevo = _valor_celda_bd(nuevo)
+            if nuevo != anterior:
+                cambios_por_fila.setdefault(pos + 2, {})[num_col] = nuevo
+    celdas_modificadas = sum(len(c) for c in cambios_por_fila.values())
+
+    filas_nuevas_xml = []
+    for pos, valores in enumerate(df_listo_guardar.iloc[num_existentes:].itertuples(index=False, name=None)):
+        num_fila = num_existentes + 2 + pos
+        celdas_xml = []
+        for num_col, valor in enumerate(valores, start=1):
+            valor = _valor_celda_bd(valor)
+            if valor is None:
+                continue
+            celda_xml = _celda_xml_bd(f"{get_column_letter(num_col)}{num_fila}", valor)
+            if celda_xml is None:
+                return None
+            celdas_xml.append(celda_xml)
+        filas_nuevas_xml.append(f'<row r="{num_fila}">{"".join(celdas_xml)}</row>')
+
+    # --- Aplicar sobre el XML de la hoja ---
+    try:
+        with zipfile.ZipFile(ruta_excel_bd) as zip_libro:
+            parte_hoja = _parte_xml_de_hoja(zip_libro, sheet_name_bd)
+            if parte_hoja is None:
+                return None
+            xml_hoja = zip_libro.read(parte_hoja)
+    except (zipfile.BadZipFile, KeyError, ET.ParseError):
+        return None
+    if xml_hoja.count(b"</sheetData>") != 1:
+        return None
+
+    partes, ultimo_corte, ultima_fila = [], 0, 0
+    for fila in PATRON_FILA_XLSX.finditer(xml_hoja):
+        ultima_fila = int(fila.group(1))
+        if ultima_fila in cambios_por_fila:
+            fila_parcheada = _parchear_fila_xml(fila.group(0).decode("utf-8"), ultima_fila, cambios_por_fila[ultima_fila])
+            if fila_parcheada is None:
+                return None
+            partes.append(xml_hoja[ultimo_corte:fila.start()])
+            partes.append(fila_parcheada.encode("utf-8"))
+            ultimo_corte = fila.end()
+    # La hoja no debe tener filas (aunque sea vacías) después de los registros conocidos
+    if ultima_fila != num_existentes + 1:
+        return None
+    if filas_nuevas_xml:
+        fin_datos = xml_hoja.index(b"</sheetData>")
+        partes.append(xml_hoja[ultimo_corte:fin_datos])
+        partes.append("".join(filas_nuevas_xml).encode("utf-8"))
+        ultimo_corte = fin_datos
+    partes.append(xml_hoja[ultimo_corte:])
+    xml_nuevo = b"".join(partes)
+
+    if filas_nuevas_xml:
+        ultima_fila_nueva = num_existentes + 1 + len(filas_nuevas_xml)
+        xml_nuevo = re.sub(
+            rb'(<dimension ref="[A-Z]+\d+:[A-Z]+)\d+(")',
+            lambda m: m.group(1) + str(ultima_fila_nueva).encode() + m.group(2),
+            xml_nuevo, count=1
+        )
+    return parte_hoja, xml_nuevo, celdas_modificadas, len(filas_nuevas_xml)
+
+def escribir_parche_bd_maestra_excel(ruta_excel_bd, parte_hoja, xml_nuevo):
+    """Reescribe el .xlsx sustituyendo solo el XML de la hoja; el resto de partes se copian tal cual."""
+    ruta_excel_bd = Path(ruta_excel_bd)
+    ruta_temporal = ruta_excel_bd.with_name(ruta_excel_bd.name + ".tmp")
+    try:
+        with zipfile.ZipFile(ruta_excel_bd) as zip_origen, zipfile.ZipFile(ruta_temporal, "w", zipfile.ZIP_DEFLATED) as zip_destino:
+            for item in zip_origen.infolist():
+                datos = xml_nuevo if item.filename == parte_hoja else zip_origen.read(item.filename)
+                zip_destino.writestr(item, datos)
+        os.replace(ruta_temporal, ruta_excel_bd)
+    finally:
+        if ruta_temporal.exists():
+            ruta_temporal.unlink()
+
+def guardar_bd_maestra_unificada(df_a_guardar, mode_config, is_test_mode=False, processed_ids_in_batch=None, forzar_excel=False):
     """
     [VERSIÓN FINAL CON ORDENAMIENTO POR ID] Guarda el DataFrame en el archivo Excel local.
     Incluye un ordenamiento final y robusto por la columna ID para asegurar la consistencia del lote.
     También preserva columnas extra que puedan existir en el Excel (ej. 'MOVIMIENTO').
+    Si el modo usa el almacén SQLite (y no se pide forzar_excel), se guarda ahí y el Excel
+    se genera solo bajo demanda (exportar_bd_maestra_sqlite_a_excel).
     """
     global excel_lock
     if is_test_mode:
         print(f"    - [MODO PRUEBA] Guardado de BD para '{mode_config['mode_name']}' OMITIDO.")
         return True
 
+    if mode_config.get("usar_bd_sqlite") and not forzar_excel:
+        return guardar_bd_maestra_sqlite(df_a_guardar, mode_config)
+
     ruta_excel_bd = Path(mode_config["master_db_file_path"])
     sheet_name_bd = "BD_Maestra"
     defined_columns = mode_config["db_master_columns"]
@@ -642,14 +1215,24 @@ def guardar_bd_maestra_unificada(df_a_guardar, mode_config, is_test_mode=False,
             ### FIN: LÓGICA DE ORDENAMIENTO FINAL POR ID ###
 
             # --- 3. Preparación del Archivo Excel ---
-            book = load_workbook(ruta_excel_bd) if ruta_excel_bd.exists() else Workbook()
-            ws = book[sheet_name_bd] if sheet_name_bd in book.sheetnames else book.create_sheet(title=sheet_name_bd)
-            ws.delete_rows(1, ws.max_row + 1)
-            for r in dataframe_to_rows(df_listo_guardar, index=False, header=True):
-                cleaned_row = [None if pd.isna(value) else value for value in r]
-                ws.append(cleaned_row)
-            if "Sheet" in book.sheetnames and sheet_name_bd != "Sheet":
-                del book["Sheet"]
+            # Primero se intenta parchear solo lo que cambió; si no se puede, se reescribe la hoja completa.
+            parche = None
+            if BD_MAESTRA_GUARDADO_INCREMENTAL:
+                parche = preparar_parche_bd_maestra_excel(ruta_excel_bd, sheet_name_bd, df_listo_guardar, mode_config["col_expediente"])
+            if parche is not None:
+                parte_hoja, xml_hoja_nuevo, celdas_modificadas, filas_nuevas = parche
+                print(f"    - Guardado incremental: {celdas_modificadas} celda(s) modificadas, {filas_nuevas} fila(s) nuevas.")
+                escribir_libro = lambda: escribir_parche_bd_maestra_excel(ruta_excel_bd, parte_hoja, xml_hoja_nuevo)
+            else:
+                book = load_workbook(ruta_excel_bd) if ruta_excel_bd.exists() else Workbook()
+                ws = book[sheet_name_bd] if sheet_name_bd in book.sheetnames else book.create_sheet(title=sheet_name_bd)
+                ws.delete_rows(1, ws.max_row + 1)
+                for r in dataframe_to_rows(df_listo_guardar, index=False, header=True):
+                    cleaned_row = [None if pd.isna(value) else value for value in r]
+                    ws.append(cleaned_row)
+                if "Sheet" in book.sheetnames and sheet_name_bd != "Sheet":
+                    del book["Sheet"]
+                escribir_libro = lambda: book.save(ruta_excel_bd)
 
             # --- 4. Bucle de Guardado, Reintento y Subida (sin cambios) ---
             max_retries = 3
@@ -657,8 +1240,9 @@ def guardar_bd_maestra_unificada(df_a_guardar, mode_config, is_test_mode=False,
             while True:
                 for intento in range(max_retries):
                     try:
-                        book.save(ruta_excel_bd)
+                        escribir_libro()
                         print(f"\n    -> BD Maestra local guardada exitosamente.")
+                        registrar_snapshot_bd_maestra_excel(ruta_excel_bd, df_listo_guardar)
                         
                         if not is_test_mode:
                             subir_archivo_al_servidor(ruta_excel_bd, mode_config)
@@ -741,13 +1325,88 @@ def cargar_config_columnas_xlsx(mode_config):
     print(f"    - (!) Error: {error_msg}")
     return None, None, None
 
+def _hash_archivo(filepath, tamano_bloque=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for bloque in iter(lambda: f.read(tamano_bloque), b""):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+def _rutas_cache_datos_principales(mode_config, filepath):
+    carpeta_cache = Path(mode_config["base_path"]) / CACHE_DATOS_DIRNAME
+    return carpeta_cache / f"{filepath.stem}.feather", carpeta_cache / f"{filepath.stem}.json"
+
+def leer_cache_datos_principales(mode_config, filepath, nombres_columnas_config):
+    """
+    Devuelve el DataFrame de la caché Feather si corresponde al archivo actual, o None.
+    Si tamaño y fecha de modificación coinciden, se usa directamente; si solo cambió la fecha
+    (archivo copiado o guardado sin cambios), se compara el hash del contenido.
+    """
+    if not PYARROW_INSTALLED:
+        return None
+    ruta_feather, ruta_meta = _rutas_cache_datos_principales(mode_config, filepath)
+    if not ruta_feather.exists() or not ruta_meta.exists():
+        return None
+    try:
+        meta = json.loads(ruta_meta.read_text(encoding="utf-8"))
+        estado_archivo = filepath.stat()
+        if meta.get("version") != CACHE_DATOS_VERSION or meta.get("columnas") != list(nombres_columnas_config):
+            return None
+        if meta.get("tamano") != estado_archivo.st_size:
+            return None
+        if meta.get("mtime_ns") != estado_archivo.st_mtime_ns:
+            if meta.get("sha256") != _hash_archivo(filepath):
+                return None
+            meta["mtime_ns"] = estado_archivo.st_mtime_ns
+            ruta_meta.write_text(json.dumps(meta), encoding="utf-8")
+        df_datos = pd.read_feather(ruta_feather)
+        if list(df_datos.columns) != list(nombres_columnas_config):
+            return None
+        return df_datos
+    except Exception as e_cache:
+        print(f"      - (*) Advertencia: No se pudo usar la caché de '{filepath.name}'. Se leerá el Excel. Error: {e_cache}")
+        return None
+
+def guardar_cache_datos_principales(mode_config, filepath, nombres_columnas_config, df_datos, firma_lectura):
+    """Guarda la lectura en Feather junto con la firma (tamaño, mtime, hash) del Excel del que salió."""
+    if not PYARROW_INSTALLED:
+        return
+    ruta_feather, ruta_meta = _rutas_cache_datos_principales(mode_config, filepath)
+    try:
+        estado_archivo = filepath.stat()
+        tamano, mtime_ns, sha256 = firma_lectura
+        if (estado_archivo.st_size, estado_archivo.st_mtime_ns) != (tamano, mtime_ns):
+            return # El Excel cambió mientras se leía; no se cachea esta lectura
+        ruta_feather.parent.mkdir(parents=True, exist_ok=True)
+        ruta_temporal = ruta_feather.with_name(ruta_feather.name + ".tmp")
+        df_datos.reset_index(drop=True).to_feather(ruta_temporal)
+        os.replace(ruta_temporal, ruta_feather)
+        meta = {
+            "version": CACHE_DATOS_VERSION,
+            "tamano": tamano,
+            "mtime_ns": mtime_ns,
+            "sha256": sha256,
+            "columnas": list(nombres_columnas_config),
+        }
+        ruta_meta.write_text(json.dumps(meta), encoding="utf-8")
+    except Exception as e_cache:
+        print(f"      - (*) Advertencia: No se pudo guardar la caché de '{filepath.name}'. Error: {e_cache}")
+
 def cargar_datos_principales_xlsx(mode_config, nombres_columnas_config):
     filepath = Path(mode_config["data_file_path"])
     print(f"    - Leyendo datos principales desde: {filepath.name}")
     if not nombres_columnas_config:
         print("    - (!) Error: No se proporcionaron nombres de columna desde la configuración. No se puede leer el archivo de datos principal.")
         return None
+    df_cache = leer_cache_datos_principales(mode_config, filepath, nombres_columnas_config) if filepath.exists() else None
+    if df_cache is not None:
+        print(f"      - Datos principales leídos desde la caché de '{filepath.name}'. {len(df_cache)} filas cargadas.")
+        return df_cache
     try:
+        firma_lectura = None
+        if PYARROW_INSTALLED and filepath.exists():
+            estado_archivo = filepath.stat()
+            firma_lectura = (estado_archivo.st_size, estado_archivo.st_mtime_ns, _hash_archivo(filepath))
         df_datos = pd.read_excel(
             filepath,
             header=None, 
@@ -759,6 +1418,8 @@ def cargar_datos_principales_xlsx(mode_config, nombres_columnas_config):
         )
         df_datos = df_datos.fillna("")
         print(f"      - Datos principales leídos desde '{filepath.name}'. {len(df_datos)} filas cargadas.")
+        if firma_lectura is not None:
+            guardar_cache_datos_principales(mode_config, filepath, nombres_columnas_config, df_datos, firma_lectura)
         return df_datos
     except FileNotFoundError:
         print(f"    - (!) Error: Archivo de datos principal '{filepath}' no encontrado.")
@@ -815,22 +1476,23 @@ def actualizar_bd_maestra_interactivo(config_modo):
     if not ids_para_actualizar:
         print("No se ingresaron IDs."); return
 
-    actualizados_count = 0
     no_encontrados_origen = []
+    registros_para_actualizar = []
 
     print("\n--- Iniciando Proceso de Actualización ---")
-    df_maestra_para_actualizar = df_maestra.copy()
+    # Agrupar el origen por ID una sola vez en lugar de filtrarlo completo por cada ID solicitado
+    posiciones_origen_por_id = df_origen.groupby(llave_principal_origen, sort=False).indices
 
     for id_valor in ids_para_actualizar:
         # Buscar el registro en el archivo de origen
-        datos_origen_encontrados = df_origen[df_origen[llave_principal_origen] == id_valor]
-        if datos_origen_encontrados.empty:
+        posiciones_origen = posiciones_origen_por_id.get(id_valor)
+        if posiciones_origen is None or len(posiciones_origen) == 0:
             print(f"  - (!) Advertencia: '{id_valor}' no fue encontrado en el archivo de Origen. Se omitirá.")
             no_encontrados_origen.append(id_valor)
             continue
         
         print(f"  - Encontrado: {id_valor}. Preparando actualización...")
-        fila_origen = datos_origen_encontrados.iloc[0]
+        fila_origen = df_origen.iloc[posiciones_origen[0]]
         
         # Preparar diccionario para la actualización.
         registro_para_actualizar = {llave_principal_maestra: id_valor}
@@ -842,7 +1504,7 @@ def actualizar_bd_maestra_interactivo(config_modo):
         
         # Lógica específica para MULTAS (cálculos)
         if config_modo['mode_type'] == "MULTAS":
-            num_registros = len(datos_origen_encontrados)
+            num_registros = len(posiciones_origen)
             num_hojas = math.ceil(num_registros / 15) # Asumiendo 15 registros por hoja
             registro_para_actualizar['REGISTROS EN BD GENERACION'] = num_registros
             registro_para_actualizar['HOJAS POR DOCUMENTO'] = num_hojas
@@ -852,20 +1514,22 @@ def actualizar_bd_maestra_interactivo(config_modo):
         registro_para_actualizar['ESTADO'] = "Actualizado Manualmente"
         registro_para_actualizar['FECHA IMPRESION'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-        # Aplicar la actualización al DataFrame
-        df_maestra_para_actualizar = actualizar_o_agregar_registro_bd_unificada(
-            df_maestra_para_actualizar, registro_para_actualizar, config_modo
-        )
-        actualizados_count += 1
+        registros_para_actualizar.append(registro_para_actualizar)
 
-    # 4. Guardar los cambios si hubo actualizaciones
+    actualizados_count = len(registros_para_actualizar)
+
+    # 4. Aplicar todos los cambios en un solo upsert y guardar si hubo actualizaciones
     if actualizados_count > 0:
         print(f"\nSe actualizarán {actualizados_count} registro(s).")
+        df_maestra_para_actualizar = upsert_bd_maestra_unificada(
+            df_maestra, pd.DataFrame(registros_para_actualizar), config_modo
+        )
         try:
-            # Crear un backup antes de sobrescribir
-            backup_path = ruta_maestra.with_suffix(f'.{datetime.now().strftime("%Y%m%d_%H%M%S")}.bak')
+            # Crear un backup antes de sobrescribir (del almacén SQLite si es la copia autoritativa)
+            ruta_a_respaldar = Path(config_modo["master_db_sqlite_path"]) if config_modo.get("usar_bd_sqlite") else ruta_maestra
+            backup_path = ruta_a_respaldar.with_suffix(f'.{datetime.now().strftime("%Y%m%d_%H%M%S")}.bak')
             print(f"Creando backup de la BD Maestra en: '{backup_path.name}'")
-            shutil.copy(ruta_maestra, backup_path)
+            shutil.copy(ruta_a_respaldar, backup_path)
 
             print(f"Guardando cambios en '{ruta_maestra.name}'...")
             # Llamamos a la función de guardado unificada
@@ -944,6 +1608,8 @@ def detectar_modos_disponibles():
                 current_mode_config["pm_file_path"] = pm_file
                 current_mode_config["template_file_path"] = template_file
                 current_mode_config["master_db_file_path"] = master_db_file
+                current_mode_config["master_db_sqlite_path"] = master_db_file.with_suffix(".sqlite")
+                current_mode_config["usar_bd_sqlite"] = BD_MAESTRA_USAR_SQLITE
                 current_mode_config["output_docs_path"] = base_path_modo / current_mode_config["output_docs_folder_name"]
 
                 if mode_type_detected == "PREDIAL":
@@ -959,6 +1625,7 @@ def detectar_modos_disponibles():
                     # --- NUEVAS CONFIGURACIONES PARA EL RECORTE DE OCR PREDIA ---
                     # General
                     current_mode_config["ocr_zoom_factor_predial"] = 2.5 # Puedes probar con 2.0, 2.5 o 3.0
+                    current_mode_config["ocr_zoom_rapido_predial"] = 1.5 # Pase rápido del OCR adaptativo; si no halla el expediente se repite con el zoom anterior
 
                     # Para la parte SUPERIOR (donde está "EXP 84425002")
                     current_mode_config["ocr_predial_top_start_y_perc"] = 0.05  # Empezar a buscar desde el 5% de la altura (para evitar el borde mismo)
@@ -1513,6 +2180,8 @@ def sub_menu_acciones_modo(mode_config):
         print("\n  ACCIONES DE MANTENIMIENTO:")
         print(f"  A. Actualizar Registros en BD Maestra (Interactivo)")
         print(f"  U. Subir BD Maestra de este modo al Servidor")
+        if mode_config.get("usar_bd_sqlite"):
+            print(f"  E. Exportar BD Maestra (SQLite) a Excel")
         if mode_config["mode_type"] == "MULTAS":
              print(f"  R. Crear Reporte de Despachos (Maldonado Gallardo)")
              print(f"  F. Revisar Estado de Impresión de Flotillas")
@@ -1543,8 +2212,19 @@ def sub_menu_acciones_modo(mode_config):
         elif opcion_accion == 'A':
             actualizar_bd_maestra_interactivo(mode_config)
             continue
+        elif opcion_accion == 'E' and mode_config.get("usar_bd_sqlite"):
+            # La exportación guarda el Excel y lo sube al servidor
+            if exportar_bd_maestra_sqlite_a_excel(mode_config):
+                print("  -> Exportación finalizada.")
+            input("    Presione Enter para continuar...");
+            continue
         elif opcion_accion == 'U':
             print(f"\n  Subiendo Base de Datos Maestra para {mode_config['mode_name']}...")
+            if mode_config.get("usar_bd_sqlite"):
+                # El Excel del servidor se genera desde el almacén SQLite (la exportación también lo sube)
+                exportar_bd_maestra_sqlite_a_excel(mode_config)
+                input("    Presione Enter para continuar...");
+                continue
             ruta_bd_maestra_local = Path(mode_config.get("master_db_file_path"))
             if ruta_bd_maestra_local.exists():
                 subir_archivo_al_servidor(ruta_bd_maestra_local, mode_config)
@@ -1571,6 +2251,101 @@ def sub_menu_acciones_modo(mode_config):
             process_selected_mode_action(mode_config, modo_accion_solicitada)
 
 
+class SesionSFTPServidor:
+    """
+    Sesión SFTP de larga duración compartida por todas las subidas.
+
+    La conexión se abre en la primera subida y se reutiliza; los directorios remotos que ya
+    se comprobaron o crearon se recuerdan para no repetir stat/mkdir. Si la sesión se cae,
+    se reconecta y se reintenta la subida una vez.
+    """
+
+    def __init__(self, host, port, usuario, password, timeout=SFTP_TIMEOUT, conectar=None):
+        self.host = host
+        self.port = port
+        self.usuario = usuario
+        self.password = password
+        self.timeout = timeout
+        # `conectar` permite sustituir la conexión (debe devolver (ssh, sftp))
+        self._conectar = conectar or self._conectar_paramiko
+        self._lock = threading.Lock()
+        self._ssh = None
+        self._sftp = None
+        self._directorios_existentes = set()
+
+    def _conectar_paramiko(self):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(self.host, port=self.port, username=self.usuario, password=self.password, timeout=self.timeout)
+        return ssh, ssh.open_sftp()
+
+    def _sesion_activa(self):
+        if self._sftp is None or self._ssh is None:
+            return False
+        transporte = self._ssh.get_transport()
+        return transporte is not None and transporte.is_active()
+
+    def _obtener_sftp(self):
+        if not self._sesion_activa():
+            self._cerrar_sesion()
+            print(f"      - Abriendo sesión SFTP con {self.host}:{self.port}...")
+            self._ssh, self._sftp = self._conectar()
+        return self._sftp
+
+    def _cerrar_sesion(self):
+        for recurso in (self._sftp, self._ssh):
+            if recurso is not None:
+                try:
+                    recurso.close()
+                except Exception:
+                    pass
+        self._ssh = None
+        self._sftp = None
+
+    def _asegurar_directorio(self, sftp, directorio_remoto):
+        """Crea los componentes del directorio que falten, consultando solo los no conocidos."""
+        directorio_remoto = directorio_remoto.rstrip('/') or '/'
+        if directorio_remoto in self._directorios_existentes:
+            return
+        ruta_acumulada = ''
+        for parte in directorio_remoto.strip('/').split('/'):
+            if not parte: continue
+            ruta_acumulada += '/' + parte
+            if ruta_acumulada in self._directorios_existentes:
+                continue
+            try:
+                sftp.stat(ruta_acumulada)
+            except FileNotFoundError:
+                print(f"      - Creando directorio remoto: {ruta_acumulada}/")
+                sftp.mkdir(ruta_acumulada)
+            self._directorios_existentes.add(ruta_acumulada)
+
+    def subir(self, ruta_local, ruta_remota):
+        """Sube un archivo creando los directorios remotos necesarios; reconecta una vez si falla."""
+        directorio_remoto = posixpath.dirname(ruta_remota)
+        with self._lock:
+            for intento in (1, 2):
+                try:
+                    sftp = self._obtener_sftp()
+                    if directorio_remoto:  # Ruta sin directorio: se sube al directorio actual de la sesión
+                        self._asegurar_directorio(sftp, directorio_remoto)
+                    sftp.put(str(ruta_local), ruta_remota)
+                    return
+                except Exception as e:
+                    if intento == 2:
+                        raise
+                    # Sesión caída o directorio borrado en el servidor: se empieza de cero
+                    print(f"      - (*) Fallo en la sesión SFTP ({e}); reconectando...")
+                    self._cerrar_sesion()
+                    self._directorios_existentes.clear()
+
+    def cerrar(self):
+        with self._lock:
+            self._cerrar_sesion()
+
+sesion_sftp_servidor = SesionSFTPServidor(SFTP_HOST, SFTP_PORT, SFTP_USUARIO, SFTP_PASSWORD)
+atexit.register(sesion_sftp_servidor.cerrar)
+
 def subir_archivo_al_servidor(ruta_local_archivo, config_modo):
     """
     Sube un archivo a una carpeta remota, creando la estructura de subdirectorios
@@ -1600,30 +2375,8 @@ def subir_archivo_al_servidor(ruta_local_archivo, config_modo):
     print(f"      -> Destino: '{ruta_remota_log}'")
 
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect("asesorescloud.ddns.net", port=58123, username="afc", password="asesores", timeout=10)
-        sftp = ssh.open_sftp()
-        
-        # 4. NUEVO: Asegurarse de que el directorio remoto exista, creándolo si es necesario.
-        directorio_remoto_padre = archivo_remoto_path.parent
-        
-        partes_ruta = directorio_remoto_padre.as_posix().strip('/').split('/')
-        ruta_acumulada = '/'
-        for parte in partes_ruta:
-            if not parte: continue
-            ruta_acumulada += parte + '/'
-            try:
-                sftp.stat(ruta_acumulada)
-            except FileNotFoundError:
-                print(f"      - Creando directorio remoto: {ruta_acumulada}")
-                sftp.mkdir(ruta_acumulada)
-
-        # 5. Subir el archivo al destino final.
-        sftp.put(str(ruta_local_archivo), archivo_remoto_path.as_posix())
-        
-        sftp.close()
-        ssh.close()
+        # 4. Subir por la sesión compartida, que crea los directorios remotos que falten.
+        sesion_sftp_servidor.subir(ruta_local_archivo, archivo_remoto_path.as_posix())
         print(f"    -> Archivo subido exitosamente.")
         return True
     except Exception as e:
@@ -1650,7 +2403,10 @@ def sincronizar_todo_con_servidor():
         
         # 1. Sincronizar el archivo de la Base de Datos Maestra
         ruta_maestra_local = config_modo.get("master_db_file_path")
-        if ruta_maestra_local and ruta_maestra_local.exists():
+        if config_modo.get("usar_bd_sqlite"):
+            # El Excel se regenera desde el almacén SQLite y la exportación lo sube
+            exportar_bd_maestra_sqlite_a_excel(config_modo)
+        elif ruta_maestra_local and ruta_maestra_local.exists():
             print(f"  - Encontrado: {ruta_maestra_local.name}")
             subir_archivo_al_servidor(ruta_maestra_local, config_modo)
         else:
@@ -0,0 +1,609 @@
+# GOBIERNO/ocr_escaneo.py
+"""
+Motor de OCR compartido por los flujos de escaneo de Multas y Predial.
+
+pytesseract lanza un proceso 'tesseract' por cada llamada, que vuelve a cargar el modelo 'spa'
+y lee la imagen desde un archivo temporal. Aquí se mantiene un motor de Tesseract ya
+inicializado en memoria (tesserocr, enlace a la API en C) por hilo/proceso y por combinación
+de idioma y configuración, y se le pasan los píxeles directamente.
+Si tesserocr no está instalado o no puede inicializarse, se usa pytesseract como antes.
+También se encarga del código QR con el ID que se puede estampar en los documentos generados y
+que el escaneo lee antes de recurrir al OCR.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing
+from pathlib import Path
+
+try:
+    import tesserocr
+    TESSEROCR_INSTALLED = True
+except ImportError:
+    TESSEROCR_INSTALLED = False
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+try:
+    import fitz # PyMuPDF
+    from PIL import Image, ImageFilter
+except ImportError:
+    fitz = None
+    Image = None
+    ImageFilter = None
+
+try:
+    import zxingcpp # Genera y lee el código de identificación impreso en los documentos
+    ZXING_INSTALLED = True
+except ImportError:
+    ZXING_INSTALLED = False
+
+# El CLI de tesseract termina el texto de cada página con este separador (page_separator);
+# se añade al resultado del motor en memoria para que el texto sea idéntico al de pytesseract.
+SEPARADOR_PAGINA_TESSERACT = "\f"
+# Modo de segmentación por defecto del CLI de tesseract (PSM_AUTO)
+PSM_POR_DEFECTO = 3
+# Bytes por píxel de los modos de imagen que se pasan al motor sin conversión
+BYTES_POR_PIXEL_MODO = {"L": 1, "RGB": 3, "RGBA": 4}
+
+_motores_por_hilo = threading.local()
+_estado_lock = threading.Lock()
+_motor_en_memoria_deshabilitado = False
+
+
+def _ruta_tessdata():
+    """Carpeta 'tessdata' a usar: TESSDATA_PREFIX, o la junto al tesseract.exe configurado en pytesseract."""
+    prefijo = os.environ.get("TESSDATA_PREFIX")
+    if prefijo:
+        return prefijo
+    tesseract_cmd = getattr(getattr(pytesseract, "pytesseract", None), "tesseract_cmd", "") if pytesseract else ""
+    if tesseract_cmd and Path(tesseract_cmd).is_file():
+        candidato = Path(tesseract_cmd).parent / "tessdata"
+        if candidato.is_dir():
+            return str(candidato)
+    return None # tesserocr usa su ruta por defecto
+
+
+def _interpretar_config(config):
+    """
+    Traduce la cadena 'config' de pytesseract a (psm, variables).
+    Devuelve None si trae opciones que el motor en memoria no sabe reproducir.
+    """
+    psm = PSM_POR_DEFECTO
+    variables = {}
+    tokens = (config or "").split()
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == "--psm" and i + 1 < len(tokens) and tokens[i + 1].isdigit():
+            psm = int(tokens[i + 1])
+        elif tokens[i] == "-c" and i + 1 < len(tokens) and "=" in tokens[i + 1]:
+            nombre, valor = tokens[i + 1].split("=", 1)
+            variables[nombre] = valor
+        else:
+            return None
+        i += 2
+    return psm, variables
+
+
+def _obtener_motor(lang, psm, variables):
+    """Motor inicializado para este hilo y esta configuración (se crea la primera vez)."""
+    motores = getattr(_motores_por_hilo, "motores", None)
+    if motores is None:
+        motores = _motores_por_hilo.motores = {}
+    clave = (lang, psm, tuple(sorted(variables.items())))
+    motor = motores.get(clave)
+    if motor is None:
+        kwargs = {"lang": lang, "psm": psm}
+        ruta_tessdata = _ruta_tessdata()
+        if ruta_tessdata:
+            kwargs["path"] = ruta_tessdata
+        motor = tesserocr.PyTessBaseAPI(**kwargs)
+        for nombre, valor in variables.items():
+            if not motor.SetVariable(nombre, valor):
+                motor.End()
+                raise RuntimeError(f"Variable de Tesseract no válida: {nombre}={valor}")
+        motores[clave] = motor
+    return motor
+
+
+def _deshabilitar_motor_en_memoria(error):
+    global _motor_en_memoria_deshabilitado
+    with _estado_lock:
+        if not _motor_en_memoria_deshabilitado:
+            _motor_en_memoria_deshabilitado = True
+            print(f"        - (*) Advertencia: No se pudo inicializar Tesseract en memoria (tesserocr). Se usará pytesseract. Error: {error}")
+
+
+def motor_en_memoria_disponible():
+    return TESSEROCR_INSTALLED and not _motor_en_memoria_deshabilitado
+
+
+def descripcion_motor_ocr():
+    """Texto para el log: qué motor de OCR se va a usar."""
+    if motor_en_memoria_disponible():
+        try:
+            _obtener_motor("spa", PSM_POR_DEFECTO, {})
+            return f"Tesseract en memoria (tesserocr, Tesseract {tesserocr.tesseract_version().split()[1]})"
+        except Exception as e_init:
+            _deshabilitar_motor_en_memoria(e_init)
+    return "pytesseract (un proceso por llamada)"
+
+
+def imagen_a_texto(img, lang="spa", config=""):
+    """
+    Equivalente a pytesseract.image_to_string(img, lang=lang, config=config).
+    Usa el motor en memoria si está disponible y la configuración es reproducible; si no, pytesseract.
+    """
+    if motor_en_memoria_disponible():
+        opciones = _interpretar_config(config)
+        if opciones is not None:
+            try:
+                motor = _obtener_motor(lang, *opciones)
+            except Exception as e_init:
+                _deshabilitar_motor_en_memoria(e_init)
+            else:
+                try:
+                    bytes_por_pixel = BYTES_POR_PIXEL_MODO.get(img.mode)
+                    if bytes_por_pixel:
+                        # Píxeles crudos, sin resolución: igual que el PNG temporal que lee el CLI
+                        ancho, alto = img.size
+                        motor.SetImageBytes(img.tobytes(), ancho, alto, bytes_por_pixel, ancho * bytes_por_pixel)
+                    else:
+                        motor.SetImage(img)
+                        motor.SetSourceResolution(0)
+                    return motor.GetUTF8Text() + SEPARADOR_PAGINA_TESSERACT
+                except Exception as e_ocr:
+                    print(f"        - (*) Advertencia: Falló el OCR en memoria; se reintenta con pytesseract. Error: {e_ocr}")
+    if pytesseract is None:
+        raise ImportError("Ni tesserocr ni pytesseract están disponibles para OCR.")
+    return pytesseract.image_to_string(img, lang=lang, config=config)
+
+
+# --- Render de regiones de interés ---
+def renderizar_franja_gris(pagina_obj, zoom, y_inicio_perc, y_fin_perc):
+    """
+    Rasteriza solo la franja horizontal [y_inicio_perc, y_fin_perc) de la página (fracciones de su
+    altura), directamente en escala de grises. Los límites en píxeles son los mismos que al
+    renderizar la página completa con ese zoom y recortarla con PIL (en páginas escaneadas solo
+    cambia la interpolación de la imagen en unos pocos niveles de gris), sin rasterizar ni guardar
+    en memoria el resto de la página.
+    """
+    mat = fitz.Matrix(zoom, zoom)
+    rect_pagina = pagina_obj.rect
+    alto_px = (rect_pagina * mat).irect.height
+    y_inicio_px = int(alto_px * y_inicio_perc)
+    y_fin_px = alto_px if y_fin_perc >= 1 else int(alto_px * y_fin_perc)
+
+    if pagina_obj.rotation:
+        # Con páginas rotadas el clip no se traduce directo a filas de píxeles: render completo y recorte
+        pix = pagina_obj.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, alpha=False)
+        img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+        return img.crop((0, y_inicio_px, img.width, y_fin_px))
+
+    clip = fitz.Rect(rect_pagina.x0, rect_pagina.y0 + y_inicio_px / zoom, rect_pagina.x1, rect_pagina.y0 + y_fin_px / zoom)
+    pix = pagina_obj.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, alpha=False, clip=clip)
+    return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+
+def texto_de_franja(pagina_obj, y_inicio_perc, y_fin_perc):
+    """
+    Texto de la capa de texto del PDF dentro de la misma franja que se pasaría al OCR.
+    Los PDF generados digitalmente (o escaneados con OCR incrustado) ya traen el texto, y
+    leerlo es mucho más barato que rasterizar y pasar Tesseract. Devuelve "" si la página no
+    tiene capa de texto en esa franja.
+    """
+    if pagina_obj.rotation:
+        return "" # La franja está definida sobre la página tal como se ve; se deja al OCR
+    try:
+        rect_pagina = pagina_obj.rect
+        alto = rect_pagina.height
+        clip = fitz.Rect(rect_pagina.x0, rect_pagina.y0 + alto * y_inicio_perc, rect_pagina.x1, rect_pagina.y0 + alto * min(y_fin_perc, 1.0))
+        return pagina_obj.get_text("text", clip=clip)
+    except Exception:
+        return ""
+
+
+# --- Código de identificación impreso (QR) ---
+# Con GOB_ESTAMPAR_CODIGO_ID=1 los documentos generados llevan en cada página un QR pequeño en la
+# esquina inferior izquierda con "GOBID|<MODO>|<ID>". Al escanear se busca primero ese código (mucho
+# más rápido y fiable que el OCR) y solo si no aparece se sigue con la capa de texto y el OCR.
+ESTAMPAR_CODIGO_ID = os.environ.get("GOB_ESTAMPAR_CODIGO_ID", "0").strip().lower() in ("1", "true", "si", "sí")
+PREFIJO_CODIGO_ID = "GOBID"
+LADO_CODIGO_ID_PT = 50 # ~18 mm: se sigue leyendo en escaneos de 150 dpi algo girados y con ruido
+MARGEN_CODIGO_ID_PT = 14 # ~5 mm desde los bordes de la hoja
+ESCALA_IMAGEN_CODIGO_ID = 4 # píxeles por módulo del QR en la imagen insertada
+# Franja inferior de la página donde se busca el código al escanear, y zoom del render
+REGION_LECTURA_CODIGO_ID = (0.82, 1.0)
+ZOOM_LECTURA_CODIGO_ID = 2.5
+
+
+def estampar_codigo_id_pdf(ruta_pdf, modo, id_documento):
+    """
+    Inserta en todas las páginas del PDF el QR con el ID del documento (guardado incremental).
+    Devuelve True si se estampó; si zxing-cpp no está instalado o falla, avisa y devuelve False.
+    """
+    if not ZXING_INSTALLED:
+        print("        - (*) Advertencia: zxing-cpp no está instalado; no se estampa el código de ID (pip install zxing-cpp).")
+        return False
+    try:
+        codigo = zxingcpp.create_barcode(f"{PREFIJO_CODIGO_ID}|{modo}|{id_documento}", zxingcpp.BarcodeFormat.QRCode)
+        imagen = memoryview(zxingcpp.write_barcode_to_image(codigo, scale=ESCALA_IMAGEN_CODIGO_ID))
+        alto_px, ancho_px = imagen.shape
+        pix_codigo = fitz.Pixmap(fitz.csGRAY, ancho_px, alto_px, imagen.tobytes(), 0)
+        with fitz.open(str(ruta_pdf)) as doc:
+            for pagina_obj in doc:
+                rect = pagina_obj.rect
+                area = fitz.Rect(
+                    rect.x0 + MARGEN_CODIGO_ID_PT, rect.y1 - MARGEN_CODIGO_ID_PT - LADO_CODIGO_ID_PT,
+                    rect.x0 + MARGEN_CODIGO_ID_PT + LADO_CODIGO_ID_PT, rect.y1 - MARGEN_CODIGO_ID_PT,
+                )
+                # La misma imagen se reutiliza en todas las páginas (PyMuPDF la guarda una sola vez)
+                pagina_obj.insert_image(area, pixmap=pix_codigo)
+            doc.saveIncr()
+        return True
+    except Exception as e_codigo:
+        print(f"        - (*) Advertencia: No se pudo estampar el código de ID {id_documento} en {Path(ruta_pdf).name}: {e_codigo}")
+        return False
+
+
+def leer_codigo_id(pagina_obj, modo):
+    """IDs de los QR de este modo encontrados en la franja inferior de la página ([] si no hay)."""
+    if not ZXING_INSTALLED:
+        return []
+    img = renderizar_franja_gris(pagina_obj, ZOOM_LECTURA_CODIGO_ID, *REGION_LECTURA_CODIGO_ID)
+    ids = []
+    for codigo in zxingcpp.read_barcodes(img, formats=zxingcpp.BarcodeFormat.QRCode):
+        partes = codigo.text.split("|", 2)
+        if len(partes) == 3 and partes[0] == PREFIJO_CODIGO_ID and partes[1] == modo and partes[2] and partes[2] not in ids:
+            ids.append(partes[2])
+    return ids
+
+
+# --- Detección de páginas en blanco ---
+# Una página escaneada en blanco sigue conteniendo una imagen, así que se mira el raster. Solo sirve
+# para saltarse el OCR: no decide si una hoja se descarta del expediente.
+# 1) Miniatura en grises (sin los márgenes, donde el escáner deja sombras y bordes): si hay píxeles
+#    claramente más oscuros que el fondo del papel (la mediana), la página tiene contenido.
+# 2) Si la miniatura parece en blanco, se confirma a más resolución, con un filtro de mediana que
+#    quita el moteado del escáner y un umbral relativo al fondo, para no perder texto muy claro
+#    (en la miniatura una línea gris claro se diluye hasta confundirse con el papel).
+ZOOM_MINIATURA_BLANCO = 0.5
+MARGEN_MINIATURA_BLANCO = 0.05
+DIFERENCIA_TINTA_BLANCO = 40 # niveles de gris por debajo del fondo para contar como tinta en la miniatura
+ZOOM_CONFIRMACION_BLANCO = 1.0
+DIFERENCIA_RELATIVA_TINTA_BLANCO = 0.08 # fracción del nivel del fondo, en la confirmación
+DIFERENCIA_MINIMA_TINTA_BLANCO = 8
+FRACCION_MAX_TINTA_BLANCO = 0.0001
+# Estado de página que devuelven los flujos de escaneo cuando la página se salta el OCR por estar en blanco
+ESTADO_PAGINA_EN_BLANCO = "PAGINA_EN_BLANCO"
+
+
+def _histograma_y_fondo(pagina_obj, zoom, filtrar_moteado=False):
+    """Histograma en grises de la página (sin márgenes) a ese zoom y nivel del fondo (la mediana)."""
+    rect = pagina_obj.rect
+    margen_x = rect.width * MARGEN_MINIATURA_BLANCO
+    margen_y = rect.height * MARGEN_MINIATURA_BLANCO
+    clip = fitz.Rect(rect.x0 + margen_x, rect.y0 + margen_y, rect.x1 - margen_x, rect.y1 - margen_y)
+    pix = pagina_obj.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False, clip=clip)
+    if not pix.width or not pix.height:
+        return None, 255
+    img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    if filtrar_moteado:
+        img = img.filter(ImageFilter.MedianFilter(3))
+    histograma = img.histogram()
+
+    total_pixeles = pix.width * pix.height
+    acumulado = 0
+    for nivel, cantidad in enumerate(histograma):
+        acumulado += cantidad
+        if acumulado * 2 >= total_pixeles:
+            return histograma, nivel
+    return histograma, 255
+
+
+def pagina_en_blanco_por_raster(pagina_obj, fraccion_max_tinta=FRACCION_MAX_TINTA_BLANCO):
+    """True si la página casi no tiene tinta, ni en la miniatura ni en la confirmación (no hace falta OCR)."""
+    histograma, fondo = _histograma_y_fondo(pagina_obj, ZOOM_MINIATURA_BLANCO)
+    if histograma is None:
+        return True
+    if sum(histograma[:max(0, fondo - DIFERENCIA_TINTA_BLANCO)]) > sum(histograma) * fraccion_max_tinta:
+        return False
+
+    histograma, fondo = _histograma_y_fondo(pagina_obj, ZOOM_CONFIRMACION_BLANCO, filtrar_moteado=True)
+    diferencia = max(DIFERENCIA_MINIMA_TINTA_BLANCO, int(fondo * DIFERENCIA_RELATIVA_TINTA_BLANCO))
+    return sum(histograma[:max(0, fondo - diferencia)]) <= sum(histograma) * fraccion_max_tinta
+
+
+# --- OCR adaptativo ---
+# Primero un pase rápido a zoom bajo y solo con los caracteres del identificador; el pase de alta
+# resolución se hace si el rápido no encuentra el identificador o si lo que lee no está entre los
+# identificadores válidos (BD/CSV). Los estados de las páginas resueltas con el pase rápido llevan
+# el primer prefijo; los demás "OCR_*" escalaron, y con el último si fue por no validar.
+PREFIJO_ESTADO_OCR_RAPIDO = "OCR_RAPIDO_"
+PREFIJO_ESTADO_OCR_ALTA = "OCR_"
+PREFIJO_ESTADO_OCR_ALTA_POR_VALIDACION = "OCR_REVALIDADO_"
+
+
+def pases_ocr(zoom_rapido, zoom_alto):
+    """Pases de OCR a intentar, en orden: [(zoom, es_rapido)]. Sin pase rápido si su zoom no es menor."""
+    pases = []
+    if zoom_rapido and zoom_rapido < zoom_alto:
+        pases.append((zoom_rapido, True))
+    pases.append((zoom_alto, False))
+    return pases
+
+
+def firma_identificadores_validos(identificadores_validos):
+    """Resumen de los identificadores válidos para la firma de la caché (el escalado depende de ellos)."""
+    if identificadores_validos is None:
+        return ""
+    return hashlib.sha256("\n".join(sorted(identificadores_validos)).encode("utf-8")).hexdigest()
+
+
+def config_de_pase(config, lista_blanca, es_rapido):
+    """Configuración de Tesseract del pase: en el rápido se limita a los caracteres de 'lista_blanca'."""
+    if es_rapido and lista_blanca:
+        return f"{config} -c tessedit_char_whitelist={lista_blanca}".strip()
+    return config
+
+
+def reportar_escalado_ocr(estados_paginas, etiqueta):
+    """
+    Imprime cuántas páginas con OCR necesitaron el pase de alta resolución, para ajustar los zooms,
+    y cuántas se descartaron en blanco.
+    """
+    rapidas = sum(1 for estado in estados_paginas if estado and estado.startswith(PREFIJO_ESTADO_OCR_RAPIDO))
+    escaladas = sum(
+        1 for estado in estados_paginas
+        if estado and estado.startswith(PREFIJO_ESTADO_OCR_ALTA)
+        and not estado.startswith(PREFIJO_ESTADO_OCR_RAPIDO) and not estado.endswith("EXCEPCION")
+    )
+    por_validacion = sum(1 for estado in estados_paginas if estado and estado.startswith(PREFIJO_ESTADO_OCR_ALTA_POR_VALIDACION))
+    en_blanco = sum(1 for estado in estados_paginas if estado == ESTADO_PAGINA_EN_BLANCO)
+    if en_blanco:
+        print(f"    - {en_blanco} páginas en blanco descartadas sin OCR ({etiqueta}).")
+    total = rapidas + escaladas
+    if not total:
+        return
+    print(f"    - OCR adaptativo ({etiqueta}): {escaladas} de {total} páginas con OCR escalaron al pase de alta resolución "
+          f"({escaladas / total:.1%}), {por_validacion} de ellas porque lo leído en el pase rápido no era válido; "
+          f"{rapidas} se resolvieron con el pase rápido.")
+
+
+# --- OCR de páginas en paralelo ---
+# Número de procesos para analizar páginas (0 = uno por núcleo). Se puede fijar por modo con
+# la clave "ocr_num_procesos" del mode_config.
+OCR_NUM_PROCESOS = int(os.environ.get("GOB_OCR_PROCESOS", "0") or 0)
+# Por debajo de este número de páginas no compensa arrancar procesos
+OCR_MIN_PAGINAS_PARALELO = 8
+OCR_PAGINAS_POR_TAREA = 2
+
+_estado_proceso_ocr = {}
+
+
+def resolver_num_procesos_ocr(mode_config=None):
+    configurado = (mode_config or {}).get("ocr_num_procesos") or OCR_NUM_PROCESOS
+    return max(1, int(configurado or os.cpu_count() or 1))
+
+
+def _inicializar_proceso_ocr(ruta_pdf, funcion_pagina, argumentos):
+    """Cada proceso abre el PDF una sola vez y reutiliza su motor de OCR para todas sus páginas."""
+    import fitz # PyMuPDF
+    _estado_proceso_ocr["doc"] = fitz.open(ruta_pdf)
+    _estado_proceso_ocr["funcion"] = funcion_pagina
+    _estado_proceso_ocr["argumentos"] = argumentos
+
+
+def _analizar_pagina_en_proceso(i_pagina):
+    try:
+        pagina_obj = _estado_proceso_ocr["doc"].load_page(i_pagina)
+        return _estado_proceso_ocr["funcion"](pagina_obj, i_pagina + 1, *_estado_proceso_ocr["argumentos"]), None
+    except Exception as e_pagina:
+        return None, f"{type(e_pagina).__name__}: {e_pagina}"
+
+
+def _analizar_paginas_secuencial(doc_fitz, funcion_pagina, argumentos, paginas):
+    for i_pagina in paginas:
+        try:
+            yield i_pagina, funcion_pagina(doc_fitz.load_page(i_pagina), i_pagina + 1, *argumentos), None
+        except Exception as e_pagina:
+            yield i_pagina, None, f"{type(e_pagina).__name__}: {e_pagina}"
+
+
+def _analizar_paginas(doc_fitz, ruta_pdf, funcion_pagina, argumentos, num_procesos, paginas):
+    """Analiza las páginas indicadas (en orden), en un pool de procesos si compensa."""
+    if num_procesos <= 1 or len(paginas) < OCR_MIN_PAGINAS_PARALELO:
+        yield from _analizar_paginas_secuencial(doc_fitz, funcion_pagina, argumentos, paginas)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    # Tesseract ya paraleliza internamente con OpenMP; con un proceso por núcleo eso solo compite
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    num_procesos = min(num_procesos, len(paginas))
+    print(f"    - Analizando {len(paginas)} páginas con {num_procesos} procesos de OCR...")
+    siguiente = 0
+    try:
+        with ProcessPoolExecutor(
+            max_workers=num_procesos,
+            initializer=_inicializar_proceso_ocr,
+            initargs=(str(ruta_pdf), funcion_pagina, tuple(argumentos)),
+        ) as pool:
+            resultados = pool.map(_analizar_pagina_en_proceso, paginas, chunksize=OCR_PAGINAS_POR_TAREA)
+            for posicion, (resultado, error) in enumerate(resultados):
+                yield paginas[posicion], resultado, error
+                siguiente = posicion + 1
+    except Exception as e_pool:
+        if siguiente >= len(paginas):
+            raise
+        print(f"    - (*) Advertencia: Falló el pool de OCR en la página {paginas[siguiente] + 1} ({e_pool}). Se continúa en un solo proceso.")
+        yield from _analizar_paginas_secuencial(doc_fitz, funcion_pagina, argumentos, paginas[siguiente:])
+
+
+def analizar_paginas_pdf(doc_fitz, ruta_pdf, funcion_pagina, argumentos=(), num_procesos=1, cache_ocr=None, firma_cache=""):
+    """
+    Aplica funcion_pagina(pagina_obj, num_pagina, *argumentos) a todas las páginas del PDF y
+    produce (i_pagina, resultado, error) estrictamente en orden de página, para que la lógica de
+    agrupación se mantenga igual. Con num_procesos > 1 el render y el OCR se reparten en un pool
+    de procesos (funcion_pagina y argumentos deben poder enviarse a otro proceso: funciones de
+    módulo y datos simples). Si el pool falla, las páginas restantes se analizan aquí mismo.
+    Con cache_ocr (CacheOCRPaginas) las páginas ya analizadas de este mismo PDF, con la misma
+    'firma_cache' (regiones, zooms, patrones...), se toman de la caché y no se vuelven a analizar.
+    """
+    total_paginas = doc_fitz.page_count
+    if cache_ocr is None:
+        yield from _analizar_paginas(doc_fitz, ruta_pdf, funcion_pagina, argumentos, num_procesos, list(range(total_paginas)))
+        return
+
+    try:
+        hash_pdf = _hash_archivo_pdf(ruta_pdf)
+        firma = _firma_cache_ocr(funcion_pagina, firma_cache)
+        en_cache = cache_ocr.cargar(hash_pdf, firma)
+    except Exception as e_cache:
+        print(f"    - (*) Advertencia: No se pudo leer la caché de OCR ({e_cache}). Se analizarán todas las páginas.")
+        yield from _analizar_paginas(doc_fitz, ruta_pdf, funcion_pagina, argumentos, num_procesos, list(range(total_paginas)))
+        return
+
+    pendientes = [i_pagina for i_pagina in range(total_paginas) if i_pagina not in en_cache]
+    if en_cache:
+        print(f"    - Caché de OCR: {total_paginas - len(pendientes)} de {total_paginas} páginas ya analizadas; se analizarán {len(pendientes)}.")
+    analizadas = _analizar_paginas(doc_fitz, ruta_pdf, funcion_pagina, argumentos, num_procesos, pendientes)
+    por_guardar = []
+    try:
+        for i_pagina in range(total_paginas):
+            if i_pagina in en_cache:
+                yield i_pagina, en_cache[i_pagina], None
+                continue
+            i_analizada, resultado, error = next(analizadas)
+            if not error and _resultado_cacheable(resultado):
+                por_guardar.append((i_analizada, resultado))
+                # Se guarda por tandas para no perder el avance si el lote se interrumpe
+                if len(por_guardar) >= CACHE_OCR_PAGINAS_POR_ESCRITURA:
+                    cache_ocr.guardar(hash_pdf, firma, por_guardar)
+                    por_guardar = []
+            yield i_analizada, resultado, error
+    finally:
+        try:
+            if por_guardar:
+                cache_ocr.guardar(hash_pdf, firma, por_guardar)
+            cache_ocr.marcar_usadas(hash_pdf, firma, list(en_cache))
+            cache_ocr.podar()
+        except Exception as e_cache:
+            print(f"    - (*) Advertencia: No se pudo actualizar la caché de OCR: {e_cache}")
+
+
+# --- Caché persistente de resultados por página ---
+# Guarda, por (hash del PDF, firma de la configuración, página), lo que devolvió la función de
+# página, para que volver a escanear el mismo PDF (tras un fallo o tras corregir la BD) no repita
+# el OCR. Está acotada: se descartan las entradas sin usar en CACHE_OCR_DIAS días y, si aun así
+# hay más de CACHE_OCR_MAX_PAGINAS, las usadas hace más tiempo.
+CACHE_OCR_HABILITADA = os.environ.get("GOB_OCR_CACHE", "1").strip().lower() not in ("0", "false", "no", "")
+CACHE_OCR_MAX_PAGINAS = int(os.environ.get("GOB_OCR_CACHE_MAX_PAGINAS", "200000") or 200000)
+CACHE_OCR_DIAS = 90
+CACHE_OCR_VERSION = 2
+CACHE_OCR_DIRNAME = "_cache_datos"
+CACHE_OCR_NOMBRE_ARCHIVO = "ocr_paginas.sqlite"
+CACHE_OCR_PAGINAS_POR_ESCRITURA = 25
+
+
+def _hash_archivo_pdf(ruta_pdf):
+    digest = hashlib.sha256()
+    with open(ruta_pdf, "rb") as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(bloque)
+    return digest.hexdigest()
+
+
+def _firma_cache_ocr(funcion_pagina, firma_cache):
+    """
+    Todo lo que cambia el resultado de una página: la función, su configuración, el detector de
+    blancos y la lectura del código de ID.
+    """
+    partes = (
+        CACHE_OCR_VERSION, funcion_pagina.__module__, funcion_pagina.__qualname__, firma_cache,
+        ZOOM_MINIATURA_BLANCO, MARGEN_MINIATURA_BLANCO, DIFERENCIA_TINTA_BLANCO, FRACCION_MAX_TINTA_BLANCO,
+        ZOOM_CONFIRMACION_BLANCO, DIFERENCIA_RELATIVA_TINTA_BLANCO, DIFERENCIA_MINIMA_TINTA_BLANCO,
+        ZXING_INSTALLED, REGION_LECTURA_CODIGO_ID, ZOOM_LECTURA_CODIGO_ID,
+    )
+    return hashlib.sha256(repr(partes).encode("utf-8")).hexdigest()
+
+
+def _resultado_cacheable(resultado):
+    """Solo se guardan resultados completos: ni excepciones ni valores que no sean JSON."""
+    if not isinstance(resultado, (tuple, list)) or len(resultado) != 2:
+        return False
+    estado = resultado[1]
+    return isinstance(estado, str) and not estado.endswith("EXCEPCION")
+
+
+class CacheOCRPaginas:
+    """Caché de resultados de OCR por página sobre un archivo SQLite local."""
+
+    def __init__(self, ruta_sqlite):
+        self.ruta_sqlite = Path(ruta_sqlite)
+        self.ruta_sqlite.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._conectar()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS paginas ("
+                " pdf_hash TEXT NOT NULL, firma TEXT NOT NULL, pagina INTEGER NOT NULL,"
+                " resultado TEXT NOT NULL, usado REAL NOT NULL,"
+                " PRIMARY KEY (pdf_hash, firma, pagina))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_paginas_usado ON paginas (usado)")
+
+    def _conectar(self):
+        # 'with conn' solo confirma o revierte la transacción; el cierre lo hace 'closing'
+        return sqlite3.connect(self.ruta_sqlite, timeout=30)
+
+    def cargar(self, pdf_hash, firma):
+        """{i_pagina: resultado} de las páginas guardadas para este PDF y esta firma."""
+        with closing(self._conectar()) as conn, conn:
+            filas = conn.execute(
+                "SELECT pagina, resultado FROM paginas WHERE pdf_hash = ? AND firma = ?", (pdf_hash, firma)
+            ).fetchall()
+        return {pagina: tuple(json.loads(resultado)) for pagina, resultado in filas}
+
+    def guardar(self, pdf_hash, firma, paginas_y_resultados):
+        ahora = time.time()
+        with closing(self._conectar()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO paginas (pdf_hash, firma, pagina, resultado, usado) VALUES (?, ?, ?, ?, ?)",
+                [(pdf_hash, firma, i_pagina, json.dumps(list(resultado)), ahora) for i_pagina, resultado in paginas_y_resultados],
+            )
+
+    def marcar_usadas(self, pdf_hash, firma, paginas):
+        if not paginas:
+            return
+        ahora = time.time()
+        with closing(self._conectar()) as conn, conn:
+            conn.executemany(
+                "UPDATE paginas SET usado = ? WHERE pdf_hash = ? AND firma = ? AND pagina = ?",
+                [(ahora, pdf_hash, firma, i_pagina) for i_pagina in paginas],
+            )
+
+    def podar(self, max_paginas=None, dias=CACHE_OCR_DIAS):
+        """Descarta entradas viejas y, si se pasa del límite, las usadas hace más tiempo."""
+        max_paginas = CACHE_OCR_MAX_PAGINAS if max_paginas is None else max_paginas
+        with closing(self._conectar()) as conn, conn:
+            conn.execute("DELETE FROM paginas WHERE usado < ?", (time.time() - dias * 86400,))
+            sobrantes = conn.execute("SELECT COUNT(*) FROM paginas").fetchone()[0] - max_paginas
+            if sobrantes > 0:
+                conn.execute(
+                    "DELETE FROM paginas WHERE rowid IN (SELECT rowid FROM paginas ORDER BY usado LIMIT ?)", (sobrantes,)
+                )
+
+
+def obtener_cache_ocr(mode_config):
+    """Caché de OCR del modo (en su carpeta '_cache_datos'), o None si está deshabilitada o no se puede abrir."""
+    if not CACHE_OCR_HABILITADA or not (mode_config or {}).get("base_path"):
+        return None
+    try:
+        return CacheOCRPaginas(Path(mode_config["base_path"]) / CACHE_OCR_DIRNAME / CACHE_OCR_NOMBRE_ARCHIVO)
+    except Exception as e_cache:
+        print(f"    - (*) Advertencia: No se pudo abrir la caché de OCR ({e_cache}). Se escaneará sin caché.")
+        return None
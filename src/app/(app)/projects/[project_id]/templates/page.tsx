@@ -22,6 +22,7 @@ export default function TemplatesPage() {
   const [numRowsToGenerate, setNumRowsToGenerate] = useState<number | null>(null);
   const [jobId, setJobId] = useState<string | null>(null);
   const [jobStatus, setJobStatus] = useState<string | null>(null);
+  const [jobProgress, setJobProgress] = useState<string | null>(null);
   const [jobResultUrl, setJobResultUrl] = useState<string | null>(null);
   const [templateId, setTemplateId] = useState<number | null>(null);
   const [existingTemplates, setExistingTemplates] = useState<any[]>([]);
@@ -154,6 +155,7 @@ export default function TemplatesPage() {
     setError(null);
     setJobId(null);
     setJobStatus(null);
+    setJobProgress(null);
     setJobResultUrl(null);
 
     const formData = new FormData();
@@ -180,23 +182,30 @@ export default function TemplatesPage() {
         setJobId(data.job_id);
         setJobStatus("PENDING");
 
-        // Iniciar el polling para el estado del trabajo
-        const pollStatus = async () => {
-          if (!data.job_id) return;
-          const statusResponse = await fetch(`http://127.0.0.1:8000/jobs/${data.job_id}`);
-          const statusData = await statusResponse.json();
+        // Suscribirse al flujo de eventos de progreso del trabajo
+        const events = new EventSource(`http://127.0.0.1:8000/jobs/${data.job_id}/events`);
+        events.onmessage = (event) => {
+          const statusData = JSON.parse(event.data);
           setJobStatus(statusData.status);
+          setJobProgress(statusData.message || null);
           if (statusData.status === "SUCCESS") {
             setJobResultUrl(statusData.result_url);
             setIsLoading(false);
-          } else if (statusData.status === "FAILURE") {
-            setError(statusData.info?.status || "Error desconocido durante la generación.");
+            events.close();
+          } else if (statusData.status === "FAILURE" || statusData.status === "REVOKED") {
+            setError(statusData.error || (statusData.status === "REVOKED"
+              ? "El trabajo fue cancelado."
+              : "Error desconocido durante la generación."));
             setIsLoading(false);
-          } else {
-            setTimeout(pollStatus, 2000); // Reintentar en 2 segundos
+            events.close();
           }
         };
-        pollStatus();
+        events.onerror = () => {
+          // Sin esto el navegador reintenta la conexión indefinidamente y la UI queda cargando
+          events.close();
+          setError("Se perdió la conexión con el servidor mientras se generaban los documentos.");
+          setIsLoading(false);
+        };
 
     } catch (err: any) {
         setError(err.message);
@@ -464,8 +473,8 @@ export default function TemplatesPage() {
               </CardHeader>
               <CardContent>
                 <p>Estado: {jobStatus}</p>
-                {jobStatus === "PROGRESS" && jobStatus && (
-                  <p>Progreso: {jobStatus}</p>
+                {jobStatus === "PROGRESS" && jobProgress && (
+                  <p>Progreso: {jobProgress}</p>
                 )}
                 {jobResultUrl && (
                   <Button asChild className="mt-4">